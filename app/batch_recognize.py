@@ -0,0 +1,205 @@
+"""
+Recognize the signs of a batch of videos (.mp4) or of already extracted landmarks (pose_<name>.pickle,
+next to lh_<name>.pickle & rh_<name>.pickle) without the interactive menu, e.g.
+
+    python app/batch_recognize.py clips/ --output predictions.jsonl --workers 8
+
+It is run from the project directory, like main.py (the reference signs are loaded from app/data).
+The clips are processed by a pool of processes (each one keeps a MediaPipe model & attaches the reference
+signs published in shared memory)
+and one JSON line is written per clip as soon as it is recognized
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import mediapipe as mp
+import numpy as np
+
+from idk_name import get_sign_predicted
+from models.sign_model import SignModel
+from utils.dataset_utils import load_dataset, load_reference_signs
+from utils.dtw import DTW_ENGINES, dtw_distances
+from utils.dtw_search import ReferenceEnvelopes, dtw_search
+from utils.landmark_utils import (
+    LEFT_HAND_LANDMARKS, POSE_LANDMARKS, RIGHT_HAND_LANDMARKS, load_array, read_landmarks_from_video
+)
+from utils.shared_references import SharedReferences, attach_reference_signs
+
+
+# Reference signs, options & MediaPipe model of a worker process, set by _init_worker
+_worker_references = None
+_worker_envelopes = None
+_worker_options = None
+_worker_holistic = None
+
+
+def iter_inputs(path):
+    """
+    :param path: directory (searched recursively) or manifest (text file with one path per line)
+    :return: Iterator over the paths of the videos & pose landmark files
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                if is_input_file(file_name):
+                    yield os.path.join(root, file_name)
+    else:
+        with open(path) as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+
+def is_input_file(path) -> bool:
+    file_name = os.path.basename(path)
+    return file_name.endswith(".mp4") or (file_name.startswith("pose_") and file_name.endswith(".pickle"))
+
+
+def read_landmarks(path):
+    """
+    :return: The pose, left hand & right hand landmarks of a video or of a pose landmark file
+    """
+    if path.endswith(".mp4"):
+        if _worker_holistic is None:
+            _init_holistic()
+        # Forget the tracking state of the previous video
+        _worker_holistic.reset()
+        landmarks = read_landmarks_from_video(path, _worker_holistic)
+        return landmarks[:, POSE_LANDMARKS], landmarks[:, LEFT_HAND_LANDMARKS], landmarks[:, RIGHT_HAND_LANDMARKS]
+
+    folder, file_name = os.path.split(path)
+    name = file_name[len("pose_"):-len(".pickle")]
+    return [load_array(os.path.join(folder, f"{prefix}_{name}.pickle")) for prefix in ["pose", "lh", "rh"]]
+
+
+def _init_worker(descriptor, options):
+    global _worker_references, _worker_envelopes, _worker_options
+    _worker_references = attach_reference_signs(descriptor)
+    _worker_options = options
+    _worker_envelopes = ReferenceEnvelopes(_worker_references) if options["search"] else None
+
+
+def _init_holistic():
+    global _worker_holistic
+    _worker_holistic = mp.solutions.holistic.Holistic(
+        min_detection_confidence=0.5, min_tracking_confidence=0.5
+    )
+
+
+def _recognize(path):
+    """
+    :return: The prediction, the top_k closest reference signs & the time of each stage for a clip
+             (or the error raised while processing it)
+    """
+    options = _worker_options
+    result = {"input": path}
+    timings = {}
+    try:
+        start = time.perf_counter()
+        pose_list, left_hand_list, right_hand_list = read_landmarks(path)
+        timings["landmarks"] = time.perf_counter() - start
+
+        stage_start = time.perf_counter()
+        recorded_sign = SignModel(pose_list, left_hand_list, right_hand_list)
+        timings["embedding"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        if options["search"]:
+            reference_signs, _ = dtw_search(
+                recorded_sign, _worker_references.copy(), k=options["top_k"], envelopes=_worker_envelopes
+            )
+        else:
+            reference_signs = dtw_distances(recorded_sign, _worker_references.copy(), engine=options["engine"])
+        timings["matching"] = time.perf_counter() - stage_start
+
+        result["n_frames"] = len(pose_list)
+        result["prediction"] = get_sign_predicted(reference_signs, options["batch_size"], options["threshold"])
+        result["top_k"] = [
+            {"name": name, "video_id": video_id, "distance": float(distance) if np.isfinite(distance) else None}
+            for name, video_id, distance in reference_signs[["name", "video_id", "distance"]].head(options["top_k"]).values
+        ]
+        timings["total"] = time.perf_counter() - start
+    except Exception as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+    result["timings"] = timings
+    return result
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Recognize the signs of videos or landmark files (JSON Lines output)")
+    parser.add_argument("input", help="directory of .mp4 / pose_*.pickle files, or manifest with one path per line")
+    parser.add_argument("-o", "--output", default="-", help="JSON Lines file (standard output by default)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument("--engine", choices=DTW_ENGINES, default="fastdtw", help="DTW engine")
+    parser.add_argument(
+        "--search", action="store_true", help="lower bound pruned search (numpy engine, only top-k distances are exact)"
+    )
+    parser.add_argument("-k", "--top-k", type=int, default=5, help="number of closest reference signs written")
+    parser.add_argument("--batch-size", type=int, default=1, help="number of reference signs voting for the prediction")
+    parser.add_argument("--threshold", type=float, default=0.5, help="minimum proportion of votes of the prediction")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    # Extract the reference videos that are not in the dataset yet & load the reference signs
+    # (the progress messages must not be mixed with the JSON Lines written to the standard output)
+    with contextlib.redirect_stdout(sys.stderr):
+        videos = load_dataset(args.workers)
+        reference_signs = load_reference_signs(videos)
+
+    options = {
+        "engine": "numpy" if args.search else args.engine,
+        "search": args.search,
+        "top_k": max(args.top_k, args.batch_size),
+        "batch_size": args.batch_size,
+        "threshold": args.threshold,
+    }
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    shared_references = SharedReferences(reference_signs)
+    n_clips, n_errors = 0, 0
+    startTime = time.time()
+    try:
+        initargs = (shared_references.descriptor, options)
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=initargs)
+            results = pool.imap_unordered(_recognize, iter_inputs(args.input))
+        else:
+            pool = None
+            _init_worker(*initargs)
+            results = map(_recognize, iter_inputs(args.input))
+
+        # Each result is written as soon as it arrives, nothing is kept in memory
+        for result in results:
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            n_clips += 1
+            n_errors += "error" in result
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        shared_references.close()
+        if output is not sys.stdout:
+            output.close()
+
+    total_time = time.time() - startTime
+    print(
+        f"{n_clips} clips ({n_errors} errors) recognized in {total_time:.2f} s with {args.workers} processes: "
+        f"{n_clips / max(total_time, 1e-9):.2f} clips/s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Benchmark of the recognition pipeline on synthetic (or already extracted) landmark sequences,
+without camera nor network:
+
+    python app/benchmark.py --vocabulary 20 --frames 50 --save baseline.json
+    python app/benchmark.py --vocabulary 20 --frames 50 --compare baseline.json
+
+Each stage reports its throughput, its p50 / p95 latency & its peak memory (tracemalloc).
+A run saved with --save can be compared with a later one: the stages whose p50 latency grew by
+more than --tolerance are reported as regressions (exit code 1)
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from idk_name import evaluate, get_sign_predicted
+from models.sign_model import SignModel
+from utils.dtw import DTW_ENGINES, dtw_distances
+from utils.landmark_utils import (
+    LEFT_HAND_LANDMARKS, N_LANDMARKS, POSE_LANDMARKS, RIGHT_HAND_LANDMARKS, extract_landmarks, load_array
+)
+
+
+# Hands used by the synthetic signs (left, right), in turn
+HAND_CONFIGURATIONS = [(False, True), (True, True), (True, False)]
+
+
+class _Landmark(object):
+    __slots__ = ("x", "y", "z")
+
+    def __init__(self, x, y, z):
+        self.x, self.y, self.z = x, y, z
+
+
+class _LandmarkList(object):
+    """Object with the same interface as a MediaPipe NormalizedLandmarkList"""
+
+    def __init__(self, points):
+        self.landmark = [_Landmark(*point) for point in points.tolist()]
+
+
+def make_results(landmarks: np.ndarray):
+    """
+    :param landmarks: array (N_LANDMARKS, 3) of a frame
+    :return: Object with the same interface as the MediaPipe Holistic results of the frame
+    """
+    def to_landmark_list(points):
+        return _LandmarkList(points) if points.any() else None
+
+    return SimpleNamespace(
+        pose_landmarks=to_landmark_list(landmarks[POSE_LANDMARKS]),
+        left_hand_landmarks=to_landmark_list(landmarks[LEFT_HAND_LANDMARKS]),
+        right_hand_landmarks=to_landmark_list(landmarks[RIGHT_HAND_LANDMARKS]),
+    )
+
+
+def make_synthetic_signs(vocabulary=10, signers=3, frames=50, seed=0) -> pd.DataFrame:
+    """
+    One smooth random trajectory of the landmarks per sign, performed by each signer with
+    a different speed & some noise
+
+    :return: pd.DataFrame (name, signer, video_id, landmarks) where landmarks is an array (n_frame, N_LANDMARKS, 3)
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for sign in range(vocabulary):
+        steps = rng.normal(scale=0.01, size=(2 * frames, N_LANDMARKS, 3))
+        template = rng.random((N_LANDMARKS, 3)) + np.cumsum(steps, axis=0)
+        has_left_hand, has_right_hand = HAND_CONFIGURATIONS[sign % len(HAND_CONFIGURATIONS)]
+
+        for signer in range(signers):
+            n_frames = max(2, int(frames * rng.uniform(0.8, 1.2)))
+            time_steps = np.sort(rng.uniform(0, len(template) - 1, n_frames)).astype(int)
+            landmarks = template[time_steps] + rng.normal(scale=0.005, size=(n_frames, N_LANDMARKS, 3))
+            if not has_left_hand:
+                landmarks[:, LEFT_HAND_LANDMARKS] = 0
+            if not has_right_hand:
+                landmarks[:, RIGHT_HAND_LANDMARKS] = 0
+
+            rows.append({
+                "name": f"sign{sign}", "signer": f"signer{signer}", "video_id": f"sign{sign}-signer{signer}-0",
+                "landmarks": landmarks,
+            })
+    return pd.DataFrame(rows)
+
+
+def load_extracted_signs(dataset_path=os.path.join("app", "data", "dataset")) -> pd.DataFrame:
+    """
+    :return: The landmarks already extracted in the dataset folder, same format as make_synthetic_signs
+    """
+    rows = []
+    for root, dirs, files in sorted(os.walk(dataset_path)):
+        for file_name in sorted(files):
+            if not (file_name.startswith("pose_") and file_name.endswith(".pickle")):
+                continue
+            video_name = file_name[len("pose_"):-len(".pickle")]
+            sign_name, signer, _ = video_name.split("-")
+            pose, left_hand, right_hand = [
+                load_array(os.path.join(root, f"{prefix}_{video_name}.pickle")) for prefix in ["pose", "lh", "rh"]
+            ]
+            rows.append({
+                "name": sign_name, "signer": signer, "video_id": video_name,
+                "landmarks": np.concatenate([pose, left_hand, right_hand], axis=1),
+            })
+    return pd.DataFrame(rows)
+
+
+def measure(function, calls, repeat=1, trace_memory=True) -> dict:
+    """
+    :param calls: list of the arguments (tuples) of each call
+    :param repeat: number of times the calls are timed
+    :return: Number of calls, throughput (calls/s), p50 & p95 latency (ms) & peak memory (KiB) of the function
+    """
+    durations = []
+    for _ in range(repeat):
+        for args in calls:
+            start = time.perf_counter()
+            function(*args)
+            durations.append(time.perf_counter() - start)
+
+    # The memory is traced in a separate pass since tracemalloc slows down the calls
+    peak_memory = None
+    if trace_memory:
+        tracemalloc.start()
+        for args in calls:
+            function(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+
+    durations = np.array(durations) * 1000
+    return {
+        "calls": len(durations),
+        "throughput": len(durations) / max(durations.sum() / 1000, 1e-12),
+        "p50_ms": float(np.percentile(durations, 50)),
+        "p95_ms": float(np.percentile(durations, 95)),
+        "peak_memory_kib": peak_memory,
+    }
+
+
+def run_fold(training_set: pd.DataFrame, validation_set: pd.DataFrame, engine="fastdtw"):
+    # Same as the cross validation of a signer in the offline evaluation of main.py (without the prints)
+    return [
+        evaluate(sign_model, training_set, engine=engine)
+        for sign_model in validation_set["sign_model"]
+    ]
+
+
+def run_benchmarks(signs: pd.DataFrame, engines, repeat=1, folds=1) -> dict:
+    results = {}
+
+    # Conversion of the MediaPipe results of each frame (pose & both hands)
+    frames = [make_results(landmarks) for sign_landmarks in signs["landmarks"] for landmarks in sign_landmarks]
+    out = np.empty((N_LANDMARKS, 3), dtype=np.float32)
+    results["extract_landmarks"] = measure(extract_landmarks, [(frame, out) for frame in frames], repeat)
+
+    # Embedding of each sign
+    results["sign_model"] = measure(
+        lambda landmarks: SignModel(
+            landmarks[:, POSE_LANDMARKS], landmarks[:, LEFT_HAND_LANDMARKS], landmarks[:, RIGHT_HAND_LANDMARKS]
+        ),
+        [(landmarks,) for landmarks in signs["landmarks"]], repeat,
+    )
+    reference_signs = signs.drop(columns="landmarks").assign(
+        sign_model=[
+            SignModel(landmarks[:, POSE_LANDMARKS], landmarks[:, LEFT_HAND_LANDMARKS], landmarks[:, RIGHT_HAND_LANDMARKS])
+            for landmarks in signs["landmarks"]
+        ],
+        distance=0,
+    )[["name", "sign_model", "signer", "distance", "video_id"]]
+
+    # Matching of each sign of the first signer with the signs of the other signers
+    signers = list(reference_signs["signer"].unique())
+    queries = reference_signs.loc[reference_signs["signer"] == signers[0], "sign_model"]
+    training_set = reference_signs.loc[reference_signs["signer"] != signers[0]]
+    for engine in engines:
+        results[f"dtw_distances[{engine}]"] = measure(
+            lambda sign_model: dtw_distances(sign_model, training_set.copy(), engine=engine),
+            [(sign_model,) for sign_model in queries], repeat,
+        )
+
+    sorted_signs = dtw_distances(queries.iloc[0], training_set.copy(), engine=engines[0])
+    results["get_sign_predicted"] = measure(get_sign_predicted, [(sorted_signs,)] * 100, repeat)
+
+    # Leave-one-signer-out folds of the offline evaluation
+    for engine in engines:
+        results[f"offline_fold[{engine}]"] = measure(
+            lambda signer: run_fold(
+                reference_signs.loc[reference_signs["signer"] != signer],
+                reference_signs.loc[reference_signs["signer"] == signer],
+                engine,
+            ),
+            [(signer,) for signer in signers[:folds]], repeat, trace_memory=False,
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance=0.1) -> bool:
+    """
+    Print the p50 latency of each stage compared with the baseline
+
+    :return: True if a stage is slower than the baseline by more than tolerance
+    """
+    regression = False
+    print(f"\n{'stage':<28}{'baseline p50':>14}{'p50':>12}{'ratio':>8}")
+    for name, stats in results.items():
+        if name not in baseline["benchmarks"]:
+            continue
+        reference = baseline["benchmarks"][name]["p50_ms"]
+        ratio = stats["p50_ms"] / max(reference, 1e-12)
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regression = True
+        print(f"{name:<28}{reference:>12.3f}ms{stats['p50_ms']:>10.3f}ms{ratio:>8.2f}{flag}")
+    return regression
+
+
+def print_results(results: dict):
+    print(f"\n{'stage':<28}{'calls':>7}{'calls/s':>12}{'p50':>12}{'p95':>12}{'peak memory':>14}")
+    for name, stats in results.items():
+        memory = f"{stats['peak_memory_kib']:.0f} KiB" if stats["peak_memory_kib"] is not None else "-"
+        print(
+            f"{name:<28}{stats['calls']:>7}{stats['throughput']:>12.1f}"
+            f"{stats['p50_ms']:>10.3f}ms{stats['p95_ms']:>10.3f}ms{memory:>14}"
+        )
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the sign recognition")
+    parser.add_argument("--vocabulary", type=int, default=10, help="number of synthetic signs")
+    parser.add_argument("--signers", type=int, default=3, help="number of synthetic signers")
+    parser.add_argument("--frames", type=int, default=50, help="mean number of frames of the synthetic signs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dataset", action="store_true", help="use the landmarks extracted in app/data/dataset")
+    parser.add_argument("--engine", choices=DTW_ENGINES, nargs="+", default=DTW_ENGINES, help="DTW engines timed")
+    parser.add_argument("--repeat", type=int, default=3, help="number of times each stage is timed")
+    parser.add_argument("--folds", type=int, default=1, help="number of signers used as validation set")
+    parser.add_argument("--save", help="write the results in this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown of the p50 reported as a regression")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    config = {
+        "vocabulary": args.vocabulary, "signers": args.signers, "frames": args.frames, "seed": args.seed,
+        "dataset": args.dataset, "engines": args.engine, "repeat": args.repeat, "folds": args.folds,
+    }
+    if args.dataset:
+        signs = load_extracted_signs()
+    else:
+        signs = make_synthetic_signs(args.vocabulary, args.signers, args.frames, args.seed)
+    print(f"{len(signs)} signs, {sum(len(landmarks) for landmarks in signs['landmarks'])} frames")
+
+    results = run_benchmarks(signs, args.engine, args.repeat, args.folds)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({
+                "config": config,
+                "environment": {
+                    "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                    "machine": platform.machine(), "processor": platform.processor(),
+                },
+                "benchmarks": results,
+            }, file, indent=2)
+        print(f"\nResults saved in {args.save}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline["config"] != config:
+            print(f"\nWarning: the baseline was run with another configuration: {baseline['config']}")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
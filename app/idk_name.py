@@ -1,16 +1,75 @@
-import array
-import time
 from collections import Counter
+import numpy as np
 import pandas as pd
 
+from utils.descriptor_filter import prefiltered_dtw_distances
 from utils.dtw import dtw_distances
+from utils.dtw_search import dtw_search
 from models.sign_model import SignModel
-from utils.landmark_utils import extract_landmarks
+from utils.landmark_utils import LEFT_HAND_LANDMARKS, POSE_LANDMARKS, RIGHT_HAND_LANDMARKS
 
 
-def evaluate(recorded_results, reference_signs: pd.DataFrame, print_results=False):
+def get_matching_method(
+    search_k=None, pool=None, prefilter_k=None, pivot_index=None, prototype_index=None, multiresolution=None,
+    incremental=False
+) -> str:
+    """
+    Name of the matching used by evaluate & compute_distances with these options (only whether each one
+    is None matters, so the numbers of pivots, prototypes or processes can be given before building them).
+    search_k is the number of exact neighbours of the pruned search, of each shard of the pool
+    or of the pivot table: it can't be combined with the other options
+
+    :param incremental: the distances are computed during the recording (see SignRecorder)
+
+    :raise ValueError: if several matchings are selected (only one of them would be used), or if the prefilter
+                       shortlists no reference
+    """
+    if prefilter_k is not None and prefilter_k < 1:
+        raise ValueError(f"The descriptor prefilter must shortlist at least 1 reference, got {prefilter_k}")
+
+    methods = ["incremental DTW"] if incremental else []
+    if multiresolution is not None:
+        methods.append("coarse-to-fine search")
+    if pool is not None:
+        methods.append("DTW processes" if search_k is None else f"DTW processes (pruned search, k={search_k})")
+    if pivot_index is not None:
+        methods.append(f"pivot table (k={search_k or 1})")
+    if prototype_index is not None:
+        methods.append("prototypes")
+    if prefilter_k is not None:
+        methods.append(f"descriptor prefilter (k={prefilter_k})")
+    if search_k is not None and pool is None and pivot_index is None:
+        methods.append(f"lower bound pruned search (k={search_k})")
+
+    if len(methods) > 1:
+        raise ValueError(f"Only one matching can be used, got: {', '.join(methods)}")
+    return methods[0] if methods else "DTW of every reference"
+
+
+def evaluate(
+    recorded_results, reference_signs: pd.DataFrame, print_results=False, engine="fastdtw", search_k=None,
+    envelopes=None, pool=None, prefilter_k=None, descriptors=None, pivot_index=None, prototype_index=None,
+    multiresolution=None
+):
     # Compute sign similarity with DTW (ascending order)
-    updated_reference_signs = dtw_distances(recorded_results, reference_signs.copy())
+    if multiresolution is not None:
+        updated_reference_signs, _ = multiresolution.search(recorded_results, reference_signs.copy())
+    elif pool is not None:
+        updated_reference_signs = pool.dtw_distances(recorded_results, reference_signs.copy(), k=search_k)
+    elif pivot_index is not None:
+        updated_reference_signs, _ = pivot_index.search(recorded_results, reference_signs.copy(), k=search_k or 1)
+    elif prototype_index is not None:
+        updated_reference_signs, _ = prototype_index.search(recorded_results, reference_signs.copy())
+    elif prefilter_k is not None:
+        updated_reference_signs, _ = prefiltered_dtw_distances(
+            recorded_results, reference_signs.copy(), k=prefilter_k, descriptors=descriptors, engine=engine
+        )
+    elif search_k is None:
+        updated_reference_signs = dtw_distances(recorded_results, reference_signs.copy(), engine=engine)
+    else:
+        updated_reference_signs, _ = dtw_search(
+            recorded_results, reference_signs.copy(), k=search_k, envelopes=envelopes
+        )
 
     if print_results:
         print(updated_reference_signs.copy()[['name', 'signer', 'distance', 'video_id']].head(8))
@@ -18,27 +77,78 @@ def evaluate(recorded_results, reference_signs: pd.DataFrame, print_results=Fals
     return get_sign_predicted(updated_reference_signs, batch_size=1)
 
 
-def compute_distances(recorded_results: array.array, reference_signs: pd.DataFrame):
+def compute_distances(
+    landmarks: np.ndarray, reference_signs: pd.DataFrame, engine="fastdtw", search_k=None, envelopes=None,
+    pool=None, prefilter_k=None, descriptors=None, pivot_index=None, prototype_index=None, resolution=None,
+    multiresolution=None
+):
     """
     Updates the distance column of the reference_signs
-    and resets recording variables
+    and resets recording variables. Only one matching option can be set (see get_matching_method)
+
+    :param landmarks: array (n_frame, N_LANDMARKS, 3) of the recorded frames (see LandmarkBuffer)
+    :param search_k: if given, only the search_k closest reference signs get an exact distance
+                     (lower bound pruning, see dtw_search), the others are set to infinity
+    :param envelopes: ReferenceEnvelopes of reference_signs used by the pruned search
+    :param pool: DTWPool created with reference_signs, used to compute the distances in parallel
+    :param prefilter_k: if given, only the prefilter_k references with the closest descriptors get a DTW distance
+                        (see prefiltered_dtw_distances), the others are set to infinity
+    :param descriptors: DescriptorIndex of reference_signs used by the prefilter
+    :param pivot_index: PivotIndex of reference_signs, used to search the search_k (1 by default)
+                        closest references with the pivot table
+    :param prototype_index: PrototypeIndex of reference_signs: the recorded sign is compared with the prototypes,
+                            then with the other videos of the best signs
+    :param resolution: Resolution of the reference signs, applied to the recorded sign
+    :param multiresolution: MultiResolutionMatcher of reference_signs: the closest references at the coarse
+                            resolution are compared at full resolution
     """
-    pose_list, left_hand_list, right_hand_list = [], [], []
-    for results in recorded_results:
-        pose, left_hand, right_hand = extract_landmarks(results)
-        pose_list.append(pose)
-        left_hand_list.append(left_hand)
-        right_hand_list.append(right_hand)
-
     # Create a SignModel object with the landmarks gathered during recording
-    recorded_sign = SignModel(pose_list, left_hand_list, right_hand_list)
+    recorded_sign = SignModel(
+        landmarks[:, POSE_LANDMARKS], landmarks[:, LEFT_HAND_LANDMARKS], landmarks[:, RIGHT_HAND_LANDMARKS]
+    )
+    if resolution is not None:
+        recorded_sign = resolution.downsample(recorded_sign)
 
-    startTime = time.time()
     # Compute sign similarity with DTW (ascending order)
-    updated_reference_signs = dtw_distances(recorded_sign, reference_signs)
-    endTime = time.time()
-
-    print(f"*** Time to compute distances: {endTime - startTime} seconds")
+    if multiresolution is not None:
+        updated_reference_signs, stats = multiresolution.search(recorded_sign, reference_signs)
+        print(
+            f"*** {stats['references']} references: {stats['skipped']} skipped (hands), "
+            f"{stats['coarse']} coarse DTW, {stats['refined']} refined at full resolution"
+        )
+    elif pool is not None:
+        updated_reference_signs = pool.dtw_distances(recorded_sign, reference_signs, k=search_k)
+    elif pivot_index is not None:
+        updated_reference_signs, stats = pivot_index.search(recorded_sign, reference_signs, k=search_k or 1)
+        print(
+            f"*** {stats['references']} references: {stats['hand_mismatch']} skipped (hands), "
+            f"{stats['pivots']} pivots, {stats['pruned']} pruned by the pivots, {stats['dtw']} DTW"
+        )
+    elif prototype_index is not None:
+        updated_reference_signs, stats = prototype_index.search(recorded_sign, reference_signs)
+        print(
+            f"*** {stats['references']} references: {stats['hand_mismatch']} skipped (hands), "
+            f"{stats['prototypes']} prototypes, {stats['fallback']} other videos of the best signs"
+        )
+    elif prefilter_k is not None:
+        updated_reference_signs, stats = prefiltered_dtw_distances(
+            recorded_sign, reference_signs, k=prefilter_k, descriptors=descriptors, engine=engine
+        )
+        print(
+            f"*** {stats['references']} references: {stats['hand_mismatch']} skipped (hands), "
+            f"{stats['prefiltered']} discarded by the descriptors, {stats['dtw']} DTW"
+        )
+    elif search_k is None:
+        updated_reference_signs = dtw_distances(recorded_sign, reference_signs, engine=engine)
+    else:
+        updated_reference_signs, stats = dtw_search(
+            recorded_sign, reference_signs, k=search_k, envelopes=envelopes
+        )
+        print(
+            f"*** {stats['references']} references: {stats['hand_mismatch']} skipped (hands), "
+            f"{stats['lb_kim']} pruned by LB_Kim, {stats['lb_keogh']} pruned by LB_Keogh, "
+            f"{stats['abandoned']} abandoned, {stats['dtw']} full DTW"
+        )
 
     return updated_reference_signs
 
@@ -58,6 +168,15 @@ def get_sign_predicted(reference_signs, batch_size=5, threshold=0.5):
     # Get the list (of size batch_size) of the most similar reference signs
     sign_names = reference_signs.iloc[:batch_size]["name"].values
 
+    return get_sign_predicted_from_names(sign_names, batch_size, threshold)
+
+
+def get_sign_predicted_from_names(sign_names, batch_size=5, threshold=0.5):
+    """
+    Same as get_sign_predicted, from the names of the closest reference signs (ascending distance)
+    """
+    sign_names = sign_names[:batch_size]
+
     # Count the occurrences of each sign and sort them by descending order
     sign_counter = Counter(sign_names).most_common()
 
@@ -65,3 +184,49 @@ def get_sign_predicted(reference_signs, batch_size=5, threshold=0.5):
     if count / batch_size < threshold:
         return "Signe inconnu"
     return predicted_sign
+
+
+def predict_from_distance_matrix(
+    distance_matrix: np.ndarray, reference_signs: pd.DataFrame, signer, batch_size=1, threshold=0.5
+):
+    """
+    Cross validation of a signer from the precomputed distances between the reference signs:
+    the videos of the signer are compared to the videos of the other signers
+
+    :param distance_matrix: array (n_refs, n_refs) in the order of the rows of reference_signs
+    :return: The true & the predicted signs of the videos of the signer
+    """
+    signers = reference_signs["signer"].values
+    names = reference_signs["name"].values
+
+    validation_idx = np.flatnonzero(signers == signer)
+    training_idx = np.flatnonzero(signers != signer)
+
+    sign_true, sign_pred = [], []
+    for idx in validation_idx:
+        distances = distance_matrix[idx, training_idx]
+        closest = training_idx[np.argsort(distances, kind="stable")[:batch_size]]
+
+        sign_true.append(names[idx])
+        sign_pred.append(get_sign_predicted_from_names(names[closest], batch_size, threshold))
+    return sign_true, sign_pred
+
+
+def sweep_parameters(distance_matrix: np.ndarray, reference_signs: pd.DataFrame, signers, batch_sizes, thresholds):
+    """
+    Accuracy of the leave-one-signer-out cross validation for each (batch_size, threshold)
+
+    :return: pd.DataFrame of the accuracies (rows: batch_size, columns: threshold)
+    """
+    accuracies = pd.DataFrame(index=pd.Index(batch_sizes, name="batch_size"), columns=thresholds, dtype=float)
+    for batch_size in batch_sizes:
+        for threshold in thresholds:
+            n_correct, n_total = 0, 0
+            for signer in signers:
+                sign_true, sign_pred = predict_from_distance_matrix(
+                    distance_matrix, reference_signs, signer, batch_size, threshold
+                )
+                n_correct += sum(true == pred for true, pred in zip(sign_true, sign_pred))
+                n_total += len(sign_true)
+            accuracies.loc[batch_size, threshold] = n_correct / max(n_total, 1)
+    return accuracies
@@ -1,3 +1,5 @@
+import time
+
 import cv2
 import mediapipe
 import pandas as pd
@@ -6,16 +8,51 @@ from tqdm import tqdm
 import numpy as np
 
 from utils.metrics_utils import compute_metrics
-from idk_name import evaluate
+from idk_name import evaluate, get_matching_method, predict_from_distance_matrix, sweep_parameters
 from utils.dataset_utils import load_dataset, load_reference_signs
+from utils.distance_matrix import load_distance_matrix
+from utils.dtw import DTW_ENGINES
+from utils.dtw_pool import DTWPool
+from utils.descriptor_filter import DescriptorIndex, shortlist_recall
+from utils.dtw_search import ReferenceEnvelopes
+from utils.instrumentation import INSTRUMENTATION
+from utils.pivot_index import N_PIVOTS, SLACK, PivotIndex, load_pivot_index, pivot_miss_rate
+from utils.prototypes import (
+    N_PROTOTYPES, PrototypeIndex, condensation_report, load_prototype_index, within_sign_distances
+)
+from utils.resolution import MultiResolutionMatcher, Resolution, load_downsampled_reference_signs
 from utils.mediapipe_utils import mediapipe_detection
 from sign_recorder import SignRecorder
+from sign_spotter import SignSpotter
 from webcam_manager import WebcamManager
+from video_pipeline import OnlinePipeline
+
+
+# Report of the instrumentation written at the end of the online evaluation
+INSTRUMENTATION_REPORT = "instrumentation.json"
 
+# Matchings offered by the menu: every reference is compared, or some of them are skipped in one of these ways
+ALL_REFERENCES = "Compare every reference"
+PRUNED_SEARCH = "Lower bound pruned search"
+COARSE_TO_FINE = "Coarse-to-fine search"
+MATCHING_METHODS = [ALL_REFERENCES, PRUNED_SEARCH, "Descriptor prefilter", "Pivot table", "Prototypes", COARSE_TO_FINE]
 
-def online_evaluation(reference_signs: pd.DataFrame):
+
+def online_evaluation(
+    reference_signs: pd.DataFrame, engine="fastdtw", search_k=None, n_workers=None, pipelined=False,
+    incremental=False, continuous=False, prefilter_k=None, pivot_index=None, prototype_index=None,
+    resolution=None, multiresolution=None
+):
     # Object that stores mediapipe results and computes sign similarities
-    sign_recorder = SignRecorder(reference_signs)
+    # (the SignSpotter recognizes the signs continuously, without the record key)
+    if continuous:
+        sign_recorder = SignSpotter(reference_signs)
+    else:
+        sign_recorder = SignRecorder(
+            reference_signs, engine=engine, search_k=search_k, n_workers=n_workers, incremental=incremental,
+            prefilter_k=prefilter_k, pivot_index=pivot_index, prototype_index=prototype_index,
+            resolution=resolution, multiresolution=multiresolution
+        )
 
     # Object that draws keypoints & displays results
     webcam_manager = WebcamManager()
@@ -31,10 +68,15 @@ def online_evaluation(reference_signs: pd.DataFrame):
     with mediapipe.solutions.holistic.Holistic(
         min_detection_confidence=0.5, min_tracking_confidence=0.5
     ) as holistic:
-        while cap.isOpened():
+        if pipelined:
+            # Capture, inference & display in separate threads
+            OnlinePipeline(cap, holistic, sign_recorder, webcam_manager, show_stats=True).run()
+
+        while not pipelined and cap.isOpened():
 
             # Read feed
-            ret, frame = cap.read()
+            with INSTRUMENTATION.span("frame_read"):
+                ret, frame = cap.read()
 
             # Make detections
             image, results = mediapipe_detection(frame, holistic)
@@ -43,7 +85,10 @@ def online_evaluation(reference_signs: pd.DataFrame):
             sign_detected, is_recording = sign_recorder.process_results(results)
 
             # Update the frame (draw landmarks & display result)
-            webcam_manager.update(frame, results, sign_detected, is_recording)
+            overlay = INSTRUMENTATION.get_overlay() if INSTRUMENTATION.enabled else None
+            webcam_manager.update(
+                frame, results, sign_detected, is_recording, overlay, is_matching=sign_recorder.is_matching
+            )
 
             pressedKey = cv2.waitKey(1) & 0xFF
             if pressedKey == ord("r"):  # Record pressing r
@@ -53,9 +98,81 @@ def online_evaluation(reference_signs: pd.DataFrame):
 
         cap.release()
         cv2.destroyAllWindows()
+        sign_recorder.close()
+
+    if INSTRUMENTATION.enabled:
+        INSTRUMENTATION.save(INSTRUMENTATION_REPORT)
+        print(f"Latency of each stage saved in {INSTRUMENTATION_REPORT}")
+
+
+def cross_validate_signer(
+    training_set: pd.DataFrame, validation_set: pd.DataFrame, engine="fastdtw", search_k=None, n_workers=None,
+    prefilter_k=None, n_pivots=None, slack=SLACK, n_prototypes=None, coarse_resolution=None, within_distances=None
+):
+    """
+    Compare every video of the validation set to the training set
+    :param within_distances: array (n_train, n_train) of the distances between the videos of each sign
+                             of the training set used to select the prototypes (see within_sign_distances)
+    :return: The true & the predicted signs of the validation set
+    """
+    sign_pred = []
+    sign_true = []
+
+    signs_to_monitor = []
+
+    # Lower bounds of the training set used by the pruned search
+    envelopes = ReferenceEnvelopes(training_set) if search_k is not None else None
+
+    # Descriptors of the training set used to shortlist the references compared with DTW
+    descriptors = DescriptorIndex(training_set) if prefilter_k is not None else None
+
+    # Pivot table of the training set
+    pivot_index = None
+    if n_pivots:
+        pivot_index = PivotIndex.build(training_set, n_pivots=n_pivots, slack=slack, engine=engine)
+
+    # Prototypes of each sign of the training set
+    prototype_index = None
+    if n_prototypes:
+        prototype_index = PrototypeIndex.build(training_set, n_prototypes, within_distances, engine=engine)
+
+    # Coarse search of the training set at a reduced resolution, refined at full resolution
+    multiresolution = None
+    if coarse_resolution is not None:
+        multiresolution = MultiResolutionMatcher(training_set, coarse_resolution, engine=engine)
+
+    # Processes computing the distances to the training set in parallel
+    pool = DTWPool(training_set, n_workers=n_workers, engine=engine) if n_workers else None
+
+    #  Iterate over the validation set
+    for _, row in tqdm(validation_set.iterrows(), total=validation_set.shape[0]):
+        print_results = row['name'] in signs_to_monitor
+
+        # Compute distance
+        predicted_sign = evaluate(
+            row['sign_model'], training_set, print_results=print_results, engine=engine,
+            search_k=search_k, envelopes=envelopes, pool=pool, prefilter_k=prefilter_k, descriptors=descriptors,
+            pivot_index=pivot_index, prototype_index=prototype_index, multiresolution=multiresolution
+        )
 
+        if print_results:
+            print(f"Signer: {row['signer']}, Sign: {row['name']}, Video ID: {row['video_id']}")
+            print(f"Predicted sign: {predicted_sign}")
+            print("----------------------------------")
 
-def offline_evaluation(reference_signs: pd.DataFrame):
+        sign_pred.append(predicted_sign)
+        sign_true.append(row['name'])
+
+    if pool is not None:
+        pool.close()
+
+    return sign_true, sign_pred
+
+
+def offline_evaluation(
+    reference_signs: pd.DataFrame, engine="fastdtw", search_k=None, n_workers=None, prefilter_k=None,
+    n_pivots=None, slack=SLACK, n_prototypes=None, coarse_resolution=None
+):
     # Define cross validation variables
     signer_options = np.append(reference_signs["signer"].unique(), 'All')
 
@@ -69,50 +186,189 @@ def offline_evaluation(reference_signs: pd.DataFrame):
 
     print(f"Selected signers: {selected_signer}")
 
-    for signer in selected_signer:
-        training_set = reference_signs.loc[reference_signs["signer"] != signer]
-        validation_set = reference_signs.loc[reference_signs["signer"] == signer]
+    # The options selecting the matching are exclusive
+    matching = get_matching_method(
+        search_k, n_workers or None, prefilter_k, n_pivots or None, n_prototypes or None, coarse_resolution
+    )
+
+    # Compute the distances between all the reference signs once, each fold is then a slice of the matrix
+    distance_matrix = None
+    if questionary.confirm("Use the cached distance matrix?").ask():
+        distance_matrix = load_distance_matrix(reference_signs, engine=engine, n_workers=n_workers)
+        matching = "cached distance matrix"
 
-        sign_pred = []
-        sign_true = []
+    # The distances within each sign are computed once, the prototypes of each fold are selected from a slice
+    within_distances = None
+    if n_prototypes and distance_matrix is None:
+        within_distances = within_sign_distances(reference_signs, engine=engine)
 
-        signs_to_monitor = []
+    for signer in selected_signer:
+        training_idx = np.flatnonzero(reference_signs["signer"].values != signer)
+        training_set = reference_signs.iloc[training_idx]
+        validation_set = reference_signs.loc[reference_signs["signer"] == signer]
 
-        #  Iterate over the validation set
-        for _, row in tqdm(validation_set.iterrows(), total=validation_set.shape[0]):
-            print_results = row['name'] in signs_to_monitor
+        training_distances = None
+        if within_distances is not None:
+            training_distances = within_distances[np.ix_(training_idx, training_idx)]
 
-            # Compute distance
-            predicted_sign = evaluate(row['sign_model'], training_set, print_results=print_results)
+        startTime = time.time()
 
-            if print_results:
-                print(f"Signer: {row['signer']}, Sign: {row['name']}, Video ID: {row['video_id']}")
-                print(f"Predicted sign: {predicted_sign}")
-                print("----------------------------------")
+        if distance_matrix is not None:
+            sign_true, sign_pred = predict_from_distance_matrix(distance_matrix, reference_signs, signer)
+        else:
+            sign_true, sign_pred = cross_validate_signer(
+                training_set, validation_set, engine=engine, search_k=search_k, n_workers=n_workers,
+                prefilter_k=prefilter_k, n_pivots=n_pivots, slack=slack, n_prototypes=n_prototypes,
+                coarse_resolution=coarse_resolution, within_distances=training_distances
+            )
 
-            sign_pred.append(predicted_sign)
-            sign_true.append(row['name'])
+        endTime = time.time()
 
         questionary.print(f"\n\nFinished cross validation for signer: {signer}", style="bold")
         print(f"{len(training_set)} samples in the training set, {len(validation_set)} samples in the validation set")
+        print(
+            f"DTW engine: {engine}, matching: {matching}, "
+            f"{(endTime - startTime) / max(len(validation_set), 1):.4f} seconds per sample"
+        )
 
         compute_metrics(sign_true, sign_pred)
 
+    if distance_matrix is not None and questionary.confirm("Sweep batch_size and threshold?").ask():
+        accuracies = sweep_parameters(
+            distance_matrix, reference_signs, selected_signer,
+            batch_sizes=[1, 3, 5, 7, 9], thresholds=[0.3, 0.4, 0.5, 0.6, 0.7]
+        )
+        print(f"\nAccuracy per batch_size (rows) and threshold (columns):\n{accuracies.round(3)}\n")
+
+    if distance_matrix is not None and questionary.confirm("Measure the recall of the descriptor prefilter?").ask():
+        recall = shortlist_recall(distance_matrix, reference_signs, selected_signer, k_values=[1, 5, 10, 20, 50])
+        print(f"\nShortlist of the k closest descriptors (rows):\n{recall.round(3)}\n")
+
+    if distance_matrix is not None and questionary.confirm("Measure the misses of the pivot table?").ask():
+        misses = pivot_miss_rate(
+            distance_matrix, reference_signs, selected_signer, n_pivots=n_pivots or N_PIVOTS, engine=engine
+        )
+        print(f"\nNearest neighbours missed by the pivot table per slack of the lower bounds:\n{misses.round(3)}\n")
+
+    if distance_matrix is not None and questionary.confirm("Compare the condensation levels of the references?").ask():
+        report = condensation_report(distance_matrix, reference_signs, selected_signer, engine=engine)
+        print(f"\nAccuracy & latency per number of prototypes of each sign:\n{report.round(3)}\n")
+
     questionary.press_any_key_to_continue()
 
 
+def ask_number(message, default, minimum=0, number_type=int):
+    """
+    Ask a number (int or float), the answer is asked again until it is at least minimum
+    """
+    def validate(text):
+        try:
+            return number_type(text) >= minimum or f"The number must be at least {minimum}"
+        except ValueError:
+            return "Enter an integer" if number_type is int else "Enter a number"
+
+    return number_type(questionary.text(message, default=str(default), validate=validate).ask())
+
+
 if __name__ == "__main__":
     evaluation_mode = questionary.select(
-        "Select the evaluation mode", choices=["ONLINE", "OFFLINE"]
+        "Select the evaluation mode", choices=["ONLINE", "CONTINUOUS", "OFFLINE"]
     ).ask()
 
+    # The continuous mode spots the signs with its own matching: the options below don't apply to it
+    dtw_engine, search_k, prefilter_k, n_pivots, n_prototypes, n_workers = "fastdtw", None, None, None, None, None
+    resolution, multiresolution, slack = None, False, SLACK
+    if evaluation_mode != 'CONTINUOUS':
+        dtw_engine = questionary.select(
+            "Select the DTW engine", choices=DTW_ENGINES
+        ).ask()
+
+        # Only one way of skipping reference signs can be used by the matching (see get_matching_method)
+        matching = questionary.select(
+            "Select the matching",
+            choices=[method for method in MATCHING_METHODS if dtw_engine == "numpy" or method != PRUNED_SEARCH]
+        ).ask()
+
+        if matching == PRUNED_SEARCH:
+            # The pruned search computes the exact distance of the closest reference signs only
+            search_k = 1
+        elif matching == "Descriptor prefilter":
+            # Number of references shortlisted by their descriptors before the DTW
+            prefilter_k = ask_number("Number of references shortlisted by the descriptors", default=20, minimum=1)
+        elif matching == "Pivot table":
+            n_pivots = int(questionary.text("Number of pivots of the pivot table", default=str(N_PIVOTS)).ask())
+            # Divisor of the lower bounds: 1 prunes the most, a larger slack misses fewer nearest neighbours
+            slack = ask_number(
+                "Slack of the pivot lower bounds (1: LAESA bound)", default=SLACK, minimum=1, number_type=float
+            )
+        elif matching == "Prototypes":
+            # Number of prototypes of each sign compared first
+            n_prototypes = int(questionary.text("Number of prototypes per sign", default=str(N_PROTOTYPES)).ask())
+
+        # Temporal resolution of the embeddings (PAA), used for the coarse search only or for the whole matching
+        if matching == COARSE_TO_FINE:
+            target_len = ask_number("Number of frames of the coarse embeddings", default=10, minimum=1)
+        else:
+            target_len = ask_number("Number of frames of the embeddings (0: every frame)", default=0)
+        if target_len > 0:
+            resolution = Resolution(target_len=target_len)
+            multiresolution = matching == COARSE_TO_FINE
+
+        # Number of processes computing the DTW distances of every reference (1 computes them in the main process)
+        if matching in [ALL_REFERENCES, PRUNED_SEARCH]:
+            n_workers = int(questionary.text("Number of DTW processes", default="1").ask())
+            n_workers = n_workers if n_workers > 1 else None
+
     # Create dataset of the videos where landmarks have not been extracted yet
     videos = load_dataset()
 
     # Create a DataFrame of reference signs (name: str, model: SignModel, distance: int)
     reference_signs = load_reference_signs(videos)
 
-    if evaluation_mode == 'ONLINE':
-        online_evaluation(reference_signs)
+    # The references are downsampled once (and saved next to the reference index), the recorded signs
+    # when they are matched
+    if resolution is not None and not multiresolution:
+        reference_signs = load_downsampled_reference_signs(reference_signs, resolution)
+
+    # Spans & counters of each stage, drawn on the frames and saved at the end
+    if evaluation_mode in ['ONLINE', 'CONTINUOUS'] and questionary.confirm("Show the latency of each stage?").ask():
+        INSTRUMENTATION.enable()
+
+    if evaluation_mode == 'CONTINUOUS':
+        pipelined = questionary.confirm("Run the capture, inference and display in separate threads?").ask()
+        online_evaluation(reference_signs, pipelined=pipelined, continuous=True)
+    elif evaluation_mode == 'ONLINE':
+        pipelined = questionary.confirm("Run the capture, inference and display in separate threads?").ask()
+
+        # The incremental DTW computes the distances of the numpy engine during the recording
+        # (every reference at full resolution, without the DTW processes)
+        incremental = (
+            dtw_engine == "numpy" and matching == ALL_REFERENCES and resolution is None and n_workers is None
+        ) and questionary.confirm(
+            "Compute the distances during the recording (incremental DTW)?"
+        ).ask()
+        # The pivot table is saved next to the reference index and rebuilt when the reference signs change
+        pivot_index = None
+        if n_pivots:
+            pivot_index = load_pivot_index(reference_signs, n_pivots=n_pivots, slack=slack, engine=dtw_engine)
+        # The prototypes too
+        prototype_index = None
+        if n_prototypes:
+            prototype_index = load_prototype_index(reference_signs, n_prototypes=n_prototypes, engine=dtw_engine)
+
+        # Coarse search at the reduced resolution, or whole matching at this resolution
+        matcher = None
+        if multiresolution:
+            matcher, resolution = MultiResolutionMatcher(reference_signs, resolution, engine=dtw_engine), None
+        online_evaluation(
+            reference_signs, engine=dtw_engine, search_k=search_k, n_workers=n_workers, pipelined=pipelined,
+            incremental=incremental, prefilter_k=prefilter_k, pivot_index=pivot_index, prototype_index=prototype_index,
+            resolution=resolution, multiresolution=matcher
+        )
     elif evaluation_mode == 'OFFLINE':
-        offline_evaluation(reference_signs)
+        # The validation videos are taken from the (already downsampled) reference signs
+        offline_evaluation(
+            reference_signs, engine=dtw_engine, search_k=search_k, n_workers=n_workers, prefilter_k=prefilter_k,
+            n_pivots=n_pivots, slack=slack, n_prototypes=n_prototypes,
+            coarse_resolution=resolution if multiresolution else None
+        )
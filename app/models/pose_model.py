@@ -1,76 +1,86 @@
 import numpy as np
 
 
-class PoseModel(object):
-    def __init__(self, landmarks):
+# Ids of the pose landmarks used to compute the arm embeddings
+POSE_LANDMARKS = {
+    "left_shoulder": 11,
+    "right_shoulder": 12,
+    "left_elbow": 13,
+    "right_elbow": 14,
+    "left_wrist": 15,
+    "right_wrist": 16,
+    "left_hip": 23,
+    "right_hip": 24,
+}
+
 
-        self.landmarks = {
-            "left_shoulder": landmarks[11],
-            "right_shoulder": landmarks[12],
-            "left_elbow": landmarks[13],
-            "right_elbow": landmarks[14],
-            "left_wrist": landmarks[15],
-            "right_wrist": landmarks[16],
-            "left_hip": landmarks[23],
-            "right_hip": landmarks[24],
-        }
+class PoseModel(object):
 
-        self.tracked_joints = [
-            # 12, 11, 13
-            ["right_shoulder", "left_shoulder", "left_elbow"],
+    tracked_joints = [
+        # 12, 11, 13
+        ["right_shoulder", "left_shoulder", "left_elbow"],
 
-            # 11, 13, 15
-            ["left_shoulder", "left_elbow", "left_wrist"],
+        # 11, 13, 15
+        ["left_shoulder", "left_elbow", "left_wrist"],
 
-            # 13, 11, 23
-            ["left_elbow", "left_shoulder", "left_hip"],
+        # 13, 11, 23
+        ["left_elbow", "left_shoulder", "left_hip"],
 
-            # 11, 12, 14
-            ["left_shoulder", "right_shoulder", "right_elbow"],
+        # 11, 12, 14
+        ["left_shoulder", "right_shoulder", "right_elbow"],
 
-            # 12, 14, 16
-            ["right_shoulder", "right_elbow", "right_wrist"],
+        # 12, 14, 16
+        ["right_shoulder", "right_elbow", "right_wrist"],
 
-            # 14, 12, 24
-            ["right_elbow", "right_shoulder", "right_hip"],
-        ]
+        # 14, 12, 24
+        ["right_elbow", "right_shoulder", "right_hip"],
+    ]
 
-        computed_angles = []
+    # Array of shape (nb_joints, 3) containing the landmark ids of each tracked joint
+    joint_ids = np.array([[POSE_LANDMARKS[name] for name in joint] for joint in tracked_joints])
 
-        for angle in self.tracked_joints:
-            vector_a = self.landmarks[angle[0]] - self.landmarks[angle[1]]
-            vector_b = self.landmarks[angle[2]] - self.landmarks[angle[1]]
+    def __init__(self, landmarks):
 
-            angle_result = self._get_angle_between_vectors(vector_a, vector_b)
+        self.landmarks = {name: landmarks[idx] for name, idx in POSE_LANDMARKS.items()}
 
-            # If the angle is not NaN we store it else we store 0
-            if angle_result == angle_result:
-                computed_angles.append(angle_result)
-            else:
-                computed_angles.append(0)
+        computed_angles = list(self.get_angles(np.asarray(landmarks, dtype=float)[np.newaxis])[0])
 
         self.left_arm_embedding = computed_angles[0:3]
         self.right_arm_embedding = computed_angles[3:6]
 
+    @classmethod
+    def get_angles(cls, landmarks: np.ndarray) -> np.ndarray:
+        """
+        Batched computation of the tracked joint angles
+        Args
+            landmarks: array of shape (n_frame, 33, 3)
+        Return
+            Array of shape (n_frame, nb_joints): the first 3 columns are the left arm
+            embedding, the last 3 the right arm embedding (NaN angles are replaced by 0)
+        """
+        vector_a = landmarks[:, cls.joint_ids[:, 0]] - landmarks[:, cls.joint_ids[:, 1]]
+        vector_b = landmarks[:, cls.joint_ids[:, 2]] - landmarks[:, cls.joint_ids[:, 1]]
+
+        return cls._get_angles_between_vectors(vector_a, vector_b)
+
     @staticmethod
     def _unit_vector(vector: np.ndarray) -> np.ndarray:
-        """ Returns the unit vector of the vector.  """
-        return vector / np.linalg.norm(vector)
+        """ Returns the unit vectors of the vectors (along the last axis).  """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return vector / np.linalg.norm(vector, axis=-1, keepdims=True)
 
     @staticmethod
-    def _get_angle_between_vectors(u: np.ndarray, v: np.ndarray) -> float:
+    def _get_angles_between_vectors(u: np.ndarray, v: np.ndarray) -> np.ndarray:
         """
         Args
-            u, v: 3D vectors representing two connections
+            u, v: arrays of shape (..., 3) of 3D vectors representing two connections
         Return
-            Angle between the two vectors
+            Angles between the two vectors, 0 if they are equal or if the angle is NaN
         """
-        if np.array_equal(u, v):
-            return 0
-
         v1_u = PoseModel._unit_vector(u)
         v1_v = PoseModel._unit_vector(v)
 
-        angle = np.arccos(np.clip(np.dot(v1_u, v1_v), -1.0, 1.0))
+        angles = np.arccos(np.clip(np.einsum("...i,...i->...", v1_u, v1_v), -1.0, 1.0))
 
-        return angle
+        angles[np.all(u == v, axis=-1)] = 0
+        return np.nan_to_num(angles, nan=0.0)
@@ -1,12 +1,46 @@
-from typing import List, Literal
+import hashlib
+import json
+from typing import List
 
 import numpy as np
 
 from models.pose_model import PoseModel
 from models.hand_model import HandModel
+from utils.instrumentation import INSTRUMENTATION
+
+
+def get_embedding_version() -> str:
+    """
+    Identifier of the embedding code: it changes whenever the tracked joints are modified,
+    which invalidates the embeddings computed with the previous definition
+    """
+    joints = json.dumps([HandModel.tracked_joints, PoseModel.tracked_joints])
+    return hashlib.sha1(joints.encode("utf-8")).hexdigest()[:16]
+
+
+EMBEDDING_VERSION = get_embedding_version()
+
+
+# Type of the embeddings: the angles don't need more precision and the DTW reads half the memory
+EMBEDDING_DTYPE = np.float32
+
+# Attributes of SignModel holding an embedding
+EMBEDDING_NAMES = ("lh_embedding", "rh_embedding", "left_pose_embedding", "right_pose_embedding")
 
 
 class SignModel(object):
+    """
+    Embeddings of a sign, stored as contiguous EMBEDDING_DTYPE arrays so that the distance code
+    (numpy DTW, lower bounds, packed reference index) can use them without conversion
+
+    Args
+        has_x_hand: bool; True if x hand is detected in the video, otherwise False
+        xh_embedding: ndarray; Array of shape (n_hand_frame, nb_joints) of the angles of the hand
+        x_pose_embedding: ndarray; Array of shape (n_frame, 3) of the angles of the arm
+    """
+
+    __slots__ = ("has_left_hand", "has_right_hand") + EMBEDDING_NAMES
+
     def __init__(
         self, pose_list: List[List[float]], left_hand_list: List[List[float]], right_hand_list: List[List[float]]
     ):
@@ -14,23 +48,48 @@ class SignModel(object):
         Params
             x_hand_list: List of all landmarks for each frame of a video
             pose_list: List of all landmarks for each frame of a video
-        Args
-            has_x_hand: bool; True if x hand is detected in the video, otherwise False
-            xh_embedding: ndarray; Array of shape (n_frame, nb_connections * nb_connections)
-            x_pose_embedding: ndarray; Array of shape (n_frame, nb_connections * nb_connections)
         """
-        self.has_left_hand = np.sum(left_hand_list) != 0
-        self.has_right_hand = np.sum(right_hand_list) != 0
+        with INSTRUMENTATION.span("embedding"):
+            self.has_left_hand = bool(np.sum(left_hand_list) != 0)
+            self.has_right_hand = bool(np.sum(right_hand_list) != 0)
 
-        self.left_pose_embedding = self._get_embedding_from_pose_landmark_list(pose_list, 'left')
-        self.right_pose_embedding = self._get_embedding_from_pose_landmark_list(pose_list, 'right')
-        self.lh_embedding = self._get_embedding_from_hand_landmark_list(left_hand_list)
-        self.rh_embedding = self._get_embedding_from_hand_landmark_list(right_hand_list)
+            pose_embedding = self._get_embedding_from_pose_landmark_list(pose_list)
+            self.left_pose_embedding = _compact(pose_embedding[:, 0:3])
+            self.right_pose_embedding = _compact(pose_embedding[:, 3:6])
+            self.lh_embedding = _compact(self._get_embedding_from_hand_landmark_list(left_hand_list))
+            self.rh_embedding = _compact(self._get_embedding_from_hand_landmark_list(right_hand_list))
+
+    @classmethod
+    def from_embeddings(
+        cls, lh_embedding, rh_embedding, left_pose_embedding, right_pose_embedding, has_left_hand, has_right_hand
+    ):
+        """
+        Create a SignModel from already computed embeddings (without the landmarks).
+        The contiguous EMBEDDING_DTYPE arrays (e.g. views of the reference index) are used as is
+        """
+        sign_model = cls.__new__(cls)
+        sign_model.has_left_hand = bool(has_left_hand)
+        sign_model.has_right_hand = bool(has_right_hand)
+        sign_model.left_pose_embedding = _compact(left_pose_embedding)
+        sign_model.right_pose_embedding = _compact(right_pose_embedding)
+        sign_model.lh_embedding = _compact(lh_embedding)
+        sign_model.rh_embedding = _compact(rh_embedding)
+        return sign_model
+
+    @property
+    def n_frames(self) -> int:
+        """Number of frames where the pose is detected"""
+        return len(self.left_pose_embedding)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the embeddings in bytes"""
+        return sum(getattr(self, name).nbytes for name in EMBEDDING_NAMES)
 
     @staticmethod
     def _get_embedding_from_hand_landmark_list(
         hand_list: List[List[float]],
-    ) -> List[List[float]]:
+    ) -> np.ndarray:
         """
         Params
             hand_list: List of all landmarks for each frame of a video
@@ -38,30 +97,32 @@ class SignModel(object):
             Array of shape (n_frame, nb_connections * nb_connections) containing
             the feature_vectors of the hand for each frame
         """
-        embedding = []
-        for frame_idx in range(len(hand_list)):
-            if np.sum(hand_list[frame_idx]) == 0:
-                continue
-
-            hand_gesture = HandModel(hand_list[frame_idx])
-            embedding.append(hand_gesture.feature_vector)
-        return embedding
-    
+        hand_array = np.asarray(hand_list, dtype=float).reshape(-1, 21, 3)
+
+        # Skip the frames where the hand is not detected
+        hand_array = hand_array[hand_array.sum(axis=(1, 2)) != 0]
+
+        return HandModel.get_feature_vectors(hand_array)
+
     @staticmethod
     def _get_embedding_from_pose_landmark_list(
         pose_list: List[List[float]],
-        side: Literal['left', 'right']
-    ) -> List[List[float]]:
-        embedding = []
-        for frame_idx in range(len(pose_list)):
-            if np.sum(pose_list[frame_idx]) == 0:
-                continue
+    ) -> np.ndarray:
+        """
+        Params
+            pose_list: List of all landmarks for each frame of a video
+        Return
+            Array of shape (n_frame, 6) containing the left arm angles (first 3 columns)
+            and the right arm angles (last 3 columns) for each frame
+        """
+        pose_array = np.asarray(pose_list, dtype=float).reshape(-1, 33, 3)
+
+        # Skip the frames where the pose is not detected
+        pose_array = pose_array[pose_array.sum(axis=(1, 2)) != 0]
 
-            pose_gesture = PoseModel(pose_list[frame_idx])
+        return PoseModel.get_angles(pose_array)
 
-            if side == 'left':
-                embedding.append(pose_gesture.left_arm_embedding)
-            else:
-                embedding.append(pose_gesture.right_arm_embedding)
 
-        return embedding
+def _compact(embedding) -> np.ndarray:
+    # Only copies the embeddings which are not already contiguous EMBEDDING_DTYPE arrays
+    return np.ascontiguousarray(embedding, dtype=EMBEDDING_DTYPE)
@@ -1,48 +1,206 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 
-from idk_name import compute_distances, get_sign_predicted
+from idk_name import compute_distances, get_matching_method, get_sign_predicted
+from utils.descriptor_filter import DescriptorIndex
+from utils.dtw_pool import DTWPool
+from utils.dtw_search import ReferenceEnvelopes
+from utils.incremental_dtw import IncrementalDTW
+from utils.landmark_buffer import LandmarkBuffer
+from utils.landmark_utils import LEFT_HAND_LANDMARKS, POSE_LANDMARKS, RIGHT_HAND_LANDMARKS
 
 
 class SignRecorder(object):
-    def __init__(self, reference_signs: pd.DataFrame, seq_len=50):
+    """
+    Records seq_len frames and matches them with the reference signs in a background thread,
+    so that the webcam keeps running while the distances are computed
+
+    Params
+        executor: concurrent.futures executor running the matching (a single thread by default, it must run
+                  its jobs in order when incremental is set)
+        incremental: advance the DTW of every reference at each recorded frame (IncrementalDTW), in the
+                     background, instead of matching the whole recording at the end
+        prefilter_k: number of references shortlisted by their descriptors before the DTW (None disables it)
+        pivot_index: PivotIndex of the reference signs used to search the closest ones (see load_pivot_index)
+        prototype_index: PrototypeIndex of the reference signs, compared first (see load_prototype_index)
+        resolution: Resolution the reference signs were downsampled to, applied to the recordings
+        multiresolution: MultiResolutionMatcher of the reference signs (coarse search, then refinement)
+    """
+
+    def __init__(
+        self, reference_signs: pd.DataFrame, seq_len=50, engine="fastdtw", search_k=None, n_workers=None,
+        executor=None, incremental=False, prefilter_k=None, pivot_index=None, prototype_index=None,
+        resolution=None, multiresolution=None
+    ):
+        # The options selecting the matching are exclusive
+        matching = get_matching_method(
+            search_k, n_workers or None, prefilter_k, pivot_index, prototype_index, multiresolution, incremental
+        )
+        print(f"*** Matching: {matching}")
+
         # Variables for recording
         self.is_recording = False
         self.seq_len = seq_len
 
-        # List of results stored each frame
-        self.recorded_results = []
+        # DTW engine used to compare the recorded sign with the reference signs
+        self.engine = engine
+
+        # Number of closest reference signs kept by the pruned search (None computes every distance)
+        self.search_k = search_k
+        self.envelopes = ReferenceEnvelopes(reference_signs) if search_k is not None else None
+
+        # Descriptors of the reference signs used to shortlist the references compared with DTW
+        self.prefilter_k = prefilter_k
+        self.descriptors = DescriptorIndex(reference_signs) if prefilter_k is not None else None
+
+        # Pivot table pruning the references (None compares all of them)
+        self.pivot_index = pivot_index
+
+        # Prototypes of each sign compared before the other videos (None compares all of them)
+        self.prototype_index = prototype_index
+
+        # Temporal resolution of the recordings (None keeps every frame) & coarse-to-fine search
+        self.resolution = resolution
+        self.multiresolution = multiresolution
+
+        # Pool of processes computing the distances in parallel (None computes them in this process)
+        self.pool = DTWPool(reference_signs, n_workers=n_workers, engine=engine) if n_workers else None
+
+        # Matcher updated at each recorded frame by the matching thread (None matches the recording once
+        # it is complete)
+        self.matcher = IncrementalDTW(reference_signs) if incremental else None
+
+        # Background matching: the future of the last recording, its generation & its duration
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.owns_executor = executor is None
+        self.future = None
+        self.generation = 0
+        self.matching_start = None
+        self.matching_time = None
+
+        # Landmarks converted at each frame. The buffer of a recording is handed to its matching job
+        # and the next recording uses the other one (a superseded job may read a buffer reused
+        # by a later recording, its result is ignored anyway)
+        self.buffers = [LandmarkBuffer(seq_len), LandmarkBuffer(seq_len)]
+        self.buffer = self.buffers[0]
 
         # DataFrame storing the distances between the recorded sign & all the reference signs from the dataset
         self.reference_signs = reference_signs
 
+    @property
+    def is_matching(self) -> bool:
+        return self.future is not None
+
+    def close(self):
+        """
+        Stop the matching thread & the processes computing the distances
+        """
+        self._cancel_matching()
+        if self.owns_executor:
+            self.executor.shutdown(wait=True)
+        if self.pool is not None:
+            self.pool.close()
+
     def record(self):
         """
-        Initialize sign_distances & start recording
+        Initialize sign_distances & start recording (a match still running is superseded)
         """
-        self.reference_signs["distance"].values[:] = 0
+        self._cancel_matching()
+        self.reference_signs["distance"] = 0
+        self.buffer.clear()
+        if self.matcher is not None:
+            # The updates of a superseded recording still queued are skipped before the reset
+            self.executor.submit(self.matcher.reset)
         self.is_recording = True
 
     def process_results(self, results) -> (str, bool):
         """
         If the SignRecorder is in the recording state:
-            it stores the landmarks during seq_len frames and then computes the sign distances
+            it stores the landmarks during seq_len frames and then starts computing the sign distances
+            in the background
         :param results: mediapipe output
-        :return: Return the word predicted (blank text if there is no distances)
-                & the recording state
+        :return: Return the word predicted (blank text if there is no distances or if the matching
+                 is still running) & the recording state
         """
         if self.is_recording:
-            if len(self.recorded_results) < self.seq_len:
-                self.recorded_results.append(results)
+            if len(self.buffer) < self.seq_len:
+                self.buffer.append(results)
+                if self.matcher is not None:
+                    self.executor.submit(self._update_matcher, self.generation, self.buffer.get_last().copy())
             else:
-                self.reference_signs = compute_distances(
-                    self.recorded_results, self.reference_signs)
-                print(self.reference_signs)
+                if self.matcher is not None:
+                    self._start_incremental_matching()
+                else:
+                    self._start_matching()
 
                 # Reset the recording variables
                 self.is_recording = False
-                self.recorded_results = []
 
-        if np.sum(self.reference_signs["distance"].values) == 0:
+        if self.future is not None and self.future.done():
+            self._finish_matching()
+
+        if self.is_matching or np.sum(self.reference_signs["distance"].values) == 0:
             return "", self.is_recording
-        return get_sign_predicted(batch_size=1), self.is_recording
+        return get_sign_predicted(self.reference_signs, batch_size=1), self.is_recording
+
+    def _start_matching(self):
+        self.generation += 1
+        self.matching_start = time.perf_counter()
+
+        # The job works on its own copy of the DataFrame, which is only swapped in when it is done
+        self.future = self.executor.submit(
+            self._match, self.generation, self.buffer.get_landmarks(), self.reference_signs.copy()
+        )
+        self.buffer = self.buffers[1] if self.buffer is self.buffers[0] else self.buffers[0]
+
+    def _match(self, generation, landmarks, reference_signs):
+        if generation != self.generation:
+            # A new recording started before this job
+            return None
+        return compute_distances(
+            landmarks, reference_signs, engine=self.engine,
+            search_k=self.search_k, envelopes=self.envelopes, pool=self.pool,
+            prefilter_k=self.prefilter_k, descriptors=self.descriptors, pivot_index=self.pivot_index,
+            prototype_index=self.prototype_index, resolution=self.resolution,
+            multiresolution=self.multiresolution)
+
+    def _finish_matching(self):
+        future, self.future = self.future, None
+        try:
+            reference_signs = future.result()
+        except Exception as error:
+            # A failed match is reported but doesn't stop the webcam loop
+            print(f"*** The matching of the sign failed: {error!r}")
+            return
+        if reference_signs is None:
+            return
+
+        self.matching_time = time.perf_counter() - self.matching_start
+        self.reference_signs = reference_signs
+        print(self.reference_signs)
+        print(f"*** Time to match the sign: {self.matching_time:.3f} seconds")
+
+    def _update_matcher(self, generation, frame):
+        if generation != self.generation:
+            return
+        self.matcher.update(frame[POSE_LANDMARKS], frame[LEFT_HAND_LANDMARKS], frame[RIGHT_HAND_LANDMARKS])
+
+    def _start_incremental_matching(self):
+        # Queued after the updates of the recording (same generation), so the distances include all its frames
+        self.matching_start = time.perf_counter()
+        self.future = self.executor.submit(self._match_incremental, self.generation, self.reference_signs.copy())
+
+    def _match_incremental(self, generation, reference_signs):
+        if generation != self.generation:
+            return None
+        return self.matcher.dtw_distances(reference_signs)
+
+    def _cancel_matching(self):
+        # A job that already started can't be interrupted: its result is ignored
+        self.generation += 1
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
@@ -0,0 +1,210 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from models.sign_model import SignModel
+from utils.dtw import pad_embeddings
+from utils.dtw_search import LEFT_CHANNELS, RIGHT_CHANNELS
+from utils.landmark_buffer import LandmarkBuffer
+from utils.landmark_utils import LEFT_HAND_LANDMARKS, POSE_LANDMARKS, RIGHT_HAND_LANDMARKS
+from utils.subsequence_dtw import lb_subsequence, subsequence_dtw
+
+
+# Number of frames of the rolling landmark buffer
+SPOTTING_WINDOW = 90
+
+# Number of frames between two scorings of the buffer
+SPOTTING_STRIDE = 5
+
+# Minimum number of frames in the buffer before the first scoring
+SPOTTING_MIN_FRAMES = 15
+
+# Maximum time (in seconds) spent scoring the references at each scoring
+SPOTTING_TIME_BUDGET = 0.03
+
+# A sign is detected when its distance (averaged over the frames of the reference) is below the threshold
+SPOTTING_THRESHOLD = 4.0
+
+# Maximum number of references scored at once
+SPOTTING_CHUNK_SIZE = 64
+
+# Number of references of the first chunk, before the cost of a chunk has been measured
+SPOTTING_PROBE_SIZE = 4
+
+# The size of the chunks is adapted so that a chunk lasts this fraction of the time budget
+SPOTTING_CHUNK_FRACTION = 0.25
+
+
+class SignSpotter(object):
+    """
+    Recognizes the signs in the live stream without the record key: the landmarks of the last
+    window frames are kept in a rolling buffer, and every stride frames the buffer is compared to
+    the reference signs with an open-begin & open-end DTW (the reference can match any part of the buffer).
+    The references are scored in increasing order of their lower bound, in chunks sized from the measured
+    cost of a reference so that the time budget isn't exceeded, and the buffer is flushed after each detection.
+    Same interface as the SignRecorder (process_results, record, close)
+
+    Params
+        threshold: distance (per frame of the reference) below which a sign is detected
+        time_budget: maximum time in seconds spent on a scoring, the references left are skipped
+        metric: local distance, one of LOCAL_DISTANCES
+    Args
+        stats: number of references skipped (hands, lower bound, time budget) and scored at the last scoring
+    """
+
+    def __init__(
+        self,
+        reference_signs: pd.DataFrame,
+        window=SPOTTING_WINDOW,
+        stride=SPOTTING_STRIDE,
+        min_frames=SPOTTING_MIN_FRAMES,
+        threshold=SPOTTING_THRESHOLD,
+        time_budget=SPOTTING_TIME_BUDGET,
+        metric="manhattan",
+    ):
+        self.stride = stride
+        self.min_frames = min_frames
+        self.threshold = threshold
+        self.time_budget = time_budget
+        self.metric = metric
+
+        self.names = reference_signs["name"].values
+        sign_models = reference_signs["sign_model"].values
+        has_left_hand = np.array([sign_model.has_left_hand for sign_model in sign_models], dtype=bool)
+        has_right_hand = np.array([sign_model.has_right_hand for sign_model in sign_models], dtype=bool)
+
+        # The buffer is only compared with the references with the same hands: the positions & the embeddings
+        # (of the channels of these hands, padded to the longest one) of the references of each hand configuration
+        self.groups = {}
+        for hands in set(zip(has_left_hand, has_right_hand)):
+            positions = np.flatnonzero((has_left_hand == hands[0]) & (has_right_hand == hands[1]))
+            templates, lengths = {}, {}
+            for channel in (LEFT_CHANNELS if hands[0] else []) + (RIGHT_CHANNELS if hands[1] else []):
+                templates[channel], lengths[channel] = pad_embeddings(
+                    [getattr(sign_model, channel) for sign_model in sign_models[positions]]
+                )
+            self.groups[hands] = (positions, templates, lengths)
+
+        # Landmarks of the last frames
+        self.buffer = LandmarkBuffer(window)
+        self.frames_since_scoring = 0
+
+        # Number of references of the next chunk, and duration (in seconds), number of references & number of
+        # buffer frames of the last chunk scored (None until the first one)
+        self.chunk_size = SPOTTING_PROBE_SIZE
+        self.last_chunk = None
+
+        self.sign_detected = ""
+        self.is_matching = False
+        self.stats = {}
+
+    def close(self):
+        pass
+
+    def record(self):
+        """
+        Flush the buffer & forget the last detection
+        """
+        self.buffer.clear()
+        self.frames_since_scoring = 0
+        self.sign_detected = ""
+
+    def process_results(self, results) -> (str, bool):
+        """
+        Add the landmarks of the frame to the buffer and score the buffer every stride frames
+        :param results: mediapipe output
+        :return: Return the last sign detected & whether a hand is visible in the buffer
+        """
+        self.buffer.append(results)
+        self.frames_since_scoring += 1
+
+        if len(self.buffer) >= self.min_frames and self.frames_since_scoring >= self.stride:
+            self.frames_since_scoring = 0
+            sign_detected = self.spot()
+            if sign_detected is not None:
+                self.sign_detected = sign_detected
+                # The frames of the detected sign can't be part of the next one
+                self.buffer.clear()
+
+        return self.sign_detected, self.buffer.has_hands()
+
+    def spot(self):
+        """
+        Compare the buffer with the reference signs
+
+        :return: The name of the closest reference sign if its distance is below the threshold, None otherwise
+        """
+        start = time.perf_counter()
+        landmarks = self.buffer.get_landmarks()
+        buffer_sign = SignModel(
+            landmarks[:, POSE_LANDMARKS], landmarks[:, LEFT_HAND_LANDMARKS], landmarks[:, RIGHT_HAND_LANDMARKS]
+        )
+
+        self.stats = {"references": len(self.names), "hand_mismatch": 0, "lower_bound": 0, "time_budget": 0, "dtw": 0}
+        if not (buffer_sign.has_left_hand or buffer_sign.has_right_hand):
+            # Nobody is signing
+            return None
+
+        channels = (LEFT_CHANNELS if buffer_sign.has_left_hand else []) + (
+            RIGHT_CHANNELS if buffer_sign.has_right_hand else []
+        )
+        hands = (buffer_sign.has_left_hand, buffer_sign.has_right_hand)
+        if hands not in self.groups:
+            self.stats["hand_mismatch"] = len(self.names)
+            return None
+        positions, templates, lengths = self.groups[hands]
+        self.stats["hand_mismatch"] = len(self.names) - len(positions)
+
+        # Lower bound of the distances, the references that can't be detected are discarded
+        bounds = sum(
+            lb_subsequence(templates[channel], lengths[channel], getattr(buffer_sign, channel), self.metric)
+            / np.maximum(lengths[channel], 1)
+            for channel in channels
+        )
+        candidates = np.argsort(bounds, kind="stable")
+        candidates = candidates[bounds[candidates] <= self.threshold]
+        self.stats["lower_bound"] = len(positions) - len(candidates)
+        bounds = bounds[candidates]
+
+        best_distance, best_idx = np.inf, None
+        chunk_start = 0
+        while chunk_start < len(candidates):
+            if bounds[chunk_start] > best_distance:
+                # The next references can't be closer than the best one
+                break
+
+            # The next chunk is only scored if it can end within the time budget. Its cost grows with the number
+            # of buffer frames, and less than its number of references (the template frames are advanced together):
+            # it costs at most as much as the last chunk if it is smaller, at most proportionally more otherwise
+            expected_time = 0
+            if self.last_chunk is not None:
+                chunk_time, chunk_references, chunk_frames = self.last_chunk
+                expected_time = chunk_time * len(landmarks) / chunk_frames * max(1, self.chunk_size / chunk_references)
+            if time.perf_counter() - start + expected_time > self.time_budget:
+                self.stats["time_budget"] = len(candidates) - chunk_start
+                break
+
+            chunk = candidates[chunk_start:chunk_start + self.chunk_size]
+            chunk_timer = time.perf_counter()
+            distances = sum(
+                subsequence_dtw(
+                    templates[channel][chunk], lengths[channel][chunk],
+                    getattr(buffer_sign, channel), self.metric
+                ) / np.maximum(lengths[channel][chunk], 1)
+                for channel in channels
+            )
+            chunk_time = time.perf_counter() - chunk_timer
+            self.last_chunk = (chunk_time, len(chunk), len(landmarks))
+            self.chunk_size = int(np.clip(
+                len(chunk) * self.time_budget * SPOTTING_CHUNK_FRACTION / max(chunk_time, 1e-6), 1, SPOTTING_CHUNK_SIZE
+            ))
+            self.stats["dtw"] += len(chunk)
+            chunk_start += len(chunk)
+
+            if distances.min() < best_distance:
+                best_distance, best_idx = distances.min(), positions[chunk[np.argmin(distances)]]
+
+        if best_idx is None or best_distance > self.threshold:
+            return None
+        return self.names[best_idx]
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+
+from utils.dtw import LOCAL_DISTANCES, dtw_step, pad_embeddings
+from utils.dtw_search import LEFT_CHANNELS, RIGHT_CHANNELS
+
+
+# Maximum number of cells of the local cost arrays computed at once (memory bound of batch_dtw)
+MAX_BATCH_CELLS = 2 ** 20
+
+
+def batch_dtw(
+    queries: np.ndarray, query_lengths: np.ndarray, references: np.ndarray, reference_lengths: np.ndarray,
+    metric="manhattan"
+) -> np.ndarray:
+    """
+    Unconstrained DTW between every query & every reference, the cumulative cost matrices of all
+    the pairs being filled together, one query frame at a time
+
+    :param queries: array (n_queries, max_len, n_features) of embeddings padded with zeros (see pad_embeddings)
+    :param references: array (n_refs, max_len, n_features) of embeddings padded with zeros
+    :param query_lengths, reference_lengths: int arrays of the lengths of the embeddings
+    :param metric: local distance, one of LOCAL_DISTANCES
+    :return: array (n_queries, n_refs) of the distances, infinity if an embedding is empty
+    """
+    if metric not in LOCAL_DISTANCES:
+        raise ValueError(f"Unknown local distance: {metric}, expected one of {LOCAL_DISTANCES}")
+
+    n_queries, n_refs = len(queries), len(references)
+    distances = np.full((n_queries, n_refs), np.inf)
+    if n_queries == 0 or n_refs == 0:
+        return distances
+
+    # The longest queries first, so that the queries still running are always the first ones
+    # (the fancy indexing copies the queries once)
+    query_order = np.argsort(-query_lengths, kind="stable")
+    queries, query_lengths = queries[query_order], query_lengths[query_order]
+
+    # The references are grouped by length so that each chunk is only padded to its longest reference,
+    # and chunked so that the cost arrays stay small
+    reference_order = np.argsort(reference_lengths, kind="stable")
+    start = 0
+    while start < n_refs:
+        width = max(reference_lengths[reference_order[start:]].max(), 1)
+        chunk_size = max(1, MAX_BATCH_CELLS // (n_queries * width))
+        chunk = reference_order[start:start + chunk_size]
+        start += len(chunk)
+
+        chunk_lengths = reference_lengths[chunk]
+        width = chunk_lengths.max()
+        if width == 0:
+            continue
+        # Features first, so that the local costs are accumulated one feature at a time
+        chunk_refs = np.ascontiguousarray(references[chunk, :width].transpose(2, 0, 1))
+        cost = np.empty((n_queries, len(chunk), width))
+        buffer = np.empty_like(cost)
+
+        # Last row of the cumulative cost matrix of each pair, prefixed by the cell preceding (0, 0)
+        rows = np.full((n_queries, len(chunk), width + 1), np.inf)
+        rows[:, :, 0] = 0
+        for i in range(queries.shape[1]):
+            n_active = np.count_nonzero(query_lengths > i)
+            if n_active == 0:
+                break
+
+            _frame_costs(queries[:n_active, i], chunk_refs, metric, cost[:n_active], buffer[:n_active])
+            rows[:n_active, :, 1:] = dtw_step(rows[:n_active], cost[:n_active])
+            rows[:n_active, :, 0] = np.inf
+
+            # Read the distances of the queries whose last frame was just added
+            for q in np.flatnonzero(query_lengths[:n_active] == i + 1):
+                distances[query_order[q], chunk] = rows[q, np.arange(len(chunk)), chunk_lengths]
+
+    distances[:, reference_lengths == 0] = np.inf
+    return distances
+
+
+def _frame_costs(frames: np.ndarray, references: np.ndarray, metric: str, out: np.ndarray, buffer: np.ndarray):
+    """
+    Local distances between each frame (n_frames, n_features) & each frame of the references
+    (n_features, n_refs, max_len), written in out (n_frames, n_refs, max_len). Summing over the features
+    one at a time avoids the (n_frames, n_refs, max_len, n_features) array of the differences
+    """
+    out.fill(0)
+    for feature in range(len(references)):
+        np.subtract(frames[:, feature, np.newaxis, np.newaxis], references[feature], out=buffer)
+        if metric == "manhattan":
+            np.abs(buffer, out=buffer)
+        else:
+            np.square(buffer, out=buffer)
+        out += buffer
+    if metric == "euclidean":
+        np.sqrt(out, out=out)
+
+
+class BatchMatcher(object):
+    """
+    Distances between several recorded signs & the reference signs computed in a single vectorized pass:
+    the same distances as sign_distance with the numpy engine (without window)
+
+    Params
+        reference_signs: pd.DataFrame with a sign_model column
+        metric: local distance, one of LOCAL_DISTANCES
+    """
+
+    def __init__(self, reference_signs: pd.DataFrame, metric="manhattan"):
+        self.metric = metric
+        self.n_refs = len(reference_signs)
+
+        # The references are grouped by hands (the distance to the signs using other hands is infinite),
+        # each group stores the positions of its references & their padded embeddings
+        sign_models = list(reference_signs["sign_model"])
+        hands = [(bool(sign_model.has_left_hand), bool(sign_model.has_right_hand)) for sign_model in sign_models]
+        self.groups = {}
+        for group_hands in set(hands):
+            positions = np.array([i for i, ref_hands in enumerate(hands) if ref_hands == group_hands], dtype=int)
+            embeddings = {
+                channel: pad_embeddings([getattr(sign_models[i], channel) for i in positions])
+                for channel in _get_channels(*group_hands)
+            }
+            self.groups[group_hands] = (positions, embeddings)
+
+    def get_distances(self, recorded_signs) -> np.ndarray:
+        """
+        :param recorded_signs: list of SignModel
+        :return: array (n_signs, n_refs) of the distances, infinity if the signs don't use the same hands
+        """
+        recorded_signs = list(recorded_signs)
+        hands = [(bool(sign.has_left_hand), bool(sign.has_right_hand)) for sign in recorded_signs]
+
+        distances = np.full((len(recorded_signs), self.n_refs), np.inf)
+        for group_hands in set(hands) & set(self.groups):
+            queries = np.array([i for i, sign_hands in enumerate(hands) if sign_hands == group_hands], dtype=int)
+            positions, embeddings = self.groups[group_hands]
+
+            group_distances = np.zeros((len(queries), len(positions)))
+            for channel, (references, reference_lengths) in embeddings.items():
+                padded, lengths = pad_embeddings([getattr(recorded_signs[q], channel) for q in queries])
+                group_distances += batch_dtw(padded, lengths, references, reference_lengths, self.metric)
+            distances[np.ix_(queries, positions)] = group_distances
+        return distances
+
+
+def _get_channels(has_left_hand: bool, has_right_hand: bool):
+    # Embeddings compared by sign_distance for the given hands
+    return (LEFT_CHANNELS if has_left_hand else []) + (RIGHT_CHANNELS if has_right_hand else [])
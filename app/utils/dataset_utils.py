@@ -1,13 +1,30 @@
+import multiprocessing
 import os
+import time
 
+import mediapipe as mp
 import pandas as pd
 from tqdm import tqdm
 
-from models.sign_model import SignModel
+from models.sign_model import EMBEDDING_VERSION, SignModel
+from utils.embedding_cache import EMBEDDING_CACHE_DIR, EmbeddingCache
 from utils.landmark_utils import save_landmarks_from_video, load_array
+from utils.reference_index import (
+    REFERENCE_INDEX_PATH, load_reference_index, read_index_header, save_reference_index
+)
 
 
-def load_dataset():
+# MediaPipe model of an extraction worker, created once by _init_extraction_worker
+_worker_holistic = None
+
+
+def load_dataset(n_workers=None):
+    """
+    Extract the landmarks of the videos that are not in the dataset yet
+
+    :param n_workers: number of extraction processes (all the CPUs by default)
+    :return: The names of all the videos
+    """
     videos = [
         file_name.replace(".mp4", "")
         for root, dirs, files in os.walk(os.path.join("app", "data", "videos"))
@@ -27,33 +44,172 @@ def load_dataset():
     if n > 0:
         print(f"\nExtracting landmarks from new videos: {n} videos detected\n")
 
-        for idx in tqdm(range(n)):
-            save_landmarks_from_video(videos_not_in_dataset[idx])
+        extract_videos(videos_not_in_dataset, n_workers)
 
     return videos
 
 
-def load_reference_signs(videos):
+def extract_videos(videos, n_workers=None):
+    """
+    Extract the landmarks of the videos with a pool of processes: each worker keeps one
+    MediaPipe Holistic model and takes the next video as soon as it is done with the previous one
+
+    :param n_workers: number of processes (all the CPUs by default, 1 extracts in this process)
+    :return: The number of frames & the extraction time (s) of each video
+    """
+    n_workers = min(n_workers or os.cpu_count(), len(videos))
+    timings = {}
+
+    startTime = time.time()
+    if n_workers == 1:
+        _init_extraction_worker()
+        for video_name in tqdm(videos):
+            video_name, n_frames, duration = _extract_video(video_name)
+            timings[video_name] = (n_frames, duration)
+        _worker_holistic.close()
+    else:
+        with multiprocessing.Pool(n_workers, initializer=_init_extraction_worker) as pool:
+            for video_name, n_frames, duration in tqdm(
+                pool.imap_unordered(_extract_video, videos), total=len(videos)
+            ):
+                timings[video_name] = (n_frames, duration)
+    endTime = time.time()
+
+    print_extraction_report(timings, endTime - startTime, n_workers)
+    return timings
+
+
+def print_extraction_report(timings, total_time, n_workers):
+    print("\nExtraction time per video:")
+    for video_name, (n_frames, duration) in sorted(timings.items(), key=lambda item: -item[1][1]):
+        print(f"  {video_name}: {n_frames} frames in {duration:.2f} s ({n_frames / max(duration, 1e-9):.1f} fps)")
+
+    total_frames = sum(n_frames for n_frames, _ in timings.values())
+    print(
+        f"\n{len(timings)} videos ({total_frames} frames) extracted in {total_time:.2f} s with {n_workers} processes: "
+        f"{len(timings) / total_time:.2f} videos/s, {total_frames / total_time:.1f} frames/s\n"
+    )
+
+
+def _init_extraction_worker():
+    global _worker_holistic
+    _worker_holistic = mp.solutions.holistic.Holistic(
+        min_detection_confidence=0.5, min_tracking_confidence=0.5
+    )
+
+
+def _extract_video(video_name):
+    startTime = time.time()
+
+    # Forget the tracking state of the previous video
+    _worker_holistic.reset()
+    n_frames = save_landmarks_from_video(video_name, _worker_holistic)
+
+    return video_name, n_frames, time.time() - startTime
+
+
+def load_reference_signs(videos, index_path=REFERENCE_INDEX_PATH, cache_dir=EMBEDDING_CACHE_DIR):
+    """
+    :param videos: names of the reference videos
+    :param index_path: compiled reference index, used if it is up to date and (re)built otherwise
+                       (None always computes the SignModel objects from the landmarks)
+    :param cache_dir: directory of the EmbeddingCache used when the index is not up to date
+                      (None disables the cache)
+    :return: pd.DataFrame of the reference signs
+    """
+    if index_path is not None and is_reference_index_up_to_date(videos, index_path):
+        print("\nLoading reference signs from the index\n")
+        reference_signs = load_reference_index(index_path)
+    else:
+        cache = EmbeddingCache(cache_dir) if cache_dir is not None else None
+        reference_signs = compute_reference_signs(videos, cache)
+        if index_path is not None:
+            build_reference_index(reference_signs, index_path)
+
+    print(
+        f'\nDictionary count: {reference_signs[["name", "sign_model"]].groupby(["name"]).count()}\n'
+    )
+    return reference_signs
+
+
+def compute_reference_signs(videos, cache: EmbeddingCache = None):
+    """
+    Create the SignModel objects from the landmarks of the videos, reusing the cached embeddings
+    of the landmark files that didn't change
+    """
     reference_signs = {"name": [], "sign_model": [], "signer": [], "distance": [], "video_id": []}
 
     print("\nLoading reference signs\n")
 
     for video_name in tqdm(videos):
         sign_name, signer, _ = video_name.split("-")
-        path = os.path.join("app", "data", "dataset", sign_name, video_name)
+        landmark_paths = get_landmark_paths(video_name)
 
-        pose_list = load_array(os.path.join(path, f"pose_{video_name}.pickle"))
-        left_hand_list = load_array(os.path.join(path, f"lh_{video_name}.pickle"))
-        right_hand_list = load_array(os.path.join(path, f"rh_{video_name}.pickle"))
+        sign_model = None
+        if cache is not None:
+            key = cache.get_key(landmark_paths)
+            sign_model = cache.get(key)
+
+        if sign_model is None:
+            pose_list, left_hand_list, right_hand_list = [
+                load_array(landmark_path) for landmark_path in landmark_paths
+            ]
+            sign_model = SignModel(pose_list, left_hand_list, right_hand_list)
+            if cache is not None:
+                cache.put(key, sign_model)
 
         reference_signs["name"].append(sign_name)
-        reference_signs["sign_model"].append(SignModel(pose_list, left_hand_list, right_hand_list))
+        reference_signs["sign_model"].append(sign_model)
         reference_signs['signer'].append(signer)
         reference_signs["distance"].append(0)
         reference_signs["video_id"].append(video_name)
 
-    reference_signs = pd.DataFrame(reference_signs, dtype=object)
-    print(
-        f'\nDictionary count: {reference_signs[["name", "sign_model"]].groupby(["name"]).count()}\n'
+    if cache is not None:
+        print(f"\nEmbedding cache: {cache.hits} hits, {cache.misses} misses\n")
+
+    return pd.DataFrame(reference_signs, dtype=object)
+
+
+def build_reference_index(reference_signs: pd.DataFrame, index_path=REFERENCE_INDEX_PATH):
+    """
+    Compile the reference signs in a single file loaded at the next startups
+    """
+    print(f"\nBuilding the reference index: {index_path}\n")
+    save_reference_index(reference_signs, index_path, embedding_version=EMBEDDING_VERSION)
+
+
+def is_reference_index_up_to_date(videos, index_path=REFERENCE_INDEX_PATH) -> bool:
+    """
+    The index is up to date if it contains exactly the given videos, if it was built with
+    the current embedding code and if none of their landmarks has been extracted after it was built
+    """
+    if not os.path.exists(index_path):
+        return False
+    try:
+        header, _ = read_index_header(index_path)
+    except ValueError:
+        return False
+
+    if header.get("embedding_version") != EMBEDDING_VERSION or sorted(header["video_ids"]) != sorted(videos):
+        return False
+
+    index_time = os.path.getmtime(index_path)
+    return all(
+        os.path.getmtime(landmark_path) <= index_time
+        for video_name in videos
+        for landmark_path in get_landmark_paths(video_name)
     )
-    return reference_signs
+
+
+def get_landmark_paths(video_name):
+    """
+    :return: The paths of the pose, left hand & right hand landmarks of a video
+    """
+    sign_name = video_name.split("-")[0]
+    path = os.path.join("app", "data", "dataset", sign_name, video_name)
+
+    return [
+        os.path.join(path, f"pose_{video_name}.pickle"),
+        os.path.join(path, f"lh_{video_name}.pickle"),
+        os.path.join(path, f"rh_{video_name}.pickle"),
+    ]
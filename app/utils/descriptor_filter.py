@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+
+from models.sign_model import SignModel
+from utils.dtw import sign_distance
+from utils.dtw_search import LEFT_CHANNELS, RIGHT_CHANNELS
+from utils.instrumentation import INSTRUMENTATION
+
+
+# Number of bins of the histogram of the angles of each channel
+N_BINS = 8
+
+# Weight of the difference of duration (log of the ratio of the numbers of frames)
+DURATION_WEIGHT = 1.0
+
+
+def channel_descriptor(embedding: np.ndarray, n_bins=N_BINS) -> np.ndarray:
+    """
+    Fixed-length summary of an embedding: mean & standard deviation of each angle,
+    and the histogram (proportions) of all its angles between 0 and pi
+
+    :param embedding: array (n_frame, n_features)
+    :return: array (2 * n_features + n_bins,), zeros if the embedding is empty
+    """
+    embedding = np.asarray(embedding)
+    n_features = embedding.shape[1]
+    if len(embedding) == 0:
+        return np.zeros(2 * n_features + n_bins)
+
+    histogram, _ = np.histogram(embedding, bins=n_bins, range=(0, np.pi))
+    return np.concatenate([
+        embedding.mean(axis=0), embedding.std(axis=0), histogram / embedding.size
+    ])
+
+
+class DescriptorIndex(object):
+    """
+    Coarse first stage of the matching: every reference sign is summarized by a fixed-length descriptor
+    per channel (see channel_descriptor) & its duration, and the references closest to the recorded sign
+    (L1 distance of the descriptors of the channels it uses) are shortlisted for the DTW
+
+    Args
+        descriptors: dict channel -> array (n_refs, descriptor_size)
+        durations: array (n_refs,), log of the number of frames of each reference
+    """
+
+    def __init__(self, reference_signs: pd.DataFrame, n_bins=N_BINS, duration_weight=DURATION_WEIGHT):
+        self.index = reference_signs.index
+        self.n_bins = n_bins
+        self.duration_weight = duration_weight
+
+        sign_models = list(reference_signs["sign_model"])
+        self.has_left_hand = np.array([sign_model.has_left_hand for sign_model in sign_models], dtype=bool)
+        self.has_right_hand = np.array([sign_model.has_right_hand for sign_model in sign_models], dtype=bool)
+        self.durations = np.log1p([sign_model.n_frames for sign_model in sign_models])
+        self.descriptors = {
+            channel: np.array([channel_descriptor(getattr(sign_model, channel), n_bins) for sign_model in sign_models])
+            for channel in LEFT_CHANNELS + RIGHT_CHANNELS
+        }
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_distances(self, recorded_sign: SignModel) -> np.ndarray:
+        """
+        :return: array (n_refs,) of the descriptor distances, infinity if the hands don't match
+        """
+        channels = []
+        if recorded_sign.has_left_hand:
+            channels += LEFT_CHANNELS
+        if recorded_sign.has_right_hand:
+            channels += RIGHT_CHANNELS
+
+        distances = self.duration_weight * np.abs(self.durations - np.log1p(recorded_sign.n_frames))
+        for channel in channels:
+            descriptor = channel_descriptor(getattr(recorded_sign, channel), self.n_bins)
+            distances += np.abs(self.descriptors[channel] - descriptor).sum(axis=1)
+
+        distances[
+            (self.has_left_hand != recorded_sign.has_left_hand) | (self.has_right_hand != recorded_sign.has_right_hand)
+        ] = np.inf
+        return distances
+
+    def shortlist(self, recorded_sign: SignModel, k: int, candidates=None) -> np.ndarray:
+        """
+        :param k: number of references kept
+        :param candidates: positions of the references which can be shortlisted (all by default)
+        :return: Positions of (at most) the k references closest to the recorded sign, with the same hands
+        """
+        if k < 1:
+            raise ValueError(f"The number of shortlisted references must be at least 1, got k={k}")
+        distances = self.get_distances(recorded_sign)
+        if candidates is not None:
+            candidates = np.asarray(candidates)
+            distances = distances[candidates]
+        positions = np.flatnonzero(np.isfinite(distances))
+
+        if len(positions) > k:
+            positions = positions[np.argpartition(distances[positions], k - 1)[:k]]
+        positions = positions[np.argsort(distances[positions], kind="stable")]
+        return positions if candidates is None else candidates[positions]
+
+
+def prefiltered_dtw_distances(
+    recorded_sign: SignModel, reference_signs: pd.DataFrame, k=20, descriptors: DescriptorIndex = None,
+    engine="fastdtw", **dtw_kwargs
+):
+    """
+    DTW distances of the k references shortlisted by their descriptors, the other references
+    get an infinite distance
+
+    :param descriptors: DescriptorIndex of reference_signs, computed if not given
+    :param engine: one of DTW_ENGINES
+    :param dtw_kwargs: options of the numpy engine (window, radius, max_slope, metric)
+    :return: The reference signs sorted by distance & a dict counting the references of each stage
+    """
+    if k < 1:
+        raise ValueError(f"The number of shortlisted references must be at least 1, got k={k}")
+    if descriptors is None:
+        descriptors = DescriptorIndex(reference_signs)
+    if len(descriptors) != len(reference_signs):
+        raise ValueError("The descriptors don't match the reference signs")
+    if not reference_signs.index.equals(descriptors.index):
+        # The reference signs have been sorted since the descriptors were computed
+        reference_signs = reference_signs.loc[descriptors.index]
+
+    with INSTRUMENTATION.span("prefilter"):
+        shortlist = descriptors.shortlist(recorded_sign, k)
+
+    sign_models = reference_signs["sign_model"].values
+    distances = np.full(len(reference_signs), np.inf)
+    for position in shortlist:
+        distances[position] = sign_distance(recorded_sign, sign_models[position], engine=engine, **dtw_kwargs)
+
+    same_hands = (descriptors.has_left_hand == recorded_sign.has_left_hand) & (
+        descriptors.has_right_hand == recorded_sign.has_right_hand
+    )
+    stats = {
+        "references": len(reference_signs),
+        "hand_mismatch": int(np.count_nonzero(~same_hands)),
+        "prefiltered": int(np.count_nonzero(same_hands)) - len(shortlist),
+        "dtw": len(shortlist),
+    }
+
+    reference_signs["distance"] = distances
+    return reference_signs.sort_values(by=["distance"]), stats
+
+
+def shortlist_recall(
+    distance_matrix: np.ndarray, reference_signs: pd.DataFrame, signers, k_values, descriptors: DescriptorIndex = None
+) -> pd.DataFrame:
+    """
+    Quality of the shortlist in the leave-one-signer-out cross validation, from the precomputed DTW distances
+
+    :param distance_matrix: array (n_refs, n_refs) in the order of the rows of reference_signs
+    :param k_values: sizes of shortlist evaluated
+    :return: pd.DataFrame indexed by k: recall (proportion of the videos whose DTW nearest neighbour is
+             shortlisted), accuracy of the prediction within the shortlist & proportion of the DTW computed
+    """
+    if descriptors is None:
+        descriptors = DescriptorIndex(reference_signs)
+    sign_models = reference_signs["sign_model"].values
+    signer_values = reference_signs["signer"].values
+    names = reference_signs["name"].values
+
+    report = pd.DataFrame(
+        0.0, index=pd.Index(k_values, name="k"), columns=["recall", "accuracy", "dtw_ratio"]
+    )
+    n_videos = 0
+    for signer in signers:
+        validation_idx = np.flatnonzero(signer_values == signer)
+        training_idx = np.flatnonzero(signer_values != signer)
+
+        for idx in validation_idx:
+            n_videos += 1
+            distances = distance_matrix[idx]
+            nearest = training_idx[np.argmin(distances[training_idx])]
+            for k in k_values:
+                shortlist = descriptors.shortlist(sign_models[idx], k, candidates=training_idx)
+                if len(shortlist) == 0:
+                    continue
+
+                # Prediction of the closest reference (get_sign_predicted with batch_size=1)
+                closest = shortlist[np.argmin(distances[shortlist])]
+                report.loc[k, "recall"] += nearest in shortlist
+                report.loc[k, "accuracy"] += names[closest] == names[idx]
+                report.loc[k, "dtw_ratio"] += len(shortlist) / max(len(training_idx), 1)
+    return report / max(n_videos, 1)
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from models.sign_model import EMBEDDING_NAMES, EMBEDDING_VERSION
+from utils.dtw_pool import DTWPool
+from utils.file_utils import atomic_write
+
+
+# Default location of the cached distance matrices
+DISTANCE_MATRIX_DIR = os.path.join("app", "data", "cache", "distance_matrices")
+
+
+def get_distance_matrix_key(reference_signs: pd.DataFrame, engine="fastdtw", **dtw_kwargs) -> str:
+    """
+    :return: Hash of the embeddings of the reference signs, of the embedding version & of the DTW options
+    """
+    digest = hashlib.sha1(EMBEDDING_VERSION.encode("utf-8"))
+    digest.update(json.dumps([engine, sorted(dtw_kwargs.items())]).encode("utf-8"))
+
+    for video_id, sign_model in zip(reference_signs["video_id"], reference_signs["sign_model"]):
+        digest.update(str(video_id).encode("utf-8"))
+        for embedding_name in EMBEDDING_NAMES:
+            digest.update(np.ascontiguousarray(getattr(sign_model, embedding_name), dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def load_distance_matrix(
+    reference_signs: pd.DataFrame, engine="fastdtw", n_workers=None, cache_dir=DISTANCE_MATRIX_DIR, **dtw_kwargs
+) -> np.ndarray:
+    """
+    Distances between every pair of reference signs, read from the cache if it was already computed
+    for the same reference signs and DTW options, computed in parallel (and cached) otherwise
+
+    :param n_workers: number of processes computing the matrix (all the CPUs by default)
+    :param cache_dir: directory of the cached matrices (None disables the cache)
+    :return: Symmetric array (n_refs, n_refs) in the order of the rows of reference_signs
+    """
+    path = None
+    if cache_dir is not None:
+        key = get_distance_matrix_key(reference_signs, engine, **dtw_kwargs)
+        path = os.path.join(cache_dir, f"{key}.npy")
+
+        if os.path.exists(path):
+            print(f"\nLoading the distance matrix: {path}\n")
+            return np.load(path)
+
+    print(f"\nComputing the distances between the {len(reference_signs)} reference signs\n")
+    with DTWPool(reference_signs, n_workers=n_workers, engine=engine, **dtw_kwargs) as pool:
+        matrix = pool.distance_matrix()
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # An interrupted run never leaves a partial matrix
+        atomic_write(path, lambda file: np.save(file, matrix))
+
+    return matrix
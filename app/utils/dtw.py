@@ -1,10 +1,23 @@
+import math
+
 import pandas as pd
 from fastdtw import fastdtw
 import numpy as np
-from models.sign_model import SignModel
+from models.sign_model import EMBEDDING_DTYPE, SignModel
+from utils.instrumentation import INSTRUMENTATION
+
+
+# Engines available to compute the DTW between two embeddings
+DTW_ENGINES = ["fastdtw", "numpy"]
 
+# Local distances supported by the numpy engine ("manhattan" is the one used by fastdtw)
+LOCAL_DISTANCES = ["manhattan", "euclidean", "sqeuclidean"]
 
-def dtw_distances(recorded_sign: SignModel, reference_signs: pd.DataFrame):
+# Global constraints supported by the numpy engine
+DTW_WINDOWS = ["sakoe_chiba", "itakura"]
+
+
+def dtw_distances(recorded_sign: SignModel, reference_signs: pd.DataFrame, engine="fastdtw", **dtw_kwargs):
     """
     Use DTW to compute similarity between the recorded sign & the reference signs
 
@@ -13,35 +26,185 @@ def dtw_distances(recorded_sign: SignModel, reference_signs: pd.DataFrame):
                             columns : name, dtype: str
                                       sign_model, dtype: SignModel
                                       distance, dtype: float64
+    :param engine: one of DTW_ENGINES
+    :param dtw_kwargs: options of the numpy engine (window, radius, max_slope, metric)
     :return: Return a sign dictionary sorted by the distances from the recorded sign
     """
-    # Embeddings of the recorded sign
-    rec_left_hand = recorded_sign.lh_embedding
-    rec_right_hand = recorded_sign.rh_embedding
-    rec_left_pose = recorded_sign.left_pose_embedding
-    rec_right_pose = recorded_sign.right_pose_embedding
-
-    for idx, row in reference_signs.iterrows():
-        # Initialize the row variables
-        ref_sign_model = row["sign_model"]
-
-        # If the reference sign has the same number of hands compute fastdtw
-        if (recorded_sign.has_left_hand == ref_sign_model.has_left_hand) and (
-            recorded_sign.has_right_hand == ref_sign_model.has_right_hand
-        ):
-            ref_left_hand = ref_sign_model.lh_embedding
-            ref_right_hand = ref_sign_model.rh_embedding
-            ref_left_pose = ref_sign_model.left_pose_embedding
-            ref_right_pose = ref_sign_model.right_pose_embedding
-
-            if recorded_sign.has_left_hand:
-                row["distance"] += list(fastdtw(rec_left_hand, ref_left_hand))[0]
-                row["distance"] += list(fastdtw(rec_left_pose, ref_left_pose))[0]
-            if recorded_sign.has_right_hand:
-                row["distance"] += list(fastdtw(rec_right_pose, ref_right_pose))[0]
-                row["distance"] += list(fastdtw(rec_right_hand, ref_right_hand))[0]
-
-        # If not, distance equals infinity
-        else:
-            row["distance"] = np.inf
-    return reference_signs.sort_values(by=["distance"])
+    reference_signs["distance"] = [
+        sign_distance(recorded_sign, ref_sign_model, engine=engine, **dtw_kwargs)
+        for ref_sign_model in reference_signs["sign_model"]
+    ]
+    with INSTRUMENTATION.span("sort"):
+        return reference_signs.sort_values(by=["distance"])
+
+
+def sign_distance(recorded_sign: SignModel, ref_sign_model: SignModel, engine="fastdtw", **dtw_kwargs) -> float:
+    """
+    DTW distance between the recorded sign & a reference sign, summed over the hand and arm embeddings
+
+    :param engine: one of DTW_ENGINES
+    :param dtw_kwargs: options of the numpy engine (window, radius, max_slope, metric)
+    :return: The distance, infinity if the two signs don't use the same hands
+    """
+    # If the reference sign doesn't have the same number of hands, distance equals infinity
+    if (recorded_sign.has_left_hand != ref_sign_model.has_left_hand) or (
+        recorded_sign.has_right_hand != ref_sign_model.has_right_hand
+    ):
+        INSTRUMENTATION.increment("references_hand_mismatch")
+        return np.inf
+
+    if engine == "fastdtw":
+        def distance_function(x, y):
+            return fastdtw(x, y)[0]
+    elif engine == "numpy":
+        def distance_function(x, y):
+            return dtw(x, y, **dtw_kwargs)
+    else:
+        raise ValueError(f"Unknown DTW engine: {engine}, expected one of {DTW_ENGINES}")
+
+    def channel_distance(channel):
+        with INSTRUMENTATION.span(f"dtw.{channel}"):
+            return distance_function(getattr(recorded_sign, channel), getattr(ref_sign_model, channel))
+
+    INSTRUMENTATION.increment("references_scored")
+    distance = 0
+    if recorded_sign.has_left_hand:
+        distance += channel_distance("lh_embedding")
+        distance += channel_distance("left_pose_embedding")
+    if recorded_sign.has_right_hand:
+        distance += channel_distance("right_pose_embedding")
+        distance += channel_distance("rh_embedding")
+    return distance
+
+
+def dtw(x, y, window=None, radius=10, max_slope=2.0, metric="manhattan", max_cost=np.inf) -> float:
+    """
+    Exact DTW distance between two embeddings. The cumulative cost matrix is filled
+    one row at a time, each row being computed with vectorized numpy operations
+
+    :param x, y: arrays of shape (n_frame, n_features)
+    :param window: None (no constraint) or one of DTW_WINDOWS
+    :param radius: half-width (in frames) of the Sakoe-Chiba band
+    :param max_slope: maximum slope of the Itakura parallelogram
+    :param metric: local distance, one of LOCAL_DISTANCES
+    :param max_cost: early abandoning threshold, the computation stops as soon as
+                     every cell of a row costs more than max_cost
+    :return: The DTW distance, infinity if no warping path satisfies the constraint
+             or if the computation was abandoned
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) == 0 or len(y) == 0:
+        return np.inf
+
+    # Iterate over the shortest sequence
+    if len(x) > len(y):
+        x, y = y, x
+
+    cost = local_cost_matrix(x, y, metric)
+    n, m = cost.shape
+    lower, upper = dtw_window(n, m, window, radius, max_slope)
+
+    # Cumulative costs of the previous row, prefixed by the virtual cell preceding (0, 0)
+    row = np.full(m + 1, np.inf)
+    row[0] = 0
+    for i in range(n):
+        next_row = np.full(m + 1, np.inf)
+        if lower[i] <= upper[i]:
+            next_row[lower[i] + 1:upper[i] + 2] = dtw_step(
+                row[lower[i]:upper[i] + 2], cost[i, lower[i]:upper[i] + 1]
+            )
+        row = next_row
+
+        # Every warping path goes through this row and the costs are positive
+        if row.min() > max_cost:
+            return np.inf
+    return float(row[m])
+
+
+def dtw_step(previous_row: np.ndarray, cost_row: np.ndarray) -> np.ndarray:
+    """
+    One row of the DTW recursion D[i, j] = C[i, j] + min(D[i-1, j], D[i, j-1], D[i-1, j-1]),
+    vectorized along the last axis. The horizontal dependency is resolved with a prefix sum:
+    D[i, j] = S[j] + min_{k <= j}(C[i, k] + min(D[i-1, k], D[i-1, k-1]) - S[k]), S being the
+    cumulative sum of C[i, :]
+
+    :param previous_row: array (..., m + 1) of the cumulative costs of the previous row,
+                         prefixed by the cost of the cell preceding its first column
+    :param cost_row: array (..., m) of the local costs of the current row
+    :return: array (..., m) of the cumulative costs of the current row
+    """
+    best_previous = np.minimum(previous_row[..., 1:], previous_row[..., :-1])
+    prefix = np.cumsum(cost_row, axis=-1, dtype=np.float64)
+    return prefix + np.minimum.accumulate(cost_row + best_previous - prefix, axis=-1)
+
+
+def local_cost_matrix(x: np.ndarray, y: np.ndarray, metric="manhattan") -> np.ndarray:
+    """
+    :param x, y: arrays of shape (n, n_features) and (m, n_features)
+    :param metric: one of LOCAL_DISTANCES
+    :return: array (n, m) of the distances between each frame of x and each frame of y
+    """
+    return frame_cost(x[:, np.newaxis, :] - y[np.newaxis, :, :], metric)
+
+
+def frame_cost(difference: np.ndarray, metric="manhattan") -> np.ndarray:
+    """
+    :param difference: array (..., n_features) of the differences between two sets of frames
+    :param metric: one of LOCAL_DISTANCES
+    :return: array (...) of the local distances between the frames
+    """
+    if metric == "manhattan":
+        return np.abs(difference).sum(axis=-1)
+
+    squared = np.square(difference).sum(axis=-1)
+    if metric == "sqeuclidean":
+        return squared
+    if metric == "euclidean":
+        return np.sqrt(squared)
+    raise ValueError(f"Unknown local distance: {metric}, expected one of {LOCAL_DISTANCES}")
+
+
+def pad_embeddings(embeddings, dtype=EMBEDDING_DTYPE):
+    """
+    :param embeddings: list of arrays (n_frame, n_features) with the same number of features
+    :param dtype: type of the padded array (the one of the SignModel embeddings by default)
+    :return: array (n_embeddings, max_len, n_features) of the embeddings padded with zeros
+             & int array (n_embeddings,) of their lengths
+    """
+    lengths = np.array([len(embedding) for embedding in embeddings], dtype=int)
+
+    n_features = np.shape(embeddings[0])[1] if len(embeddings) > 0 else 0
+    padded = np.zeros((len(embeddings), max(lengths, default=0), n_features), dtype=dtype)
+    for i, embedding in enumerate(embeddings):
+        padded[i, :len(embedding)] = embedding
+    return padded, lengths
+
+
+def dtw_window(n: int, m: int, window=None, radius=10, max_slope=2.0):
+    """
+    Column bounds of the cells allowed by the global constraint for each row of a (n, m) cost matrix
+
+    :param window: None, "sakoe_chiba" (band of half-width radius around the diagonal)
+                   or "itakura" (parallelogram of slopes between 1 / max_slope and max_slope)
+    :return: Two int arrays of size n: the first and last allowed column of each row
+             (a row with no allowed cell has lower > upper)
+    """
+    rows = np.arange(n)
+    if window is None or (window == "sakoe_chiba" and n == 1):
+        return np.zeros(n, dtype=int), np.full(n, m - 1)
+
+    if window == "sakoe_chiba":
+        # The band follows the diagonal of the matrix and is wide enough to stay connected
+        slope = (m - 1) / (n - 1)
+        radius = max(radius, math.ceil(slope / 2))
+        center = rows * slope
+        lower = np.ceil(center - radius - 1e-9)
+        upper = np.floor(center + radius + 1e-9)
+    elif window == "itakura":
+        lower = np.ceil(np.maximum(rows / max_slope, (m - 1) - max_slope * (n - 1 - rows)) - 1e-9)
+        upper = np.floor(np.minimum(rows * max_slope, (m - 1) - (n - 1 - rows) / max_slope) + 1e-9)
+    else:
+        raise ValueError(f"Unknown DTW window: {window}, expected one of {DTW_WINDOWS}")
+
+    return np.maximum(lower, 0).astype(int), np.minimum(upper, m - 1).astype(int)
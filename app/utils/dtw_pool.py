@@ -0,0 +1,145 @@
+import math
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from models.sign_model import SignModel
+from utils.dtw import sign_distance
+from utils.dtw_search import ReferenceEnvelopes, dtw_search
+from utils.shared_references import SharedReferences, attach_reference_signs
+
+
+# Reference signs resident in each worker process, set once by _init_worker
+_worker_references = None
+
+# Lower bound envelopes of the shards already searched by the worker
+_worker_envelopes = {}
+
+
+def _init_worker(descriptor):
+    global _worker_references
+    _worker_references = attach_reference_signs(descriptor)
+    _worker_envelopes.clear()
+
+
+def _score_shard(args):
+    """
+    Compute the distances between the recorded sign & the reference signs [start, stop[ of the worker
+
+    :return: The positions of the scored references & their distances
+             (only the k closest references if k is not None)
+    """
+    recorded_sign, start, stop, engine, k, dtw_kwargs = args
+    shard = _worker_references.iloc[start:stop]
+
+    if k is not None and engine == "numpy":
+        if (start, stop) not in _worker_envelopes:
+            _worker_envelopes[(start, stop)] = ReferenceEnvelopes(shard)
+        shard, _ = dtw_search(recorded_sign, shard.copy(), k=k, envelopes=_worker_envelopes[(start, stop)], **dtw_kwargs)
+        return shard.index.values[:k], shard["distance"].values[:k].astype(float)
+
+    distances = np.array([
+        sign_distance(recorded_sign, ref_sign_model, engine=engine, **dtw_kwargs)
+        for ref_sign_model in shard["sign_model"]
+    ])
+    positions = np.arange(start, stop)
+    if k is not None:
+        closest = np.argsort(distances, kind="stable")[:k]
+        positions, distances = positions[closest], distances[closest]
+    return positions, distances
+
+
+def _score_row(args):
+    """
+    Compute the distances between the reference sign i of the worker & the reference signs after it
+    """
+    i, engine, dtw_kwargs = args
+    sign_models = _worker_references["sign_model"].values
+
+    return i, np.array([
+        sign_distance(sign_models[i], ref_sign_model, engine=engine, **dtw_kwargs)
+        for ref_sign_model in sign_models[i + 1:]
+    ])
+
+
+class DTWPool(object):
+    """
+    Pool of processes computing the DTW distances between a recorded sign & the reference signs.
+    The reference signs are published once in shared memory & attached by each worker, then every call
+    only sends the recorded sign: the reference set is split into shards of chunk_size signs scored in parallel
+
+    Params
+        reference_signs: pd.DataFrame of the reference signs
+        n_workers: number of processes (all the CPUs by default)
+        chunk_size: number of reference signs per shard (4 shards per worker by default)
+        engine: one of DTW_ENGINES
+        dtw_kwargs: options of the numpy engine (window, radius, max_slope, metric)
+    """
+
+    def __init__(self, reference_signs: pd.DataFrame, n_workers=None, chunk_size=None, engine="fastdtw", **dtw_kwargs):
+        self.index = reference_signs.index
+        self.n_workers = n_workers or os.cpu_count()
+        self.chunk_size = chunk_size or max(1, math.ceil(len(reference_signs) / (4 * self.n_workers)))
+        self.engine = engine
+        self.dtw_kwargs = dtw_kwargs
+
+        self.shared_references = SharedReferences(reference_signs)
+        self.pool = multiprocessing.Pool(
+            self.n_workers, initializer=_init_worker, initargs=(self.shared_references.descriptor,)
+        )
+
+    def dtw_distances(self, recorded_sign: SignModel, reference_signs: pd.DataFrame, k=None):
+        """
+        Parallel version of dtw_distances (same result)
+
+        :param reference_signs: the pd.DataFrame the pool was created with (possibly sorted)
+        :param k: if given, each shard only returns its k closest references and the distance
+                  of the other references is set to infinity
+        :return: Return a sign dictionary sorted by the distances from the recorded sign
+        """
+        if not reference_signs.index.equals(self.index):
+            # The reference signs have been sorted since the pool was created
+            reference_signs = reference_signs.loc[self.index]
+
+        shards = [
+            (recorded_sign, start, min(start + self.chunk_size, len(self.index)), self.engine, k, self.dtw_kwargs)
+            for start in range(0, len(self.index), self.chunk_size)
+        ]
+
+        # Merge the distances of every shard
+        distances = np.full(len(self.index), np.inf)
+        for positions, shard_distances in self.pool.imap_unordered(_score_shard, shards):
+            distances[positions] = shard_distances
+
+        reference_signs["distance"] = distances
+        return reference_signs.sort_values(by=["distance"])
+
+    def distance_matrix(self) -> np.ndarray:
+        """
+        Compute the distances between every pair of reference signs (each pair is computed once)
+
+        :return: Symmetric array (n_refs, n_refs), in the order of the reference signs the pool was created with
+        """
+        n_refs = len(self.index)
+        matrix = np.zeros((n_refs, n_refs))
+
+        rows = [(i, self.engine, self.dtw_kwargs) for i in range(n_refs)]
+        chunk_size = max(1, n_refs // (16 * self.n_workers))
+        for i, distances in tqdm(self.pool.imap_unordered(_score_row, rows, chunk_size), total=n_refs):
+            matrix[i, i + 1:] = distances
+            matrix[i + 1:, i] = distances
+        return matrix
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared_references.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,213 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+
+from models.sign_model import SignModel
+from utils.dtw import dtw, frame_cost
+from utils.instrumentation import INSTRUMENTATION
+
+
+# Embeddings compared when a hand is present, in the order they are summed by sign_distance
+LEFT_CHANNELS = ["lh_embedding", "left_pose_embedding"]
+RIGHT_CHANNELS = ["right_pose_embedding", "rh_embedding"]
+
+# Number of reference signs processed at once when computing LB_Keogh
+LB_CHUNK_SIZE = 1024
+
+
+class ChannelEnvelope(object):
+    """
+    Summary of one embedding of every reference sign used by the lower bounds
+    Args
+        lengths: int array (n_refs,), number of frames of each embedding
+        first, last: arrays (n_refs, n_features), first & last frame of each embedding
+        lower, upper: arrays (n_refs, n_features), minimum & maximum of each feature over all frames
+    """
+
+    def __init__(self, embeddings):
+        n_features = np.shape(embeddings[0])[1] if len(embeddings) > 0 else 0
+        shape = (len(embeddings), n_features)
+
+        self.lengths = np.array([len(embedding) for embedding in embeddings], dtype=int)
+        self.first, self.last = np.zeros(shape), np.zeros(shape)
+        self.lower, self.upper = np.zeros(shape), np.zeros(shape)
+
+        for idx, embedding in enumerate(embeddings):
+            if len(embedding) == 0:
+                continue
+            self.first[idx] = embedding[0]
+            self.last[idx] = embedding[-1]
+            self.lower[idx] = np.min(embedding, axis=0)
+            self.upper[idx] = np.max(embedding, axis=0)
+
+
+class ReferenceEnvelopes(object):
+    """
+    Lower bound data precomputed once for every reference sign of a DataFrame
+    (must be rebuilt if the rows of the DataFrame change)
+    """
+
+    def __init__(self, reference_signs: pd.DataFrame):
+        sign_models = list(reference_signs["sign_model"])
+
+        # Index of the reference signs, in the order of the envelopes
+        self.index = reference_signs.index
+
+        self.has_left_hand = np.array([sign_model.has_left_hand for sign_model in sign_models], dtype=bool)
+        self.has_right_hand = np.array([sign_model.has_right_hand for sign_model in sign_models], dtype=bool)
+        self.channels = {
+            channel: ChannelEnvelope([getattr(sign_model, channel) for sign_model in sign_models])
+            for channel in LEFT_CHANNELS + RIGHT_CHANNELS
+        }
+
+    def __len__(self):
+        return len(self.has_left_hand)
+
+
+def lb_kim(query: np.ndarray, envelope: ChannelEnvelope, metric="manhattan") -> np.ndarray:
+    """
+    LB_Kim: every warping path goes through the first and the last cells of the cost matrix
+
+    :param query: array (n_frame, n_features)
+    :return: array (n_refs,) of lower bounds of the DTW between the query and each reference
+    """
+    if len(query) == 0:
+        return np.full(len(envelope.lengths), np.inf)
+
+    bound = frame_cost(query[0] - envelope.first, metric)
+    if len(query) > 1:
+        bound += frame_cost(query[-1] - envelope.last, metric)
+    else:
+        bound += np.where(envelope.lengths > 1, frame_cost(query[-1] - envelope.last, metric), 0)
+
+    bound[envelope.lengths == 0] = np.inf
+    return bound
+
+
+def lb_keogh(query: np.ndarray, envelope: ChannelEnvelope, metric="manhattan") -> np.ndarray:
+    """
+    LB_Keogh with an envelope covering the whole reference: every frame of the query is matched
+    to at least one frame of the reference, which lies inside the [lower, upper] box of the reference
+
+    :param query: array (n_frame, n_features)
+    :return: array (n_refs,) of lower bounds of the DTW between the query and each reference
+    """
+    if len(query) == 0:
+        return np.full(len(envelope.lengths), np.inf)
+
+    bound = np.empty(len(envelope.lengths))
+    for start in range(0, len(bound), LB_CHUNK_SIZE):
+        upper = envelope.upper[start:start + LB_CHUNK_SIZE, np.newaxis, :]
+        lower = envelope.lower[start:start + LB_CHUNK_SIZE, np.newaxis, :]
+
+        # Distance of each query frame to the box of each reference
+        excess = np.maximum(query - upper, 0) + np.maximum(lower - query, 0)
+        bound[start:start + LB_CHUNK_SIZE] = frame_cost(excess, metric).sum(axis=-1)
+
+    bound[envelope.lengths == 0] = np.inf
+    return bound
+
+
+def dtw_search(
+    recorded_sign: SignModel, reference_signs: pd.DataFrame, k=5, envelopes: ReferenceEnvelopes = None, **dtw_kwargs
+):
+    """
+    Exact search of the k reference signs closest to the recorded sign. The references are
+    discarded with LB_Kim, then LB_Keogh, and the DTW of the remaining references is abandoned
+    as soon as its partial cost exceeds the current k-th best distance
+
+    :param recorded_sign: a SignModel object containing the data gathered during record
+    :param reference_signs: pd.DataFrame with a sign_model column
+    :param k: number of nearest references whose distance is guaranteed to be exact
+    :param envelopes: ReferenceEnvelopes of reference_signs, computed if not given
+    :param dtw_kwargs: options of the numpy DTW engine (window, radius, max_slope, metric)
+    :return: The reference signs sorted by distance (the pruned references have an infinite distance)
+             & a dict counting the references discarded by each stage
+    """
+    if k < 1:
+        raise ValueError(f"The number of nearest references must be at least 1, got k={k}")
+    if envelopes is None:
+        envelopes = ReferenceEnvelopes(reference_signs)
+    if len(envelopes) != len(reference_signs):
+        raise ValueError("The envelopes don't match the reference signs")
+    if not reference_signs.index.equals(envelopes.index):
+        # The reference signs have been sorted since the envelopes were computed
+        reference_signs = reference_signs.loc[envelopes.index]
+
+    metric = dtw_kwargs.get("metric", "manhattan")
+    channels = []
+    if recorded_sign.has_left_hand:
+        channels += LEFT_CHANNELS
+    if recorded_sign.has_right_hand:
+        channels += RIGHT_CHANNELS
+    queries = [np.asarray(getattr(recorded_sign, channel)) for channel in channels]
+
+    # Lower bounds of each channel for every reference (n_channels, n_refs)
+    kim = np.zeros((len(channels), len(envelopes)))
+    keogh = np.zeros((len(channels), len(envelopes)))
+    for idx, (channel, query) in enumerate(zip(channels, queries)):
+        kim[idx] = lb_kim(query, envelopes.channels[channel], metric)
+        keogh[idx] = lb_keogh(query, envelopes.channels[channel], metric)
+    lower_bound = np.maximum(kim, keogh)
+
+    # Only the references with the same hands are candidates, the most promising ones first
+    candidates = np.flatnonzero(
+        (envelopes.has_left_hand == recorded_sign.has_left_hand)
+        & (envelopes.has_right_hand == recorded_sign.has_right_hand)
+    )
+    candidates = candidates[np.argsort(lower_bound[:, candidates].sum(axis=0), kind="stable")]
+
+    stats = {
+        "references": len(envelopes),
+        "hand_mismatch": len(envelopes) - len(candidates),
+        "lb_kim": 0,
+        "lb_keogh": 0,
+        "abandoned": 0,
+        "dtw": 0,
+    }
+    distances = np.full(len(envelopes), np.inf)
+    sign_models = reference_signs["sign_model"].values
+
+    # Max-heap (negated distances) of the k best distances found so far
+    best = []
+    for position, ref_idx in enumerate(candidates):
+        kth_best = -best[0] if len(best) == k else np.inf
+
+        # The candidates are sorted by lower bound: all the remaining ones can be discarded
+        if lower_bound[:, ref_idx].sum() > kth_best:
+            remaining = candidates[position:]
+            n_kim = np.count_nonzero(kim[:, remaining].sum(axis=0) > kth_best)
+            stats["lb_kim"] += n_kim
+            stats["lb_keogh"] += len(remaining) - n_kim
+            break
+
+        distance = 0
+        for idx, (channel, query) in enumerate(zip(channels, queries)):
+            remaining_bound = lower_bound[idx + 1:, ref_idx].sum()
+            distance += dtw(
+                query,
+                getattr(sign_models[ref_idx], channel),
+                max_cost=kth_best - distance - remaining_bound,
+                **dtw_kwargs,
+            )
+            if distance > kth_best:
+                break
+
+        if distance > kth_best:
+            stats["abandoned"] += 1
+            continue
+
+        stats["dtw"] += 1
+        distances[ref_idx] = distance
+        if len(best) < k:
+            heapq.heappush(best, -distance)
+        else:
+            heapq.heapreplace(best, -distance)
+
+    INSTRUMENTATION.increment("references_scored", stats["dtw"] + stats["abandoned"])
+    INSTRUMENTATION.increment("references_hand_mismatch", stats["hand_mismatch"])
+
+    reference_signs["distance"] = distances
+    with INSTRUMENTATION.span("sort"):
+        return reference_signs.sort_values(by=["distance"]), stats
@@ -0,0 +1,113 @@
+import hashlib
+import os
+
+import numpy as np
+
+from models.sign_model import EMBEDDING_NAMES, EMBEDDING_VERSION, SignModel
+from utils.file_utils import atomic_write
+
+
+# Default location & size of the cache of reference embeddings
+EMBEDDING_CACHE_DIR = os.path.join("app", "data", "cache", "embeddings")
+EMBEDDING_CACHE_MAX_SIZE = 1024 ** 3
+
+# Fraction of max_size kept when the cache is full, so that the eviction doesn't run at every insertion
+EVICTION_RATIO = 0.9
+
+
+class EmbeddingCache(object):
+    """
+    Persistent cache of the SignModel embeddings, addressed by the content of the landmark files
+    and by the version of the embedding code. The least recently used entries are evicted
+    when the size of the cache exceeds max_size bytes
+
+    Args
+        hits, misses: number of lookups that found / didn't find an entry
+        size: total size of the entries in bytes
+    """
+
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, max_size=EMBEDDING_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._get_entries())
+
+    @staticmethod
+    def get_key(landmark_paths) -> str:
+        """
+        :param landmark_paths: paths of the pose, left hand & right hand landmarks of a video
+        :return: Hash of the content of the files & of the embedding version
+        """
+        digest = hashlib.sha1(EMBEDDING_VERSION.encode("utf-8"))
+        for landmark_path in landmark_paths:
+            with open(landmark_path, "rb") as file:
+                digest.update(hashlib.sha1(file.read()).digest())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        :return: The cached SignModel, None if the key is not in the cache
+        """
+        path = self._get_path(key)
+        try:
+            with np.load(path) as data:
+                sign_model = SignModel.from_embeddings(
+                    has_left_hand=data["has_left_hand"], has_right_hand=data["has_right_hand"],
+                    **{embedding_name: data[embedding_name] for embedding_name in EMBEDDING_NAMES}
+                )
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        os.utime(path)
+        self.hits += 1
+        return sign_model
+
+    def put(self, key: str, sign_model: SignModel):
+        path = self._get_path(key)
+
+        # An entry overwritten is replaced in the size of the cache
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+
+        # A crash never leaves a partial entry
+        atomic_write(path, lambda file: np.savez(
+            file,
+            has_left_hand=sign_model.has_left_hand,
+            has_right_hand=sign_model.has_right_hand,
+            **{embedding_name: getattr(sign_model, embedding_name) for embedding_name in EMBEDDING_NAMES}
+        ))
+
+        entry_size = os.path.getsize(path)
+        self.size += entry_size - previous_size
+
+        # An entry which doesn't fit after an eviction would evict every other one (and itself): it isn't cached
+        if entry_size > self.max_size * EVICTION_RATIO:
+            os.remove(path)
+            self.size -= entry_size
+            return
+
+        if self.size > self.max_size:
+            self.evict(int(self.max_size * EVICTION_RATIO))
+
+    def evict(self, target_size: int):
+        """
+        Delete the least recently used entries until the cache fits in target_size bytes
+        """
+        entries = sorted(self._get_entries(), key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+
+        for entry in entries:
+            if self.size <= target_size:
+                break
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def _get_entries(self):
+        return [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".npz")]
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
@@ -0,0 +1,19 @@
+import os
+
+
+def atomic_write(path, write_fn):
+    """
+    Write a file in a temporary file first, then move it to path: an interrupted write never leaves
+    a partial file (the previous one, if any, is kept)
+
+    :param write_fn: function writing the content in the binary file object it is given
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            write_fn(file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
@@ -0,0 +1,78 @@
+import queue
+import threading
+
+import cv2
+
+
+# Number of decoded frames waiting for the inference
+FRAME_QUEUE_SIZE = 16
+
+# Marks the end of the video in the queue
+_END_OF_VIDEO = object()
+
+
+class FramePrefetcher(object):
+    """
+    Iterate over the frames of a cv2.VideoCapture decoded (and cropped) in a background thread,
+    so that the decoding of the next frames overlaps with the processing of the current one
+
+    Params
+        cap: cv2.VideoCapture to read, released at the end of the iteration
+        max_size: number of decoded frames stored in advance
+        roi: slices applied to each frame (region of interest)
+    """
+
+    def __init__(self, cap: cv2.VideoCapture, max_size=FRAME_QUEUE_SIZE, roi=None):
+        self.cap = cap
+        self.roi = roi
+        self.frames = queue.Queue(maxsize=max_size)
+        self.stopped = threading.Event()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is _END_OF_VIDEO:
+                    break
+                yield frame
+        finally:
+            self.close()
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Stop the reading thread & release the video
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.cap.release()
+
+    def _read(self):
+        try:
+            while not self.stopped.is_set() and self.cap.isOpened():
+                ret, frame = self.cap.read()
+                if not ret:
+                    break
+
+                if self.roi is not None:
+                    frame = frame[self.roi]
+                self._put(frame)
+        except Exception as error:
+            self.error = error
+        finally:
+            self._put(_END_OF_VIDEO)
+
+    def _put(self, item):
+        # Wait for a free slot unless the consumer stopped
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
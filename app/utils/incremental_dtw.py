@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+from models.hand_model import HandModel
+from models.pose_model import PoseModel
+from models.sign_model import EMBEDDING_DTYPE
+from utils.dtw import dtw_step, frame_cost, pad_embeddings
+from utils.dtw_search import LEFT_CHANNELS, RIGHT_CHANNELS
+
+
+class IncrementalDTW(object):
+    """
+    Unconstrained DTW between a sign being recorded & every reference sign, advanced one frame
+    at a time: each recorded frame adds one row to the cumulative cost matrices of all the references
+    at once, so the distances are available as soon as the recording stops.
+    The distances are the ones of the numpy engine without window (sign_distance)
+
+    Params
+        reference_signs: pd.DataFrame with a sign_model column
+        metric: local distance, one of LOCAL_DISTANCES
+    Args
+        n_frames: number of frames of each embedding of the recorded sign
+        has_left_hand, has_right_hand: hands detected so far in the recorded sign
+    """
+
+    def __init__(self, reference_signs: pd.DataFrame, metric="manhattan"):
+        self.index = reference_signs.index
+        self.metric = metric
+
+        sign_models = list(reference_signs["sign_model"])
+        self.ref_has_left_hand = np.array([sign_model.has_left_hand for sign_model in sign_models], dtype=bool)
+        self.ref_has_right_hand = np.array([sign_model.has_right_hand for sign_model in sign_models], dtype=bool)
+
+        # Embeddings of the references padded to the longest one: (n_refs, max_len, n_features)
+        self.references, self.lengths = {}, {}
+        for channel in LEFT_CHANNELS + RIGHT_CHANNELS:
+            self.references[channel], self.lengths[channel] = pad_embeddings(
+                [getattr(sign_model, channel) for sign_model in sign_models]
+            )
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the recorded frames
+        """
+        self.has_left_hand = False
+        self.has_right_hand = False
+        self.n_frames = {channel: 0 for channel in self.references}
+
+        # Last row of the cumulative cost matrix of each reference, prefixed by the cell preceding (0, 0)
+        self.rows = {}
+        for channel, references in self.references.items():
+            rows = np.full((len(references), references.shape[1] + 1), np.inf)
+            rows[:, 0] = 0
+            self.rows[channel] = rows
+
+    def update(self, pose: np.ndarray, left_hand: np.ndarray, right_hand: np.ndarray):
+        """
+        Add a recorded frame (frames where a landmark set is not detected are skipped, as in SignModel)
+
+        :param pose, left_hand, right_hand: landmarks of the frame (see extract_landmarks)
+        """
+        pose = np.asarray(pose, dtype=float).reshape(1, 33, 3)
+        if pose.sum() != 0:
+            angles = PoseModel.get_angles(pose)[0]
+            self._advance("left_pose_embedding", angles[0:3])
+            self._advance("right_pose_embedding", angles[3:6])
+
+        left_hand = np.asarray(left_hand, dtype=float).reshape(1, 21, 3)
+        if left_hand.sum() != 0:
+            self.has_left_hand = True
+            self._advance("lh_embedding", HandModel.get_feature_vectors(left_hand)[0])
+
+        right_hand = np.asarray(right_hand, dtype=float).reshape(1, 21, 3)
+        if right_hand.sum() != 0:
+            self.has_right_hand = True
+            self._advance("rh_embedding", HandModel.get_feature_vectors(right_hand)[0])
+
+    def get_distances(self) -> np.ndarray:
+        """
+        :return: array (n_refs,) of the distances between the recorded frames & each reference sign,
+                 infinity if they don't use the same hands
+        """
+        distances = np.zeros(len(self.index))
+        channels = []
+        if self.has_left_hand:
+            channels += LEFT_CHANNELS
+        if self.has_right_hand:
+            channels += RIGHT_CHANNELS
+
+        for channel in channels:
+            lengths = self.lengths[channel]
+            if self.n_frames[channel] == 0:
+                # The DTW with an empty embedding is infinite
+                distances[:] = np.inf
+                continue
+            final = self.rows[channel][np.arange(len(lengths)), lengths]
+            distances += np.where(lengths > 0, final, np.inf)
+
+        mismatch = (self.ref_has_left_hand != self.has_left_hand) | (self.ref_has_right_hand != self.has_right_hand)
+        distances[mismatch] = np.inf
+        return distances
+
+    def dtw_distances(self, reference_signs: pd.DataFrame) -> pd.DataFrame:
+        """
+        :param reference_signs: the pd.DataFrame the matcher was created with (possibly sorted)
+        :return: Return a sign dictionary sorted by the distances from the recorded sign
+        """
+        reference_signs["distance"] = pd.Series(self.get_distances(), index=self.index)
+        return reference_signs.sort_values(by=["distance"])
+
+    def _advance(self, channel: str, frame: np.ndarray):
+        # Same precision as the embeddings of a SignModel
+        frame = frame.astype(EMBEDDING_DTYPE)
+        rows = self.rows[channel]
+        cost = frame_cost(self.references[channel] - frame, self.metric)
+
+        rows[:, 1:] = dtw_step(rows, cost)
+        rows[:, 0] = np.inf
+        self.n_frames[channel] += 1
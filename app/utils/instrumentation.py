@@ -0,0 +1,198 @@
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+
+# Number of durations kept by the rolling histogram of each span
+HISTOGRAM_WINDOW = 300
+
+# Quantiles exported for each span
+QUANTILES = [0.5, 0.95, 0.99]
+
+# Instrumentation enabled at startup when this environment variable is set to 1
+INSTRUMENTATION_ENV = "LIBRAS_INSTRUMENTATION"
+
+
+class Histogram(object):
+    """
+    Rolling latency histogram of a span: the last durations (for the quantiles)
+    and the number & total of all the durations
+    """
+
+    def __init__(self, window=HISTOGRAM_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self.durations = collections.deque(maxlen=window)
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.durations.append(duration)
+
+    def quantiles(self, quantiles=QUANTILES):
+        if not self.durations:
+            return [0.0] * len(quantiles)
+        return [float(value) for value in np.quantile(np.array(self.durations), quantiles)]
+
+
+class _Span(object):
+    """Context manager adding its duration to the histogram of a span"""
+
+    __slots__ = ("instrumentation", "name", "start")
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan(object):
+    """Span used when the instrumentation is disabled: it does nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Instrumentation(object):
+    """
+    Registry of the named spans (rolling latency histograms) & counters of the recognition path.
+    When it is disabled, span returns a shared no-op context manager and increment returns immediately
+
+        with INSTRUMENTATION.span("mediapipe"):
+            results = model.process(image)
+        INSTRUMENTATION.increment("frames_dropped")
+
+    Params
+        enabled: record the spans & counters
+        window: number of durations kept per span
+    """
+
+    def __init__(self, enabled=False, window=HISTOGRAM_WINDOW):
+        self.enabled = enabled
+        self.window = window
+        self.histograms = {}
+        self.counters = collections.Counter()
+
+        # The spans are recorded by the capture, inference & matching threads
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = collections.Counter()
+
+    def span(self, name: str):
+        """
+        :return: A context manager recording its duration in the histogram name
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def observe(self, name: str, duration: float):
+        """
+        Add a duration (in seconds) to the histogram name
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.window)
+            histogram.add(duration)
+
+    def increment(self, name: str, value=1):
+        if not self.enabled or not value:
+            return
+        with self.lock:
+            self.counters[name] += value
+
+    def get_report(self) -> dict:
+        """
+        :return: For each span, its count, total & quantiles in milliseconds, and the counters
+        """
+        with self.lock:
+            spans = {}
+            for name, histogram in sorted(self.histograms.items()):
+                report = {"count": histogram.count, "total_ms": histogram.total * 1000}
+                for quantile, value in zip(QUANTILES, histogram.quantiles()):
+                    report[f"p{round(quantile * 100)}_ms"] = value * 1000
+                spans[name] = report
+            return {"spans": spans, "counters": dict(sorted(self.counters.items()))}
+
+    def to_json(self) -> str:
+        return json.dumps(self.get_report(), indent=2)
+
+    def to_prometheus(self, prefix="libras") -> str:
+        """
+        :return: The spans (summaries in seconds) & counters in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            if self.histograms:
+                metric = f"{prefix}_stage_duration_seconds"
+                lines += [f"# HELP {metric} Duration of the stages of the recognition", f"# TYPE {metric} summary"]
+                for name, histogram in sorted(self.histograms.items()):
+                    for quantile, value in zip(QUANTILES, histogram.quantiles()):
+                        lines.append(f'{metric}{{stage="{name}",quantile="{quantile}"}} {value:.9f}')
+                    lines.append(f'{metric}_sum{{stage="{name}"}} {histogram.total:.9f}')
+                    lines.append(f'{metric}_count{{stage="{name}"}} {histogram.count}')
+
+            for name, value in sorted(self.counters.items()):
+                metric = f"{prefix}_{_metric_name(name)}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def get_overlay(self) -> list:
+        """
+        :return: Lines of text (p50 / p95 of each span & counters) to draw on the webcam frame
+        """
+        report = self.get_report()
+        lines = [
+            f"{name}: {span['p50_ms']:.1f} / {span['p95_ms']:.1f} ms"
+            for name, span in report["spans"].items()
+        ]
+        lines += [f"{name}: {value}" for name, value in report["counters"].items()]
+        return lines
+
+    def save(self, path: str):
+        """
+        Write the report in path: Prometheus text format if it ends with .prom, JSON otherwise
+        """
+        content = self.to_prometheus() if path.endswith(".prom") else self.to_json()
+        with open(path, "w") as file:
+            file.write(content)
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+# Registry shared by the whole recognition path
+INSTRUMENTATION = Instrumentation(enabled=os.environ.get(INSTRUMENTATION_ENV) == "1")
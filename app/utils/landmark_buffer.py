@@ -0,0 +1,67 @@
+import numpy as np
+
+from utils.landmark_utils import N_LANDMARKS, extract_landmarks
+
+
+class LandmarkBuffer(object):
+    """
+    Preallocated ring buffer of the landmarks of the last capacity frames (float32), filled as
+    the frames arrive. Each frame is written twice (at i and i + capacity) so that the last frames
+    are always contiguous and can be read without copy
+
+    Args
+        left_hand, right_hand: bool arrays, presence of each hand in each slot
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.landmarks = np.zeros((2 * capacity, N_LANDMARKS, 3), dtype=np.float32)
+        self.left_hand = np.zeros(2 * capacity, dtype=bool)
+        self.right_hand = np.zeros(2 * capacity, dtype=bool)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        self.count = 0
+
+    def append(self, results):
+        """
+        Convert the landmarks of a frame & add them to the buffer (the oldest frame is overwritten when it is full)
+
+        :param results: mediapipe output
+        """
+        slot = self.count % self.capacity
+        extract_landmarks(results, out=self.landmarks[slot])
+        self.landmarks[slot + self.capacity] = self.landmarks[slot]
+
+        self.left_hand[slot] = self.left_hand[slot + self.capacity] = bool(results.left_hand_landmarks)
+        self.right_hand[slot] = self.right_hand[slot + self.capacity] = bool(results.right_hand_landmarks)
+        self.count += 1
+
+    def get_frames(self) -> slice:
+        # Slots of the frames in the buffer, from the oldest to the newest
+        n_frames = len(self)
+        start = (self.count - n_frames) % self.capacity
+        return slice(start, start + n_frames)
+
+    def get_landmarks(self) -> np.ndarray:
+        """
+        :return: View (n_frame, N_LANDMARKS, 3) of the landmarks of the frames in the buffer (oldest first),
+                 only valid until the next append
+        """
+        return self.landmarks[self.get_frames()]
+
+    def get_last(self) -> np.ndarray:
+        """
+        :return: View (N_LANDMARKS, 3) of the landmarks of the last frame
+        """
+        return self.landmarks[(self.count - 1) % self.capacity]
+
+    def has_hands(self) -> bool:
+        """
+        :return: True if a hand is present in one of the frames of the buffer
+        """
+        frames = self.get_frames()
+        return bool(self.left_hand[frames].any() or self.right_hand[frames].any())
@@ -1,91 +1,146 @@
 import cv2
+import itertools
+import operator
 import os
 import numpy as np
 import pickle as pkl
 import mediapipe as mp
+from utils.file_utils import atomic_write
+from utils.frame_prefetcher import FramePrefetcher
+from utils.instrumentation import INSTRUMENTATION
 from utils.mediapipe_utils import mediapipe_detection
 
 
-def landmark_to_array(mp_landmark_list) -> np.ndarray:
-    """Return a np array of size (nb_keypoints x 3)"""
-    keypoints = []
-    for landmark in mp_landmark_list.landmark:
-        keypoints.append([landmark.x, landmark.y, landmark.z])
-    return np.nan_to_num(keypoints)
+# Position of the landmarks of each model in the array filled by extract_landmarks
+POSE_LANDMARKS = slice(0, 33)
+LEFT_HAND_LANDMARKS = slice(33, 54)
+RIGHT_HAND_LANDMARKS = slice(54, 75)
+N_LANDMARKS = 75
 
+_get_xyz = operator.attrgetter("x", "y", "z")
 
-def extract_landmarks(results):
+
+def landmark_to_array(mp_landmark_list, out=None) -> np.ndarray:
+    """Return a np array of size (nb_keypoints x 3)
+
+    :param out: array (nb_keypoints, 3) filled with the coordinates instead of a new array
+    """
+    landmarks = mp_landmark_list.landmark
+    if out is None:
+        out = np.empty((len(landmarks), 3))
+
+    # Read the coordinates straight into the array, without intermediate lists
+    out[:] = np.fromiter(
+        itertools.chain.from_iterable(map(_get_xyz, landmarks)), dtype=out.dtype, count=out.size
+    ).reshape(out.shape)
+
+    # MediaPipe rarely outputs NaN, the (slower) replacement only runs when needed
+    if not np.isfinite(out.sum()):
+        np.nan_to_num(out, copy=False)
+    return out
+
+
+def extract_landmarks(results, out=None):
     """Extract the results of both hands and convert them to a np array of size
-    if a hand doesn't appear, return an array of zeros
+    if a hand (or the pose) doesn't appear, its landmarks are set to zero
 
     :param results: mediapipe object that contains the 3D position of all keypoints
-    :return: 
-    - x_hands: Two np arrays of size (21, 3) corresponding to both hands
+    :param out: array (N_LANDMARKS, 3) filled with the landmarks (of any float dtype) instead of a new array
+    :return: Views of the landmarks in out:
     - pose: np arrays of size (33, 3) corresponding to pose
+    - x_hands: Two np arrays of size (21, 3) corresponding to both hands
     """
-    pose = landmark_to_array(results.pose_landmarks)
-
-    left_hand = np.zeros((21, 3))
-    if results.left_hand_landmarks:
-        left_hand = landmark_to_array(results.left_hand_landmarks)
+    if out is None:
+        out = np.empty((N_LANDMARKS, 3))
+
+    with INSTRUMENTATION.span("extract_landmarks"):
+        for landmark_list, landmarks in [
+            (results.pose_landmarks, out[POSE_LANDMARKS]),
+            (results.left_hand_landmarks, out[LEFT_HAND_LANDMARKS]),
+            (results.right_hand_landmarks, out[RIGHT_HAND_LANDMARKS]),
+        ]:
+            if landmark_list:
+                landmark_to_array(landmark_list, out=landmarks)
+            else:
+                landmarks.fill(0)
 
-    right_hand = np.zeros((21, 3))
-    if results.right_hand_landmarks:
-        right_hand = (landmark_to_array(results.right_hand_landmarks))
+    return out[POSE_LANDMARKS], out[LEFT_HAND_LANDMARKS], out[RIGHT_HAND_LANDMARKS]
 
-    return pose, left_hand, right_hand
 
+def save_landmarks_from_video(video_name, holistic=None, prefetch=True) -> int:
+    """
+    Extract the landmarks of a video and save them in the dataset folder
 
-def save_landmarks_from_video(video_name):
-    landmark_list = {"pose": [], "left_hand": [], "right_hand": []}
+    :param holistic: MediaPipe Holistic model reused between videos (a new one is created if None)
+    :param prefetch: decode the next frames in a background thread during the inference
+    :return: The number of frames of the video
+    """
     sign_name = video_name.split("-")[0]
+    landmarks = read_landmarks_from_video(
+        os.path.join("app", "data", "videos", sign_name, video_name + ".mp4"), holistic, prefetch
+    )
+
+    # Create the folder of the video data if it doesn't exists
+    data_path = os.path.join("app", "data", "dataset", sign_name, video_name)
+    os.makedirs(data_path, exist_ok=True)
+
+    # Saving the landmark_list in the correct folder, the pose last
+    # since its presence marks the video as extracted
+    save_array(list(landmarks[:, LEFT_HAND_LANDMARKS]), os.path.join(data_path, f"lh_{video_name}.pickle"))
+    save_array(list(landmarks[:, RIGHT_HAND_LANDMARKS]), os.path.join(data_path, f"rh_{video_name}.pickle"))
+    save_array(list(landmarks[:, POSE_LANDMARKS]), os.path.join(data_path, f"pose_{video_name}.pickle"))
+
+    return len(landmarks)
+
+
+def read_landmarks_from_video(video_path, holistic=None, prefetch=True) -> np.ndarray:
+    """
+    Extract the landmarks of each frame of a video
+
+    :param holistic: MediaPipe Holistic model reused between videos (a new one is created if None)
+    :param prefetch: decode the next frames in a background thread during the inference
+    :return: Array (n_frame, N_LANDMARKS, 3) of the landmarks (see extract_landmarks)
+    """
+    if holistic is None:
+        with mp.solutions.holistic.Holistic(
+            min_detection_confidence=0.5, min_tracking_confidence=0.5
+        ) as holistic:
+            return read_landmarks_from_video(video_path, holistic, prefetch)
+
+    landmark_list = []
 
     # Set the Video stream
-    cap = cv2.VideoCapture(
-        os.path.join("app", "data", "videos", sign_name, video_name + ".mp4")
-    )
-    with mp.solutions.holistic.Holistic(
-        min_detection_confidence=0.5, min_tracking_confidence=0.5
-    ) as holistic:
-        while cap.isOpened():
-            ret, frame = cap.read()
-
-            if ret:
-                # Crop the frame to define the region of interest
-                frame = frame[:960, :]
-
-                # Make detections
-                image, results = mediapipe_detection(frame, holistic)
-
-                # Store results
-                pose, left_hand, right_hand = extract_landmarks(results)
-                landmark_list["pose"].append(pose)
-                landmark_list["left_hand"].append(left_hand)
-                landmark_list["right_hand"].append(right_hand)
-            else:
-                break
-        cap.release()
+    cap = cv2.VideoCapture(video_path)
 
-    # Create the folder of the sign if it doesn't exists
-    path = os.path.join("app", "data", "dataset", sign_name)
-    if not os.path.exists(path):
-        os.mkdir(path)
+    # Crop the frames to define the region of interest
+    roi = np.s_[:960, :]
+    frames = FramePrefetcher(cap, roi=roi) if prefetch else _read_frames(cap, roi)
 
-    # Create the folder of the video data if it doesn't exists
-    data_path = os.path.join(path, video_name)
-    if not os.path.exists(data_path):
-        os.mkdir(data_path)
+    for frame in frames:
+        # Make detections (the image is not displayed, no need to convert it back to BGR)
+        _, results = mediapipe_detection(frame, holistic, convert_back=False)
+
+        # Store results
+        landmarks = np.empty((N_LANDMARKS, 3))
+        extract_landmarks(results, out=landmarks)
+        landmark_list.append(landmarks)
 
-    # Saving the landmark_list in the correct folder
-    save_array(landmark_list["pose"], os.path.join(data_path, f"pose_{video_name}.pickle"))
-    save_array(landmark_list["left_hand"], os.path.join(data_path, f"lh_{video_name}.pickle"))
-    save_array(landmark_list["right_hand"], os.path.join(data_path, f"rh_{video_name}.pickle"))
+    return np.array(landmark_list).reshape(-1, N_LANDMARKS, 3)
+
+
+def _read_frames(cap, roi):
+    """Read the frames of the video in the current thread"""
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame[roi]
+    cap.release()
 
 
 def save_array(arr, path):
-    file = open(path, "wb")
-    pkl.dump(arr, file)
-    file.close()
+    # A crash never leaves a partial pickle
+    atomic_write(path, lambda file: pkl.dump(arr, file))
 
 
 def load_array(path):
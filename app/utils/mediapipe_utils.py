@@ -1,13 +1,23 @@
 import cv2
 import mediapipe as mp
 
+from utils.instrumentation import INSTRUMENTATION
 
-def mediapipe_detection(image, model):
+
+def mediapipe_detection(image, model, convert_back=True):
+    """
+    :param image: BGR image
+    :param model: MediaPipe model
+    :param convert_back: if False, the returned image is left in RGB (useful when it is not displayed)
+    :return: The image & the results of the model
+    """
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     image.flags.writeable = False
-    results = model.process(image)
+    with INSTRUMENTATION.span("mediapipe"):
+        results = model.process(image)
     image.flags.writeable = True
-    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    if convert_back:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
     return image, results
 
 
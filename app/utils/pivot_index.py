@@ -0,0 +1,265 @@
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
+
+from models.sign_model import SignModel
+from utils.distance_matrix import get_distance_matrix_key
+from utils.dtw import sign_distance
+from utils.file_utils import atomic_write
+from utils.reference_index import REFERENCE_INDEX_PATH
+
+
+# Default location of the pivot table, next to the reference index
+PIVOT_INDEX_PATH = os.path.splitext(REFERENCE_INDEX_PATH)[0] + "_pivots.npz"
+
+# Number of pivots chosen in each hand configuration
+N_PIVOTS = 8
+
+# The lower bounds given by the pivots are divided by the slack (1 is the LAESA bound, which misses
+# neighbours since DTW isn't a metric: see pivot_miss_rate)
+SLACK = 1.5
+
+
+class PivotIndex(object):
+    """
+    Pivot table (LAESA) over the reference signs: a few pivots are chosen in each hand configuration
+    (farthest-first traversal) and the distances between every reference & the pivots of its configuration
+    are precomputed. A query computes its distances to the pivots only, and |d(q, p) - d(r, p)| / slack
+    is used as a lower bound of d(q, r) to skip the references which can't be among the k closest.
+
+    DTW doesn't satisfy the triangle inequality, so the bound is a heuristic: a larger slack prunes less
+    but misses fewer neighbours
+
+    Params
+        pivots: positions (in reference_signs) of the pivots
+        table: array (n_refs, n_pivots) of the distances between the references & the pivots,
+               infinity for the pivots of another hand configuration
+        has_left_hand, has_right_hand: bool arrays (n_refs,) of the hands of the references
+        index: index of reference_signs
+        slack: divisor of the lower bounds, at least 1
+        engine, dtw_kwargs: DTW options the table was computed with
+    """
+
+    def __init__(
+        self, pivots, table, has_left_hand, has_right_hand, index, slack=SLACK, engine="numpy", **dtw_kwargs
+    ):
+        if slack < 1:
+            raise ValueError(f"The slack of the pivot lower bounds must be at least 1, got {slack}")
+        self.pivots = np.asarray(pivots, dtype=int)
+        self.table = np.asarray(table, dtype=float)
+        self.has_left_hand = np.asarray(has_left_hand, dtype=bool)
+        self.has_right_hand = np.asarray(has_right_hand, dtype=bool)
+        self.index = index
+        self.slack = slack
+        self.engine = engine
+        self.dtw_kwargs = dtw_kwargs
+
+    @classmethod
+    def build(
+        cls, reference_signs: pd.DataFrame, n_pivots=N_PIVOTS, slack=SLACK, distance_matrix: np.ndarray = None,
+        engine="numpy", **dtw_kwargs
+    ):
+        """
+        Choose the pivots & compute the table: the first pivot of a hand configuration is its first
+        reference, each next one is the reference farthest from the pivots already chosen
+
+        :param distance_matrix: array (n_refs, n_refs) of the distances between the reference signs,
+                                in the order of the rows (the distances to the pivots are computed if None)
+        """
+        sign_models = reference_signs["sign_model"].values
+        has_left_hand = np.array([sign_model.has_left_hand for sign_model in sign_models], dtype=bool)
+        has_right_hand = np.array([sign_model.has_right_hand for sign_model in sign_models], dtype=bool)
+
+        pivots, columns = [], []
+        for hands in sorted(set(zip(has_left_hand, has_right_hand))):
+            group = np.flatnonzero((has_left_hand == hands[0]) & (has_right_hand == hands[1]))
+
+            # Distance between each reference of the group & its closest pivot
+            closest = np.full(len(group), np.inf)
+            pivot = group[0]
+            for _ in range(min(n_pivots, len(group))):
+                column = np.full(len(sign_models), np.inf)
+                if distance_matrix is not None:
+                    column[group] = distance_matrix[pivot, group]
+                else:
+                    column[group] = [
+                        sign_distance(sign_models[pivot], sign_models[ref_idx], engine=engine, **dtw_kwargs)
+                        for ref_idx in group
+                    ]
+                pivots.append(pivot)
+                columns.append(column)
+
+                closest = np.minimum(closest, column[group])
+                closest[np.isin(group, pivots)] = -np.inf
+
+                # Only pivots (or references at an infinite distance) are left
+                finite = np.isfinite(closest)
+                if not finite.any():
+                    break
+                pivot = group[np.argmax(np.where(finite, closest, -np.inf))]
+
+        table = np.stack(columns, axis=1) if columns else np.zeros((len(sign_models), 0))
+        return cls(
+            pivots, table, has_left_hand, has_right_hand, reference_signs.index, slack=slack, engine=engine,
+            **dtw_kwargs
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def search(self, recorded_sign: SignModel, reference_signs: pd.DataFrame, k=1):
+        """
+        Search of the k reference signs closest to the recorded sign
+
+        :param reference_signs: the pd.DataFrame the index was built with (possibly sorted)
+        :return: The reference signs sorted by distance (the pruned references have an infinite distance)
+                 & a dict counting the references discarded by each stage
+        """
+        if len(self) != len(reference_signs):
+            raise ValueError("The pivot index doesn't match the reference signs")
+        if not reference_signs.index.equals(self.index):
+            # The reference signs have been sorted since the index was built
+            reference_signs = reference_signs.loc[self.index]
+        sign_models = reference_signs["sign_model"].values
+
+        same_hands = (self.has_left_hand == recorded_sign.has_left_hand) & (
+            self.has_right_hand == recorded_sign.has_right_hand
+        )
+        distances = np.full(len(self), np.inf)
+
+        # Exact distances to the pivots of the same hand configuration
+        pivot_columns = np.flatnonzero(same_hands[self.pivots])
+        pivots = self.pivots[pivot_columns]
+        distances[pivots] = [
+            sign_distance(recorded_sign, sign_models[pivot], engine=self.engine, **self.dtw_kwargs)
+            for pivot in pivots
+        ]
+
+        # Lower bound of the other candidates (the infinite distances don't bound anything)
+        candidates = np.setdiff1d(np.flatnonzero(same_hands), pivots)
+        table = self.table[np.ix_(candidates, pivot_columns)]
+        query = distances[pivots]
+        with np.errstate(invalid="ignore"):
+            gaps = np.abs(query - table)
+        gaps[~(np.isfinite(query) & np.isfinite(table))] = 0
+        lower_bound = gaps.max(axis=1, initial=0) / self.slack
+
+        order = np.argsort(lower_bound, kind="stable")
+        candidates, lower_bound = candidates[order], lower_bound[order]
+
+        stats = {
+            "references": len(self),
+            "hand_mismatch": int(np.count_nonzero(~same_hands)),
+            "pivots": len(pivots),
+            "pruned": 0,
+            "dtw": 0,
+        }
+
+        # Max-heap (negated distances) of the k best distances found so far
+        best = []
+        for distance in distances[pivots]:
+            _push(best, distance, k)
+        for position, ref_idx in enumerate(candidates):
+            kth_best = -best[0] if len(best) == k else np.inf
+            if lower_bound[position] > kth_best:
+                stats["pruned"] = len(candidates) - position
+                break
+
+            distances[ref_idx] = sign_distance(
+                recorded_sign, sign_models[ref_idx], engine=self.engine, **self.dtw_kwargs
+            )
+            stats["dtw"] += 1
+            _push(best, distances[ref_idx], k)
+
+        reference_signs["distance"] = distances
+        return reference_signs.sort_values(by=["distance"]), stats
+
+    def save(self, path=PIVOT_INDEX_PATH, key=""):
+        """
+        :param key: identifier of the reference signs & DTW options (see get_distance_matrix_key)
+        """
+        # An interrupted build never leaves a partial index
+        atomic_write(path, lambda file: np.savez(
+            file, pivots=self.pivots, table=self.table, has_left_hand=self.has_left_hand,
+            has_right_hand=self.has_right_hand, key=np.array(key),
+        ))
+
+
+def load_pivot_index(
+    reference_signs: pd.DataFrame, path=PIVOT_INDEX_PATH, n_pivots=N_PIVOTS, slack=SLACK, engine="numpy",
+    **dtw_kwargs
+) -> PivotIndex:
+    """
+    Read the pivot index saved next to the reference index if it was built for the same reference signs,
+    number of pivots & DTW options, build (and save) it otherwise
+    """
+    key = f"{get_distance_matrix_key(reference_signs, engine, **dtw_kwargs)}-{n_pivots}"
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if str(data["key"]) == key:
+                return PivotIndex(
+                    data["pivots"], data["table"], data["has_left_hand"], data["has_right_hand"],
+                    reference_signs.index, slack=slack, engine=engine, **dtw_kwargs
+                )
+
+    print(f"\nBuilding the pivot index of the {len(reference_signs)} reference signs\n")
+    pivot_index = PivotIndex.build(reference_signs, n_pivots=n_pivots, slack=slack, engine=engine, **dtw_kwargs)
+    pivot_index.save(path, key)
+    return pivot_index
+
+
+def pivot_miss_rate(
+    distance_matrix: np.ndarray, reference_signs: pd.DataFrame, signers, slacks=(1.0, SLACK, 2.0),
+    n_pivots=N_PIVOTS, engine="fastdtw", **dtw_kwargs
+) -> pd.DataFrame:
+    """
+    Quality of the pivot search in the leave-one-signer-out cross validation: the pivot table of each
+    training set is built from the precomputed DTW distances, and the videos of the validation set are
+    searched with it (the DTW is computed, with the options of the matrix)
+
+    :param distance_matrix: array (n_refs, n_refs) in the order of the rows of reference_signs
+    :param slacks: slacks of the lower bounds evaluated
+    :return: pd.DataFrame indexed by slack: miss rate (proportion of the videos whose DTW nearest neighbour
+             isn't found), accuracy of the prediction & proportion of the DTW computed
+    """
+    signer_values = reference_signs["signer"].values
+    names = reference_signs["name"].values
+
+    report = pd.DataFrame(
+        0.0, index=pd.Index(slacks, name="slack"), columns=["miss_rate", "accuracy", "dtw_ratio"]
+    )
+    n_videos = 0
+    for signer in signers:
+        validation_idx = np.flatnonzero(signer_values == signer)
+        training_idx = np.flatnonzero(signer_values != signer)
+        training_set = reference_signs.iloc[training_idx]
+
+        pivot_index = PivotIndex.build(
+            training_set, n_pivots=n_pivots, distance_matrix=distance_matrix[np.ix_(training_idx, training_idx)],
+            engine=engine, **dtw_kwargs
+        )
+        for idx in validation_idx:
+            n_videos += 1
+            distances = distance_matrix[idx]
+            nearest = training_idx[np.argmin(distances[training_idx])]
+            for slack in slacks:
+                pivot_index.slack = slack
+                sorted_signs, stats = pivot_index.search(
+                    reference_signs["sign_model"].values[idx], training_set.copy(), k=1
+                )
+                closest = training_idx[training_set.index.get_loc(sorted_signs.index[0])]
+
+                # A closest reference at the same distance as the nearest neighbour isn't a miss
+                report.loc[slack, "miss_rate"] += distances[closest] > distances[nearest]
+                report.loc[slack, "accuracy"] += names[closest] == names[idx]
+                report.loc[slack, "dtw_ratio"] += (stats["pivots"] + stats["dtw"]) / max(len(training_idx), 1)
+    return report / max(n_videos, 1)
+
+
+def _push(best, distance, k):
+    if len(best) < k:
+        heapq.heappush(best, -distance)
+    elif distance < -best[0]:
+        heapq.heapreplace(best, -distance)
@@ -0,0 +1,250 @@
+import itertools
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from models.sign_model import SignModel
+from utils.distance_matrix import get_distance_matrix_key
+from utils.dtw import sign_distance
+from utils.file_utils import atomic_write
+from utils.reference_index import REFERENCE_INDEX_PATH
+
+
+# Default location of the prototypes, next to the reference index
+PROTOTYPE_INDEX_PATH = os.path.splitext(REFERENCE_INDEX_PATH)[0] + "_prototypes.npz"
+
+# Number of prototypes kept for each sign & hand configuration
+N_PROTOTYPES = 1
+
+# Number of best signs (according to their prototypes) whose other videos are then compared
+FALLBACK_SIGNS = 2
+
+
+def select_medoids(distances: np.ndarray, n_medoids: int) -> np.ndarray:
+    """
+    Greedy k-medoids: the first medoid minimizes the sum of the distances to the other elements,
+    each next one minimizes the sum of the distances between every element & its closest medoid
+
+    :param distances: array (n, n) of the DTW distances between the elements
+    :return: Positions of the min(n_medoids, n) medoids
+    """
+    # An infinite distance (empty embedding) must not make every sum infinite
+    finite = np.isfinite(distances)
+    distances = np.where(finite, distances, distances[finite].max(initial=0) * 2 + 1)
+
+    medoids = [int(np.argmin(distances.sum(axis=1)))]
+    closest = distances[medoids[0]]
+    while len(medoids) < min(n_medoids, len(distances)):
+        costs = np.minimum(closest[np.newaxis, :], distances).sum(axis=1)
+        costs[medoids] = np.inf
+        medoids.append(int(np.argmin(costs)))
+        closest = np.minimum(closest, distances[medoids[-1]])
+    return np.array(medoids, dtype=int)
+
+
+def get_sign_groups(reference_signs: pd.DataFrame) -> dict:
+    """
+    :return: dict (name, has_left_hand, has_right_hand) -> positions of the videos in reference_signs
+    """
+    sign_models = reference_signs["sign_model"].values
+    return pd.DataFrame({
+        "name": reference_signs["name"].values,
+        "has_left_hand": [sign_model.has_left_hand for sign_model in sign_models],
+        "has_right_hand": [sign_model.has_right_hand for sign_model in sign_models],
+    }).groupby(["name", "has_left_hand", "has_right_hand"]).indices
+
+
+def within_sign_distances(reference_signs: pd.DataFrame, engine="fastdtw", **dtw_kwargs) -> np.ndarray:
+    """
+    Distances between the videos of each sign & hand configuration (each pair is computed once),
+    the other pairs are infinite. The prototypes of any subset of the references (e.g. the training set
+    of a fold) can be selected from a slice of this matrix
+
+    :return: Symmetric array (n_refs, n_refs) in the order of the rows of reference_signs
+    """
+    sign_models = reference_signs["sign_model"].values
+    distances = np.full((len(sign_models), len(sign_models)), np.inf)
+    for positions in get_sign_groups(reference_signs).values():
+        distances[positions, positions] = 0
+        for i, j in itertools.combinations(positions, 2):
+            distances[i, j] = distances[j, i] = sign_distance(
+                sign_models[i], sign_models[j], engine=engine, **dtw_kwargs
+            )
+    return distances
+
+
+class PrototypeIndex(object):
+    """
+    Condensed reference set: the videos of each sign & hand configuration are represented by a few
+    prototypes (DTW medoids). A recorded sign is compared with the prototypes first, then with the other
+    videos of the fallback_signs best signs only
+
+    Params
+        prototypes: index labels (of reference_signs) of the prototypes
+        fallback_signs: number of best signs whose other videos are compared (0 only uses the prototypes)
+        engine, dtw_kwargs: DTW options
+    """
+
+    def __init__(self, prototypes, fallback_signs=FALLBACK_SIGNS, engine="fastdtw", **dtw_kwargs):
+        self.prototypes = pd.Index(prototypes)
+        self.fallback_signs = fallback_signs
+        self.engine = engine
+        self.dtw_kwargs = dtw_kwargs
+
+    @classmethod
+    def build(
+        cls, reference_signs: pd.DataFrame, n_prototypes=N_PROTOTYPES, distance_matrix: np.ndarray = None,
+        fallback_signs=FALLBACK_SIGNS, engine="fastdtw", **dtw_kwargs
+    ):
+        """
+        :param n_prototypes: number of prototypes of each sign & hand configuration (None keeps every video)
+        :param distance_matrix: array (n_refs, n_refs) of the distances between the reference signs,
+                                in the order of the rows (only the distances within a sign are read,
+                                see within_sign_distances, which computes them if None)
+        """
+        if n_prototypes is None:
+            return cls(reference_signs.index, fallback_signs, engine, **dtw_kwargs)
+
+        if distance_matrix is None:
+            distance_matrix = within_sign_distances(reference_signs, engine=engine, **dtw_kwargs)
+
+        prototypes = []
+        for positions in get_sign_groups(reference_signs).values():
+            distances = distance_matrix[np.ix_(positions, positions)]
+            prototypes += list(positions[select_medoids(distances, n_prototypes)])
+
+        return cls(reference_signs.index[np.sort(prototypes)], fallback_signs, engine, **dtw_kwargs)
+
+    def __len__(self):
+        return len(self.prototypes)
+
+    def search(self, recorded_sign: SignModel, reference_signs: pd.DataFrame):
+        """
+        :param reference_signs: the pd.DataFrame the prototypes were selected from (possibly sorted)
+        :return: The reference signs sorted by distance (the videos which were not compared have an
+                 infinite distance) & a dict counting the DTW computed
+        """
+        sign_models = reference_signs["sign_model"].values
+        names = reference_signs["name"].values
+        is_prototype = reference_signs.index.isin(self.prototypes)
+        same_hands = np.array([
+            sign_model.has_left_hand == recorded_sign.has_left_hand
+            and sign_model.has_right_hand == recorded_sign.has_right_hand
+            for sign_model in sign_models
+        ], dtype=bool)
+
+        distances = np.full(len(reference_signs), np.inf)
+        prototypes = np.flatnonzero(is_prototype & same_hands)
+        distances[prototypes] = [
+            sign_distance(recorded_sign, sign_models[position], engine=self.engine, **self.dtw_kwargs)
+            for position in prototypes
+        ]
+
+        # Other videos of the best signs according to their prototypes
+        best_signs = []
+        for position in prototypes[np.argsort(distances[prototypes], kind="stable")]:
+            if len(best_signs) == self.fallback_signs or not np.isfinite(distances[position]):
+                break
+            if names[position] not in best_signs:
+                best_signs.append(names[position])
+        fallback = np.flatnonzero(~is_prototype & same_hands & np.isin(names, best_signs))
+        distances[fallback] = [
+            sign_distance(recorded_sign, sign_models[position], engine=self.engine, **self.dtw_kwargs)
+            for position in fallback
+        ]
+
+        stats = {
+            "references": len(reference_signs),
+            "hand_mismatch": int(np.count_nonzero(~same_hands)),
+            "prototypes": len(prototypes),
+            "fallback": len(fallback),
+        }
+        reference_signs["distance"] = distances
+        return reference_signs.sort_values(by=["distance"]), stats
+
+    def save(self, reference_signs: pd.DataFrame, path=PROTOTYPE_INDEX_PATH, key=""):
+        """
+        :param reference_signs: the pd.DataFrame the prototypes were selected from (their positions are saved)
+        :param key: identifier of the reference signs, DTW options & number of prototypes
+        """
+        positions = reference_signs.index.get_indexer(self.prototypes)
+
+        # An interrupted build never leaves a partial file
+        atomic_write(path, lambda file: np.savez(file, prototypes=positions, key=np.array(key)))
+
+
+def load_prototype_index(
+    reference_signs: pd.DataFrame, path=PROTOTYPE_INDEX_PATH, n_prototypes=N_PROTOTYPES,
+    fallback_signs=FALLBACK_SIGNS, engine="fastdtw", **dtw_kwargs
+) -> PrototypeIndex:
+    """
+    Read the prototypes saved next to the reference index if they were selected from the same reference signs,
+    number of prototypes & DTW options, select (and save) them otherwise
+    """
+    key = f"{get_distance_matrix_key(reference_signs, engine, **dtw_kwargs)}-{n_prototypes}"
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if str(data["key"]) == key:
+                return PrototypeIndex(
+                    reference_signs.index[data["prototypes"]], fallback_signs, engine, **dtw_kwargs
+                )
+
+    print(f"\nSelecting the prototypes of the {len(reference_signs)} reference signs\n")
+    prototype_index = PrototypeIndex.build(
+        reference_signs, n_prototypes, fallback_signs=fallback_signs, engine=engine, **dtw_kwargs
+    )
+    prototype_index.save(reference_signs, path, key)
+    return prototype_index
+
+
+def condensation_report(
+    distance_matrix: np.ndarray, reference_signs: pd.DataFrame, signers, levels=(1, 2, 3, None),
+    fallback_signs=(0, FALLBACK_SIGNS), engine="fastdtw", **dtw_kwargs
+) -> pd.DataFrame:
+    """
+    Accuracy & latency of the leave-one-signer-out cross validation for each condensation level:
+    the prototypes of the training set are selected from the distance matrix, and the videos of the
+    validation set are matched with them (the DTW is actually computed to measure the latency)
+
+    :param distance_matrix: array (n_refs, n_refs) in the order of the rows of reference_signs
+    :param levels: numbers of prototypes per sign & hand configuration (None keeps every video)
+    :param fallback_signs: values of fallback_signs evaluated for each level
+    :return: pd.DataFrame indexed by (prototypes, fallback_signs): accuracy, number of references kept,
+             mean number of DTW & mean latency (ms) per video
+    """
+    signer_values = reference_signs["signer"].values
+    rows = []
+    for level in levels:
+        # Without condensation, every video is compared: the fallback is useless
+        for fallback in (fallback_signs if level is not None else [0]):
+            n_correct, n_videos, n_references, n_dtw, latency = 0, 0, 0, 0, 0.0
+            for signer in signers:
+                training_idx = np.flatnonzero(signer_values != signer)
+                training_set = reference_signs.iloc[training_idx]
+                validation_set = reference_signs.iloc[np.flatnonzero(signer_values == signer)]
+
+                prototype_index = PrototypeIndex.build(
+                    training_set, level, distance_matrix[np.ix_(training_idx, training_idx)],
+                    fallback_signs=fallback, engine=engine, **dtw_kwargs
+                )
+                n_references += len(prototype_index)
+                for sign_model, name in zip(validation_set["sign_model"], validation_set["name"]):
+                    start = time.perf_counter()
+                    sorted_signs, stats = prototype_index.search(sign_model, training_set.copy())
+                    latency += time.perf_counter() - start
+
+                    n_correct += sorted_signs["name"].iloc[0] == name
+                    n_dtw += stats["prototypes"] + stats["fallback"]
+                    n_videos += 1
+
+            rows.append({
+                "prototypes": "all" if level is None else level,
+                "fallback_signs": fallback,
+                "accuracy": n_correct / max(n_videos, 1),
+                "references": n_references / max(len(signers), 1),
+                "dtw_per_video": n_dtw / max(n_videos, 1),
+                "latency_ms": latency * 1000 / max(n_videos, 1),
+            })
+    return pd.DataFrame(rows).set_index(["prototypes", "fallback_signs"])
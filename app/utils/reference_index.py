@@ -0,0 +1,160 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from models.sign_model import EMBEDDING_NAMES, SignModel
+from utils.file_utils import atomic_write
+
+
+# Default location of the compiled reference index
+REFERENCE_INDEX_PATH = os.path.join("app", "data", "reference_index.bin")
+
+# Identifies a reference index file, followed by the length of its JSON header
+INDEX_MAGIC = b"LIBRASIX"
+INDEX_FORMAT_VERSION = 1
+
+# Data of the arrays is aligned on this number of bytes
+ALIGNMENT = 64
+
+
+def pack_reference_signs(reference_signs: pd.DataFrame, dtype=np.float32):
+    """
+    Convert the reference signs to flat arrays: for each embedding, the frames of every sign are
+    concatenated in an array (total_frames, n_features) of the given dtype and an offset table (n_signs + 1,)
+    gives the first frame of each sign
+
+    :return: A dict of arrays & a dict of metadata (names, signers, video ids)
+    """
+    sign_models = list(reference_signs["sign_model"])
+
+    arrays = {}
+    for embedding_name in EMBEDDING_NAMES:
+        embeddings = [np.asarray(getattr(sign_model, embedding_name), dtype=dtype) for sign_model in sign_models]
+        lengths = [len(embedding) for embedding in embeddings]
+
+        offsets = np.zeros(len(embeddings) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+
+        arrays[embedding_name] = np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=dtype)
+        arrays[f"{embedding_name}_offsets"] = offsets
+
+    arrays["has_left_hand"] = np.array([sign_model.has_left_hand for sign_model in sign_models], dtype=bool)
+    arrays["has_right_hand"] = np.array([sign_model.has_right_hand for sign_model in sign_models], dtype=bool)
+
+    metadata = {
+        "names": [str(name) for name in reference_signs["name"]],
+        "signers": [str(signer) for signer in reference_signs["signer"]],
+        "video_ids": [str(video_id) for video_id in reference_signs["video_id"]],
+    }
+    return arrays, metadata
+
+
+def unpack_reference_signs(arrays, metadata) -> pd.DataFrame:
+    """
+    Inverse of pack_reference_signs: the embeddings of the SignModel objects are views of the arrays
+    """
+    sign_models = []
+    for idx in range(len(metadata["video_ids"])):
+        embeddings = {}
+        for embedding_name in EMBEDDING_NAMES:
+            offsets = arrays[f"{embedding_name}_offsets"]
+            embeddings[embedding_name] = arrays[embedding_name][offsets[idx]:offsets[idx + 1]]
+
+        sign_models.append(SignModel.from_embeddings(
+            has_left_hand=arrays["has_left_hand"][idx], has_right_hand=arrays["has_right_hand"][idx], **embeddings
+        ))
+
+    return pd.DataFrame({
+        "name": metadata["names"],
+        "sign_model": sign_models,
+        "signer": metadata["signers"],
+        "distance": [0] * len(sign_models),
+        "video_id": metadata["video_ids"],
+    }, dtype=object)
+
+
+def save_reference_index(reference_signs: pd.DataFrame, path=REFERENCE_INDEX_PATH, **metadata):
+    """
+    Write the reference signs in a single memory-mappable file:
+    INDEX_MAGIC, length of the header (uint64), JSON header, then the aligned data of the arrays
+
+    :param metadata: additional values stored in the header
+    """
+    arrays, header = pack_reference_signs(reference_signs)
+    header.update(metadata)
+    header["format_version"] = INDEX_FORMAT_VERSION
+
+    header["arrays"], data_size = get_array_layout(arrays)
+
+    encoded_header = json.dumps(header).encode("utf-8")
+    data_start = _aligned(len(INDEX_MAGIC) + 8 + len(encoded_header))
+
+    def write_index(file):
+        file.write(INDEX_MAGIC)
+        file.write(np.uint64(len(encoded_header)).tobytes())
+        file.write(encoded_header)
+        for name, array in arrays.items():
+            file.seek(data_start + header["arrays"][name]["offset"])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_start + data_size)
+
+    # An interrupted build never leaves a partial index
+    atomic_write(path, write_index)
+
+
+def read_index_header(path=REFERENCE_INDEX_PATH):
+    """
+    :return: The JSON header of the index & the position of its data section in the file
+    """
+    with open(path, "rb") as file:
+        if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a reference index")
+        header_length = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(header_length).decode("utf-8"))
+
+    if header.get("format_version") != INDEX_FORMAT_VERSION:
+        raise ValueError(f"{path} has an unsupported format version")
+    return header, _aligned(len(INDEX_MAGIC) + 8 + header_length)
+
+
+def load_reference_index(path=REFERENCE_INDEX_PATH) -> pd.DataFrame:
+    """
+    Map the index in memory: the embeddings are read-only views of the file
+    """
+    header, data_start = read_index_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+
+    return unpack_reference_signs(get_array_views(data[data_start:], header["arrays"]), header)
+
+
+def get_array_layout(arrays):
+    """
+    :param arrays: dict of arrays stored one after the other (aligned on ALIGNMENT bytes)
+    :return: The dtype, shape & offset of each array & the total size in bytes
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += _aligned(array.nbytes)
+    return layout, offset
+
+
+def get_array_views(data: np.ndarray, layout):
+    """
+    :param data: uint8 array of the arrays described by layout (see get_array_layout)
+    :return: A dict of the arrays, views of data
+    """
+    arrays = {}
+    for name, description in layout.items():
+        dtype = np.dtype(description["dtype"])
+        start = description["offset"]
+        count = int(np.prod(description["shape"]))
+        arrays[name] = data[start:start + count * dtype.itemsize].view(dtype).reshape(description["shape"])
+    return arrays
+
+
+def _aligned(size: int) -> int:
+    return -(-size // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,164 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from models.sign_model import EMBEDDING_NAMES, SignModel
+from utils.distance_matrix import get_distance_matrix_key
+from utils.dtw import dtw_distances, sign_distance
+from utils.reference_index import (
+    REFERENCE_INDEX_PATH, load_reference_index, read_index_header, save_reference_index
+)
+
+
+# Number of references compared at full resolution by the multi-resolution search
+REFINE_K = 10
+
+# Default location of the downsampled reference signs, next to the reference index
+DOWNSAMPLED_INDEX_PATH = os.path.splitext(REFERENCE_INDEX_PATH)[0] + "_downsampled.bin"
+
+
+def paa(embedding: np.ndarray, target_len=None, stride=None) -> np.ndarray:
+    """
+    Piecewise aggregate approximation: the frames are averaged over consecutive segments
+
+    :param embedding: array (n_frame, n_features)
+    :param target_len: number of segments of equal length (the embeddings shorter than target_len are kept)
+    :param stride: number of frames of each segment (the last one may be shorter)
+    :return: array (n_segment, n_features) of the mean of each segment
+    """
+    if (target_len is None) == (stride is None):
+        raise ValueError("Exactly one of target_len & stride must be given")
+
+    embedding = np.asarray(embedding)
+    n_frames = len(embedding)
+    if target_len is not None:
+        if n_frames <= target_len:
+            return embedding
+        starts = (np.arange(target_len) * n_frames) // target_len
+    else:
+        if stride <= 1 or n_frames == 0:
+            return embedding
+        starts = np.arange(0, n_frames, stride)
+
+    counts = np.diff(np.append(starts, n_frames))
+    sums = np.add.reduceat(embedding, starts, axis=0, dtype=np.float64)
+    return (sums / counts[:, np.newaxis]).astype(embedding.dtype)
+
+
+class Resolution(object):
+    """
+    Temporal resolution of the embeddings, reduced with PAA. It must be applied to the reference signs
+    (once, when they are loaded) and to every recorded sign, so that both are compared at the same resolution
+
+    Params
+        target_len: number of frames of each embedding
+        stride: number of frames averaged together
+    """
+
+    def __init__(self, target_len=None, stride=None):
+        if (target_len is None) == (stride is None):
+            raise ValueError("Exactly one of target_len & stride must be given")
+        if (target_len if target_len is not None else stride) < 1:
+            raise ValueError(f"The resolution must keep at least 1 frame, got target_len={target_len}, stride={stride}")
+        self.target_len = target_len
+        self.stride = stride
+
+    def __repr__(self):
+        if self.target_len is not None:
+            return f"Resolution(target_len={self.target_len})"
+        return f"Resolution(stride={self.stride})"
+
+    def downsample(self, sign_model: SignModel) -> SignModel:
+        return SignModel.from_embeddings(
+            has_left_hand=sign_model.has_left_hand, has_right_hand=sign_model.has_right_hand,
+            **{
+                embedding_name: paa(getattr(sign_model, embedding_name), self.target_len, self.stride)
+                for embedding_name in EMBEDDING_NAMES
+            }
+        )
+
+    def downsample_reference_signs(self, reference_signs: pd.DataFrame) -> pd.DataFrame:
+        """
+        :return: A copy of the reference signs with downsampled SignModel objects
+        """
+        reference_signs = reference_signs.copy()
+        reference_signs["sign_model"] = [self.downsample(sign_model) for sign_model in reference_signs["sign_model"]]
+        return reference_signs
+
+
+def load_downsampled_reference_signs(
+    reference_signs: pd.DataFrame, resolution: Resolution, path=DOWNSAMPLED_INDEX_PATH
+) -> pd.DataFrame:
+    """
+    Read the downsampled reference signs saved next to the reference index if they were downsampled from
+    the same reference signs & resolution, downsample (and save) them otherwise
+
+    :return: The downsampled reference signs, with the index of reference_signs
+    """
+    key = f"{get_distance_matrix_key(reference_signs)}-{resolution!r}"
+    if os.path.exists(path):
+        try:
+            header, _ = read_index_header(path)
+        except ValueError:
+            header = {}
+        if header.get("key") == key:
+            return load_reference_index(path).set_axis(reference_signs.index)
+
+    print(f"\nDownsampling the {len(reference_signs)} reference signs to {resolution}\n")
+    downsampled_signs = resolution.downsample_reference_signs(reference_signs)
+    save_reference_index(downsampled_signs, path, key=key)
+    return downsampled_signs
+
+
+class MultiResolutionMatcher(object):
+    """
+    Coarse-to-fine search: the recorded sign is compared with every reference sign at a reduced resolution,
+    then the refine_k closest ones are compared at full resolution (the others keep an infinite distance)
+
+    Params
+        reference_signs: pd.DataFrame of the reference signs at full resolution
+        resolution: Resolution of the coarse search
+        refine_k: number of references compared at full resolution
+        engine, dtw_kwargs: DTW options
+    """
+
+    def __init__(
+        self, reference_signs: pd.DataFrame, resolution: Resolution, refine_k=REFINE_K, engine="fastdtw",
+        **dtw_kwargs
+    ):
+        self.resolution = resolution
+        self.refine_k = refine_k
+        self.engine = engine
+        self.dtw_kwargs = dtw_kwargs
+
+        # The coarse embeddings are computed once
+        self.coarse_signs = resolution.downsample_reference_signs(reference_signs[["sign_model"]])
+
+    def search(self, recorded_sign: SignModel, reference_signs: pd.DataFrame):
+        """
+        :param reference_signs: the pd.DataFrame the matcher was created with (possibly sorted)
+        :return: The reference signs sorted by distance & a dict counting the references skipped (other hands)
+                 and the DTW computed at each resolution
+        """
+        coarse_signs = dtw_distances(
+            self.resolution.downsample(recorded_sign), self.coarse_signs.copy(), engine=self.engine,
+            **self.dtw_kwargs
+        )
+        finite = np.isfinite(coarse_signs["distance"].values)
+        candidates = coarse_signs.index[finite][:self.refine_k]
+
+        distances = pd.Series(np.inf, index=reference_signs.index)
+        for label in candidates:
+            distances[label] = sign_distance(
+                recorded_sign, reference_signs.at[label, "sign_model"], engine=self.engine, **self.dtw_kwargs
+            )
+
+        stats = {
+            "references": len(reference_signs),
+            "skipped": int(np.count_nonzero(~finite)),
+            "coarse": int(np.count_nonzero(finite)),
+            "refined": len(candidates),
+        }
+        reference_signs["distance"] = distances
+        return reference_signs.sort_values(by=["distance"]), stats
@@ -0,0 +1,83 @@
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from utils.reference_index import get_array_layout, get_array_views, pack_reference_signs, unpack_reference_signs
+
+
+# Shared memory blocks attached by this process, kept open as long as the process uses the reference signs
+_attached_blocks = {}
+
+
+class SharedReferences(object):
+    """
+    Reference signs published once in shared memory as flat arrays with offset tables (see pack_reference_signs).
+    The worker processes attach them with attach_reference_signs: the embeddings are read-only views
+    of the shared block, so the memory used doesn't grow with the number of workers
+
+    Params
+        reference_signs: pd.DataFrame of the reference signs
+    Args
+        descriptor: small picklable dict sent to the workers (name of the block, layout of the arrays, metadata)
+    """
+
+    def __init__(self, reference_signs: pd.DataFrame):
+        # The embeddings keep their dtype so that the workers compute the same distances as this process
+        sign_models = reference_signs["sign_model"].values
+        dtype = np.asarray(sign_models[0].lh_embedding).dtype if len(sign_models) > 0 else np.float32
+        arrays, metadata = pack_reference_signs(reference_signs, dtype=dtype)
+        layout, size = get_array_layout(arrays)
+
+        self.block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        views = get_array_views(np.frombuffer(self.block.buf, dtype=np.uint8), layout)
+        for name, view in views.items():
+            view[...] = arrays[name]
+
+        self.descriptor = {"name": self.block.name, "arrays": layout, "metadata": metadata}
+
+    def close(self):
+        """
+        Release the shared memory (the workers must not use the reference signs anymore)
+        """
+        self.block.close()
+        self.block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_reference_signs(descriptor) -> pd.DataFrame:
+    """
+    :param descriptor: SharedReferences.descriptor
+    :return: pd.DataFrame of the reference signs whose embeddings are read-only views of the shared memory
+    """
+    block = _attached_blocks.get(descriptor["name"])
+    if block is None:
+        block = _attach_block(descriptor["name"])
+        _attached_blocks[descriptor["name"]] = block
+
+    data = np.frombuffer(block.buf, dtype=np.uint8)
+    data.flags.writeable = False
+    return unpack_reference_signs(get_array_views(data, descriptor["arrays"]), descriptor["metadata"])
+
+
+def _attach_block(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach a block without registering it with the resource tracker of this process: only the process
+    which created it unlinks it (a process with its own tracker would unlink it when it exits)
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    # Before Python 3.13, SharedMemory always registers the block it opens
+    register = resource_tracker.register
+    resource_tracker.register = lambda resource_name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
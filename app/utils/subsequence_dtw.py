@@ -0,0 +1,56 @@
+import numpy as np
+
+from utils.dtw import dtw_step, frame_cost
+
+
+def subsequence_dtw(templates: np.ndarray, lengths: np.ndarray, stream: np.ndarray, metric="manhattan") -> np.ndarray:
+    """
+    Open-begin & open-end DTW: cost of the best alignment of each whole template with any
+    subsequence of the stream. The cumulative cost matrices of all the templates are filled
+    together, one template frame at a time
+
+    :param templates: array (n_templates, max_len, n_features) of embeddings padded with zeros
+    :param lengths: int array (n_templates,) of the lengths of the templates
+    :param stream: array (n_frame, n_features)
+    :param metric: local distance, one of LOCAL_DISTANCES
+    :return: array (n_templates,) of the costs, infinity for an empty template or stream
+    """
+    costs = np.full(len(templates), np.inf)
+    if len(stream) == 0:
+        return costs
+
+    # The virtual row preceding the first template frame costs 0 everywhere: the match can start at any frame
+    rows = np.zeros((len(templates), len(stream) + 1))
+    for i in range(templates.shape[1]):
+        # Only the templates that still have frames are advanced
+        active = np.flatnonzero(lengths > i)
+        if len(active) == 0:
+            break
+
+        cost = frame_cost(templates[active, i, np.newaxis, :] - stream[np.newaxis, :, :], metric)
+        rows[active, 1:] = dtw_step(rows[active], cost)
+        rows[active, 0] = np.inf
+
+        # The match can stop at any frame of the stream
+        ended = active[lengths[active] == i + 1]
+        costs[ended] = rows[ended, 1:].min(axis=-1)
+    return costs
+
+
+def lb_subsequence(templates: np.ndarray, lengths: np.ndarray, stream: np.ndarray, metric="manhattan") -> np.ndarray:
+    """
+    Lower bound of subsequence_dtw: every template frame is aligned with at least one frame of
+    the stream, which costs at least its distance to the bounding box of the stream
+
+    :return: array (n_templates,) of the lower bounds
+    """
+    if len(stream) == 0:
+        return np.full(len(templates), np.inf)
+
+    lower, upper = stream.min(axis=0), stream.max(axis=0)
+    excess = np.maximum(templates - upper, 0) + np.maximum(lower - templates, 0)
+    bounds = frame_cost(excess, metric)
+
+    # Ignore the padding frames
+    bounds[np.arange(templates.shape[1]) >= lengths[:, np.newaxis]] = 0
+    return np.where(lengths > 0, bounds.sum(axis=-1), np.inf)
@@ -0,0 +1,218 @@
+import collections
+import queue
+import threading
+import time
+
+import cv2
+
+from sign_recorder import SignRecorder
+from utils.instrumentation import INSTRUMENTATION
+from utils.mediapipe_utils import mediapipe_detection
+from webcam_manager import WebcamManager
+
+
+# Number of items waiting between two stages
+QUEUE_SIZE = 2
+
+# Number of frames used to compute the FPS of a stage
+FPS_WINDOW = 30
+
+
+class FrameQueue(object):
+    """
+    Bounded queue between two stages of the pipeline. When it is full, put either drops the
+    oldest item (so that the next stage always works on the freshest frame) or waits for a free slot
+
+    Args
+        dropped: number of items dropped
+    """
+
+    def __init__(self, max_size=QUEUE_SIZE, drop_oldest=True):
+        self.max_size = max_size
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+
+    def put(self, item, timeout=None):
+        """
+        :return: False if the queue was still full after timeout seconds (item not added)
+        """
+        with self.condition:
+            if len(self.items) >= self.max_size:
+                if self.drop_oldest:
+                    self.items.popleft()
+                    self.dropped += 1
+                    INSTRUMENTATION.increment("frames_dropped")
+                elif not self.condition.wait_for(lambda: len(self.items) < self.max_size, timeout):
+                    return False
+
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        :raise queue.Empty: if the queue was still empty after timeout seconds
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0, timeout):
+                raise queue.Empty
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StageStats(object):
+    """
+    Rolling frame rate of a stage of the pipeline
+    """
+
+    def __init__(self, name: str, window=FPS_WINDOW):
+        self.name = name
+        self.count = 0
+        self.timestamps = collections.deque(maxlen=window)
+
+    def tick(self):
+        self.count += 1
+        self.timestamps.append(time.perf_counter())
+
+    @property
+    def fps(self) -> float:
+        if len(self.timestamps) < 2:
+            return 0.0
+        return (len(self.timestamps) - 1) / (self.timestamps[-1] - self.timestamps[0])
+
+
+class OnlinePipeline(object):
+    """
+    Webcam recognition split in three stages connected by bounded queues:
+    a capture thread reads the camera, an inference thread runs MediaPipe & the SignRecorder,
+    and the calling thread draws the results & handles the keyboard (OpenCV windows must stay
+    in the main thread)
+
+    Params
+        cap: opened cv2.VideoCapture
+        holistic: MediaPipe Holistic model
+        drop_oldest: when a queue is full, drop its oldest frame instead of waiting
+        show_stats: draw the FPS of each stage & the queue depths on the frame
+    """
+
+    def __init__(
+        self,
+        cap: cv2.VideoCapture,
+        holistic,
+        sign_recorder: SignRecorder,
+        webcam_manager: WebcamManager,
+        queue_size=QUEUE_SIZE,
+        drop_oldest=True,
+        show_stats=False,
+    ):
+        self.cap = cap
+        self.holistic = holistic
+        self.sign_recorder = sign_recorder
+        self.webcam_manager = webcam_manager
+        self.show_stats = show_stats
+
+        self.frames = FrameQueue(queue_size, drop_oldest)
+        self.results = FrameQueue(queue_size, drop_oldest)
+        self.stats = {name: StageStats(name) for name in ["capture", "inference", "display"]}
+
+        # The SignRecorder is used by the inference thread & by the keyboard handling
+        self.recorder_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self):
+        """
+        Run the pipeline until "q" is pressed or the camera stops
+        """
+        threads = [
+            threading.Thread(target=self._capture, daemon=True),
+            threading.Thread(target=self._inference, daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._display()
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            print(self.get_report())
+
+    def get_report(self) -> str:
+        lines = [f"{stats.name}: {stats.count} frames, {stats.fps:.1f} FPS" for stats in self.stats.values()]
+        lines.append(
+            f"queues: {len(self.frames)} frames ({self.frames.dropped} dropped), "
+            f"{len(self.results)} results ({self.results.dropped} dropped)"
+        )
+        return "\n".join(lines)
+
+    def _capture(self):
+        while not self.stopped.is_set() and self.cap.isOpened():
+            with INSTRUMENTATION.span("frame_read"):
+                ret, frame = self.cap.read()
+            if not ret:
+                break
+
+            self.stats["capture"].tick()
+            self._put(self.frames, frame)
+        self.stopped.set()
+
+    def _inference(self):
+        while not self.stopped.is_set():
+            try:
+                frame = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            # Make detections (the drawing is done on the original BGR frame)
+            _, results = mediapipe_detection(frame, self.holistic, convert_back=False)
+
+            # Process results
+            with self.recorder_lock:
+                sign_detected, is_recording = self.sign_recorder.process_results(results)
+                is_matching = self.sign_recorder.is_matching
+
+            self.stats["inference"].tick()
+            self._put(self.results, (frame, results, sign_detected, is_recording, is_matching))
+
+    def _display(self):
+        while not self.stopped.is_set():
+            try:
+                frame, results, sign_detected, is_recording, is_matching = self.results.get(timeout=0.1)
+            except queue.Empty:
+                frame = None
+
+            if frame is not None:
+                # Update the frame (draw landmarks & display result)
+                overlay = self._get_overlay() if self.show_stats or INSTRUMENTATION.enabled else None
+                self.webcam_manager.update(
+                    frame, results, sign_detected, is_recording, overlay, is_matching=is_matching
+                )
+                self.stats["display"].tick()
+
+            pressedKey = cv2.waitKey(1) & 0xFF
+            if pressedKey == ord("r"):  # Record pressing r
+                with self.recorder_lock:
+                    self.sign_recorder.record()
+            elif pressedKey == ord("q"):  # Break pressing q
+                break
+
+    def _get_overlay(self):
+        lines = [f"{stats.name}: {stats.fps:.1f} FPS" for stats in self.stats.values()]
+        lines.append(f"queues: {len(self.frames)} / {len(self.results)}")
+        if INSTRUMENTATION.enabled:
+            lines += INSTRUMENTATION.get_overlay()
+        return lines
+
+    def _put(self, frame_queue: FrameQueue, item):
+        # Wait for a free slot (if the queue doesn't drop frames) unless the pipeline stopped
+        while not self.stopped.is_set():
+            if frame_queue.put(item, timeout=0.1):
+                return
@@ -2,9 +2,12 @@ import cv2
 import numpy as np
 import mediapipe as mp
 
+from utils.instrumentation import INSTRUMENTATION
+
 
 WHITE_COLOR = (245, 242, 226)
 RED_COLOR = (25, 35, 240)
+ORANGE_COLOR = (0, 165, 255)
 
 HEIGHT = 600
 
@@ -18,31 +21,46 @@ class WebcamManager(object):
         self.sign_detected = ""
 
     def update(
-        self, frame: np.ndarray, results, sign_detected: str, is_recording: bool
+        self, frame: np.ndarray, results, sign_detected: str, is_recording: bool, overlay=None,
+        is_matching=False
     ):
-        self.sign_detected = sign_detected
-
-        # Draw landmarks
-        self.draw_landmarks(frame, results)
-
-        WIDTH = int(HEIGHT * len(frame[0]) / len(frame))
-        # Resize frame
-        frame = cv2.resize(frame, (WIDTH, HEIGHT), interpolation=cv2.INTER_AREA)
-
-        # Flip the image vertically for mirror effect
-        frame = cv2.flip(frame, 1)
+        """
+        :param is_matching: the recorded sign is being compared to the reference signs
+        :param overlay: optional list of lines of text drawn in the top left corner
+        """
+        with INSTRUMENTATION.span("display"):
+            self.sign_detected = sign_detected
+
+            # Draw landmarks
+            self.draw_landmarks(frame, results)
+
+            WIDTH = int(HEIGHT * len(frame[0]) / len(frame))
+            # Resize frame
+            frame = cv2.resize(frame, (WIDTH, HEIGHT), interpolation=cv2.INTER_AREA)
+
+            # Flip the image vertically for mirror effect
+            frame = cv2.flip(frame, 1)
+
+            # Write result if there is
+            frame = self.draw_text(frame)
+
+            # Chose circle color
+            color = WHITE_COLOR
+            if is_recording:
+                color = RED_COLOR
+            elif is_matching:
+                color = ORANGE_COLOR
+
+            # Update the frame
+            cv2.circle(frame, (30, 30), 20, color, -1)
+            if overlay:
+                self.draw_overlay(frame, overlay)
+            cv2.imshow("OpenCV Feed", frame)
 
-        # Write result if there is
-        frame = self.draw_text(frame)
-
-        # Chose circle color
-        color = WHITE_COLOR
-        if is_recording:
-            color = RED_COLOR
-
-        # Update the frame
-        cv2.circle(frame, (30, 30), 20, color, -1)
-        cv2.imshow("OpenCV Feed", frame)
+    @staticmethod
+    def draw_overlay(frame, lines, font=cv2.FONT_HERSHEY_SIMPLEX, font_size=0.5, line_height=20):
+        for idx, line in enumerate(lines):
+            cv2.putText(frame, line, (10, 70 + idx * line_height), font, font_size, WHITE_COLOR, 1)
 
     def draw_text(
         self,
@@ -0,0 +1,350 @@
+"""
+Recognition service: the reference signs are loaded once and the landmark sequences sent over
+HTTP (POST /recognize) or WebSocket (/ws) are recognized. The requests arriving within max_delay
+seconds are matched together in a single vectorized DTW pass (see MicroBatcher & BatchMatcher)
+
+    python server/recognition_server.py --port 8080
+
+A request is a JSON object {"landmarks": [...], "top_k": 5, "id": ...} where landmarks is an array
+(n_frame, 75, 3) of the pose (33), left hand (21) & right hand (21) landmarks of each frame, set to zero
+when they are not detected (the layout of extract_landmarks)
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from aiohttp import WSMsgType, web
+
+# The recognition code is in the app directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from idk_name import get_sign_predicted_from_names  # noqa: E402
+from models.sign_model import EMBEDDING_VERSION, SignModel  # noqa: E402
+from utils.batch_dtw import BatchMatcher  # noqa: E402
+from utils.dataset_utils import load_dataset, load_reference_signs  # noqa: E402
+from utils.instrumentation import INSTRUMENTATION  # noqa: E402
+from utils.landmark_utils import (  # noqa: E402
+    LEFT_HAND_LANDMARKS, N_LANDMARKS, POSE_LANDMARKS, RIGHT_HAND_LANDMARKS
+)
+
+
+# Maximum number of requests matched together
+MAX_BATCH_SIZE = 16
+
+# Time (in seconds) the first request of a batch waits for other requests
+MAX_DELAY = 0.005
+
+# Number of requests kept to compute the latency percentiles
+LATENCY_WINDOW = 1000
+
+# Default number of closest reference signs returned
+TOP_K = 5
+
+RECOGNIZER = web.AppKey("recognizer", object)
+
+
+class MicroBatcher(object):
+    """
+    Gathers the items submitted concurrently: the first item waits at most max_delay seconds for
+    other ones, then the whole batch is processed by process_batch in a worker thread (so that the
+    event loop keeps receiving requests, which form the next batch)
+
+    Params
+        process_batch: function list of items -> list of results (same order)
+        max_batch_size: maximum number of items of a batch
+        max_delay: maximum time in seconds the first item of a batch waits for the others
+    """
+
+    def __init__(self, process_batch, max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_DELAY):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self.queue = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, item):
+        """
+        :return: The result of the item & the size of the batch it was processed in
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # The requests that were cancelled while waiting are not processed
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, [item for item, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result((result, len(batch)))
+
+
+class LatencyStats(object):
+    """
+    Rolling statistics of the last requests: total latency, matching time of their batch & batch size
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.count = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.matching_times = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+
+    def add(self, latency: float, matching_time: float, batch_size: int):
+        self.count += 1
+        self.latencies.append(latency)
+        self.matching_times.append(matching_time)
+        self.batch_sizes.append(batch_size)
+
+    def get_report(self) -> dict:
+        report = {"count": self.count, "window": len(self.latencies)}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            report.update({
+                "latency_p50_ms": float(np.percentile(latencies, 50)),
+                "latency_p95_ms": float(np.percentile(latencies, 95)),
+                "latency_max_ms": float(latencies.max()),
+                "matching_p50_ms": float(np.percentile(np.array(self.matching_times) * 1000, 50)),
+                "mean_batch_size": float(np.mean(self.batch_sizes)),
+            })
+        return report
+
+
+class Recognizer(object):
+    """
+    Matches batches of landmark sequences with the reference signs
+
+    Params
+        batch_size, threshold: voting parameters of get_sign_predicted
+    """
+
+    def __init__(self, reference_signs: pd.DataFrame, batch_size=1, threshold=0.5, **batcher_kwargs):
+        self.names = reference_signs["name"].values
+        self.video_ids = reference_signs["video_id"].values
+        self.batch_size = batch_size
+        self.threshold = threshold
+
+        self.matcher = BatchMatcher(reference_signs)
+        self.batcher = MicroBatcher(self.match, **batcher_kwargs)
+        self.stats = LatencyStats()
+
+    def match(self, requests):
+        """
+        :param requests: list of (landmarks (n_frame, N_LANDMARKS, 3), top_k)
+        :return: The prediction, the top_k closest reference signs & the matching time of each request
+        """
+        start = time.perf_counter()
+        recorded_signs = [
+            SignModel(landmarks[:, POSE_LANDMARKS], landmarks[:, LEFT_HAND_LANDMARKS], landmarks[:, RIGHT_HAND_LANDMARKS])
+            for landmarks, _ in requests
+        ]
+        with INSTRUMENTATION.span("dtw.batch"):
+            distances = self.matcher.get_distances(recorded_signs)
+        matching_time = time.perf_counter() - start
+
+        results = []
+        for (_, top_k), sign_distances in zip(requests, distances):
+            closest = np.argsort(sign_distances, kind="stable")[:max(top_k, self.batch_size)]
+            results.append({
+                "prediction": get_sign_predicted_from_names(self.names[closest], self.batch_size, self.threshold),
+                "top_k": [
+                    {
+                        "name": self.names[i],
+                        "video_id": self.video_ids[i],
+                        "distance": float(sign_distances[i]) if np.isfinite(sign_distances[i]) else None,
+                    }
+                    for i in closest[:top_k]
+                ],
+                "matching_ms": matching_time * 1000,
+            })
+        return results
+
+    async def recognize(self, request: dict) -> dict:
+        """
+        :param request: decoded JSON request
+        :raise ValueError: if the request is invalid
+        """
+        start = time.perf_counter()
+        landmarks, top_k = parse_request(request)
+        result, batch_size = await self.batcher.submit((landmarks, top_k))
+
+        latency = time.perf_counter() - start
+        self.stats.add(latency, result["matching_ms"] / 1000, batch_size)
+
+        response = dict(result, batch_size=batch_size, latency_ms=latency * 1000)
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+
+def parse_request(request):
+    """
+    :return: The landmarks (n_frame, N_LANDMARKS, 3) & the number of closest reference signs to return
+    :raise ValueError: if the request is invalid
+    """
+    if not isinstance(request, dict) or "landmarks" not in request:
+        raise ValueError('The request must be a JSON object with a "landmarks" field')
+    try:
+        landmarks = np.asarray(request["landmarks"], dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError("The landmarks must be an array of numbers")
+    if landmarks.ndim != 3 or landmarks.shape[1:] != (N_LANDMARKS, 3) or len(landmarks) == 0:
+        raise ValueError(f"The landmarks must be an array (n_frame, {N_LANDMARKS}, 3), got {landmarks.shape}")
+
+    top_k = request.get("top_k", TOP_K)
+    # bool is a subclass of int: "top_k": true must not be read as 1
+    if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+        raise ValueError("top_k must be a positive integer")
+    return np.nan_to_num(landmarks), top_k
+
+
+async def recognize(request: web.Request) -> web.Response:
+    try:
+        body = await request.json()
+        response = await request.app[RECOGNIZER].recognize(body)
+    except (ValueError, json.JSONDecodeError) as error:
+        return web.json_response({"error": str(error)}, status=400)
+    return web.json_response(response)
+
+
+async def recognize_ws(request: web.Request) -> web.WebSocketResponse:
+    """
+    Each text message is a request, answered as soon as it is recognized (not necessarily in order,
+    the "id" field of the request is sent back)
+    """
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    recognizer = request.app[RECOGNIZER]
+    send_lock = asyncio.Lock()
+
+    async def answer(message):
+        try:
+            response = await recognizer.recognize(json.loads(message))
+        except (ValueError, json.JSONDecodeError) as error:
+            response = {"error": str(error)}
+        async with send_lock:
+            if not ws.closed:
+                await ws.send_json(response)
+
+    tasks = set()
+    async for message in ws:
+        if message.type == WSMsgType.TEXT:
+            task = asyncio.create_task(answer(message.data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif message.type == WSMsgType.ERROR:
+            break
+
+    for task in tasks:
+        task.cancel()
+    return ws
+
+
+async def health(request: web.Request) -> web.Response:
+    recognizer = request.app[RECOGNIZER]
+    return web.json_response({
+        "status": "ok",
+        "references": len(recognizer.names),
+        "signs": len(set(recognizer.names)),
+        "embedding_version": EMBEDDING_VERSION,
+    })
+
+
+async def latency(request: web.Request) -> web.Response:
+    return web.json_response(request.app[RECOGNIZER].stats.get_report())
+
+
+async def metrics(request: web.Request) -> web.Response:
+    # Spans & counters of the recognition (empty unless the instrumentation is enabled)
+    return web.Response(text=INSTRUMENTATION.to_prometheus(), content_type="text/plain")
+
+
+def create_app(
+    reference_signs: pd.DataFrame = None, batch_size=1, threshold=0.5, max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_DELAY
+) -> web.Application:
+    """
+    :param reference_signs: pd.DataFrame of the reference signs (loaded from app/data if None,
+                            the service must then be started from the project directory)
+    """
+    if reference_signs is None:
+        reference_signs = load_reference_signs(load_dataset())
+
+    application = web.Application()
+    application[RECOGNIZER] = Recognizer(
+        reference_signs, batch_size=batch_size, threshold=threshold, max_batch_size=max_batch_size, max_delay=max_delay
+    )
+
+    async def start_batcher(application):
+        application[RECOGNIZER].batcher.start()
+
+    async def stop_batcher(application):
+        await application[RECOGNIZER].batcher.stop()
+
+    application.on_startup.append(start_batcher)
+    application.on_cleanup.append(stop_batcher)
+    application.add_routes([
+        web.post("/recognize", recognize),
+        web.get("/ws", recognize_ws),
+        web.get("/health", health),
+        web.get("/latency", latency),
+        web.get("/metrics", metrics),
+    ])
+    return application
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sign recognition service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE, help="requests matched together")
+    parser.add_argument("--max-delay", type=float, default=MAX_DELAY, help="seconds waited to fill a batch")
+    parser.add_argument("--instrument", action="store_true", help="record the latency of each stage (GET /metrics)")
+    args = parser.parse_args()
+
+    if args.instrument:
+        INSTRUMENTATION.enable()
+
+    web.run_app(create_app(max_batch_size=args.max_batch_size, max_delay=args.max_delay), host=args.host, port=args.port)